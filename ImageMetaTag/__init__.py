@@ -42,10 +42,24 @@ RESERVED_TAGS = ('interlace', 'gamma', 'dpi', 'transparency', 'aspect',
 # default timeout and retries for database access:
 DEFAULT_DB_TIMEOUT = 6
 DEFAULT_DB_ATTEMPTS = 20
+# default sqlite settings applied to every database connection, see
+# ImageMetaTag.db.connect_db. WAL journaling means readers and writers do not
+# block each other, but it needs a file system that supports shared memory
+# (i.e. not NFS), so set the journal mode to 'DELETE' if that is a problem:
+DEFAULT_DB_JOURNAL_MODE = 'WAL'
+DEFAULT_DB_SYNCHRONOUS = 'NORMAL'
+# memory mapped I/O (bytes) and page cache (negative values are in KiB):
+DEFAULT_DB_MMAP_SIZE = 256 * 1024 * 1024
+DEFAULT_DB_CACHE_SIZE = -16000
+# new database files are created with incremental auto vacuum, so that space
+# freed by deleting images can be reclaimed in small steps (see ImageMetaTag.db.compact):
+DEFAULT_DB_AUTO_VACUUM = 'INCREMENTAL'
 
 # we want all of the functions in webpage and db, as a separate level
 import ImageMetaTag.webpage
 import ImageMetaTag.db
+import ImageMetaTag.dbd
+import ImageMetaTag.shards
 # but only specfic parts of savefig and img_dict:
 from ImageMetaTag.savefig import savefig
 from ImageMetaTag.savefig import image_file_postproc
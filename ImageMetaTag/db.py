@@ -11,25 +11,49 @@ Released under BSD 3-Clause License. See LICENSE for more details.
 '''
 
 import os
+import sys
 import sqlite3
+import atexit
+import threading
 import fnmatch
 import time
 import errno
+import collections
+import random
 import pdb
 
 from datetime import datetime
 from io import StringIO
 import numpy as np
+try:
+    from urllib.request import pathname2url
+except ImportError:
+    from urllib import pathname2url
 
 from ImageMetaTag import META_IMG_FORMATS
 from ImageMetaTag import DEFAULT_DB_TIMEOUT
 from ImageMetaTag import DEFAULT_DB_ATTEMPTS
+from ImageMetaTag import DEFAULT_DB_JOURNAL_MODE, DEFAULT_DB_SYNCHRONOUS
+from ImageMetaTag import DEFAULT_DB_MMAP_SIZE, DEFAULT_DB_CACHE_SIZE
+from ImageMetaTag import DEFAULT_DB_AUTO_VACUUM
 from ImageMetaTag.img_dict import readmeta_from_image
 from ImageMetaTag.img_dict import check_for_required_keys
 
 # the name of the database table that holds the plot metadata
 SQLITE_IMG_INFO_TABLE = 'img_info'
 SQLITE_IMG_INFO_FNAME = 'fname'
+# the name of the table of tag values, for databases with encoded tags:
+SQLITE_TAG_VALUES_TABLE = 'img_tag_values'
+# the names of the tables of the change log, if it is enabled:
+SQLITE_CHANGES_TABLE = 'img_changes'
+SQLITE_TOMBSTONES_TABLE = 'img_tombstones'
+SQLITE_CHANGE_SEQ_TABLE = 'img_change_seq'
+# the start of a db_file that is written to through imt-dbd (see ImageMetaTag.dbd):
+DBD_URL_SCHEME = 'unix://'
+# INSERT ... ON CONFLICT DO UPDATE needs sqlite 3.24.0 or newer:
+SQLITE_HAS_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+# sqlite3.connect can only open a URI (for read-only connections) from python 3.4:
+SQLITE_HAS_URI = sys.version_info >= (3, 4)
 
 
 def info_key_to_db_name(in_str):
@@ -44,15 +68,18 @@ def db_name_to_info_key(in_str):
 
 
 def write_img_to_dbfile(db_file, img_filename, img_info, add_strict=False,
-                        attempt_replace=False,
-                        timeout=DEFAULT_DB_TIMEOUT):
+                        attempt_replace=False, encode_tags=False,
+                        timeout=DEFAULT_DB_TIMEOUT, keep_open=False):
     '''
     Writes image metadata to a database.
 
     Arguments:
 
     * db_file - the database file to write to. If it does not exist, it will \
-                be created.
+                be created. This can also be the address of an imt-dbd daemon \
+                (unix:///path/to/socket, see :mod:`ImageMetaTag.dbd`) which \
+                writes to the database for this process, or the directory of \
+                a sharded database (see :mod:`ImageMetaTag.shards`).
     * img_filename - the filename of the image to which the metadata applies. \
                      Usually this is either the absolute path, or it is \
                      useful to make this the relative path, from the location \
@@ -64,42 +91,201 @@ def write_img_to_dbfile(db_file, img_filename, img_info, add_strict=False,
 
     * add_strict - passed into :func:`ImageMetaTag.db.write_img_to_open_db`
     * attempt_replace - passed to :func:`ImageMetaTag.db.write_img_to_open_db`
+    * encode_tags - passed to :func:`ImageMetaTag.db.open_or_create_db_file`
     * timeout - default timeout to try and write to the database.
+    * keep_open - if True, the database connection is kept open, and reused \
+                  the next time this is called (by the same process and \
+                  thread) for the same database file. See \
+                  :func:`ImageMetaTag.db.close_pooled_connections`.
 
     This is commonly used in :func:`ImageMetaTag.savefig`
     '''
 
+    # (imported here, as ImageMetaTag.dbd imports this module)
+    from ImageMetaTag import dbd
+
     if len(img_info) == 0:
         raise ValueError('Size of image info dict is zero')
     if db_file is None:
         pass
+    elif dbd.is_dbd_url(db_file):
+        dbd.write_imgs(db_file, [(img_filename, img_info)], add_strict=add_strict,
+                       attempt_replace=attempt_replace, timeout=timeout,
+                       keep_open=keep_open)
+    elif os.path.isdir(db_file):
+        # a sharded database, so write to the shard for this image:
+        from ImageMetaTag import shards
+        write_img_to_dbfile(shards.shard_file_for_img(db_file, img_info), img_filename,
+                            img_info, add_strict=add_strict,
+                            attempt_replace=attempt_replace, encode_tags=encode_tags,
+                            timeout=timeout, keep_open=keep_open)
+    elif keep_open:
+        dbcn, dbcr = _pooled_db_file(db_file, img_info, timeout=timeout,
+                                     encode_tags=encode_tags)
+        try:
+            write_img_to_open_db(dbcr, img_filename, img_info,
+                                 add_strict=add_strict,
+                                 attempt_replace=attempt_replace)
+            dbcn.commit()
+        except:
+            # the cached schema and tag codes may not match the database
+            # after a rollback, so start again with a new connection next time:
+            _close_pooled_connection(db_file)
+            raise
     else:
         # open the database:
-        dbcn, dbcr = open_or_create_db_file(db_file, img_info, timeout=timeout)
-        # now write:
-        write_img_to_open_db(dbcr, img_filename, img_info,
-                             add_strict=add_strict,
-                             attempt_replace=attempt_replace)
-        # now commit that databasde entry and close:
+        dbcn, dbcr = open_or_create_db_file(db_file, img_info, timeout=timeout,
+                                            encode_tags=encode_tags)
+        try:
+            # now write:
+            write_img_to_open_db(dbcr, img_filename, img_info,
+                                 add_strict=add_strict,
+                                 attempt_replace=attempt_replace)
+            # now commit that databasde entry:
+            dbcn.commit()
+        finally:
+            # and close (rolling back if anything went wrong):
+            dbcn.close()
+
+
+def _pooled_db_file(db_file, img_info, timeout=DEFAULT_DB_TIMEOUT, encode_tags=False):
+    '''
+    Returns the pooled connection (dbcn) and a cursor (dbcr) for a database file,
+    for :func:`ImageMetaTag.db.write_img_to_dbfile` with keep_open=True, opening
+    it (by :func:`ImageMetaTag.db.open_or_create_db_file`) if needed.
+
+    A pooled connection is checked cheaply before it is reused: it is not used if
+    the database file has been deleted or replaced (so has a different inode),
+    and is not used at all in a forked process. The write transaction is begun
+    here, and the cached table schema is cleared if the schema has been changed
+    (by another process adding a tag, for instance) since it was last used.
+    '''
+    pool_key = (os.path.abspath(db_file), threading.current_thread().ident)
+    try:
+        db_stat = os.stat(pool_key[0])
+        file_id = (db_stat.st_dev, db_stat.st_ino)
+    except OSError:
+        file_id = None
+
+    pooled = _CONNECTION_POOL.get(pool_key)
+    if pooled is not None and pooled['pid'] != os.getpid():
+        _forget_pooled_connections()
+        pooled = None
+    if pooled is not None and pooled['file_id'] != file_id:
+        _close_pooled_connection(db_file)
+        pooled = None
+
+    if pooled is None:
+        dbcn, dbcr = open_or_create_db_file(db_file, img_info, timeout=timeout,
+                                            encode_tags=encode_tags)
+        # commit the table, if it has just been created:
         dbcn.commit()
-        dbcn.close()
+        db_stat = os.stat(pool_key[0])
+        pooled = {'pid': os.getpid(),
+                  'file_id': (db_stat.st_dev, db_stat.st_ino),
+                  'timeout': timeout,
+                  'schema_version': None,
+                  'dbcn': dbcn}
+        _CONNECTION_POOL[pool_key] = pooled
+    else:
+        dbcn = pooled['dbcn']
+        dbcr = dbcn.cursor()
+        if pooled['timeout'] != timeout:
+            dbcr.execute('PRAGMA busy_timeout = {:d}'.format(int(timeout * 1000)))
+            pooled['timeout'] = timeout
+
+    # take the write lock, so the schema cannot change before the write:
+    dbcr.execute('BEGIN IMMEDIATE')
+    schema_version = dbcr.execute('PRAGMA schema_version').fetchone()[0]
+    if schema_version != pooled['schema_version']:
+        invalidate_schema_cache(dbcr)
+        pooled['schema_version'] = schema_version
+    return dbcn, dbcr
+
+
+def _close_pooled_connection(db_file):
+    'Closes the pooled connection to db_file, for this thread, if there is one'
+    pool_key = (os.path.abspath(db_file), threading.current_thread().ident)
+    pooled = _CONNECTION_POOL.pop(pool_key, None)
+    if pooled is None:
+        pass
+    elif pooled['pid'] != os.getpid():
+        _FORKED_CONNECTIONS.append(pooled['dbcn'])
+    else:
+        # (close rolls back anything that has not been committed)
+        pooled['dbcn'].close()
+
+
+def _forget_pooled_connections():
+    '''
+    Empties the connection pool in a forked process. The connections belong to
+    the parent process, so are kept (and not closed) in _FORKED_CONNECTIONS, as
+    closing them here could checkpoint or delete the parent's WAL file.
+    '''
+    _FORKED_CONNECTIONS.extend([x['dbcn'] for x in _CONNECTION_POOL.values()])
+    _CONNECTION_POOL.clear()
+
+
+def close_pooled_connections():
+    '''
+    Closes all of the database connections that have been kept open by
+    :func:`ImageMetaTag.db.write_img_to_dbfile` with keep_open=True (or
+    :func:`ImageMetaTag.savefig` with db_keep_open=True).
+
+    Pooled connections are kept per process and thread, and are closed
+    automatically when python exits, so this only needs to be called to
+    release the database files sooner than that.
+    '''
+    for pool_key in list(_CONNECTION_POOL.keys()):
+        pooled = _CONNECTION_POOL.pop(pool_key)
+        if pooled['pid'] != os.getpid():
+            _FORKED_CONNECTIONS.append(pooled['dbcn'])
+            continue
+        try:
+            pooled['dbcn'].close()
+        except sqlite3.ProgrammingError:
+            # opened by another thread, which should close it itself:
+            pass
+
+
+# the connections kept open by write_img_to_dbfile(keep_open=True), keyed by the
+# absolute path of the database file and the thread that uses them:
+_CONNECTION_POOL = {}
+# connections pooled by the parent of a forked process, which must not be used,
+# or closed, by the child:
+_FORKED_CONNECTIONS = []
+atexit.register(close_pooled_connections)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_pooled_connections)
 
 
 def read(db_file, required_tags=None, tag_strings=None,
          db_timeout=DEFAULT_DB_TIMEOUT,
          db_attempts=DEFAULT_DB_ATTEMPTS,
-         n_samples=None):
+         n_samples=None, tag_codes=False, sample_seed=None, immutable=False,
+         where=None):
     '''
     reads in the database written by write_img_to_dbfile
 
     Options:
      * required_tags - a list of image tags to return, and to fail if not all are \
-                       present
-     * tag_strings - an input list that will be populated with the unique values of \
-                     the image tags.
+                       present. Only these tags are read from the database.
+     * where - a dict of tag names & acceptable values, to only read the \
+               images that match (as :func:`ImageMetaTag.db.select_dbfile_by_tags`).
+     * tag_strings - an input list, or dict, that will be populated with the unique \
+                     values of the image tags.
      * n_samples - if provided, only the given number of entries will be loaded \
                    from the database, at random. \
                    Must be an integer or None (default None)
+     * sample_seed - the seed for the random sample, when using n_samples, \
+                     so the same sample can be read again.
+     * immutable - the database file does not change, so can be read without \
+                   any locking (see :func:`ImageMetaTag.db.open_db_file`).
+     * tag_codes - for databases with encoded tags (see \
+                   :func:`ImageMetaTag.db.create_table_for_img_info`), return \
+                   the integer codes of the tag values, rather than the values \
+                   themselves. :func:`ImageMetaTag.db.read_tag_values` gives \
+                   the values for the codes.
 
     Returns:
      * a list of filenames (payloads for the :class:`ImageMetaTag.ImageDict` class )
@@ -114,53 +300,402 @@ def read(db_file, required_tags=None, tag_strings=None,
     the dictionary itself but also of an :class:`ImageMetaTag.ImageDict` produced
     with the dictionary.
 
+    tag_strings can also be a dict, used as a pool of strings ({string: string}).
+    This is faster to populate than a list, and the same dict can be passed to
+    several reads (of different databases, for instance) so that they all share
+    the same strings.
+
+    The database is opened read-only, so reading it does not hold up processes
+    that are writing to it.
+
+    db_file can also be the directory of a sharded database (see
+    :mod:`ImageMetaTag.shards`), in which case only the shards that can match
+    the where option are read, in parallel.
+
     Will return None, None if there is a problem.
 
     In older versions, this was named read_img_info_from_dbfile which will still work.
     '''
     if db_file is None:
         return None, None
+    if os.path.isdir(db_file):
+        # (imported here, as ImageMetaTag.shards imports this module)
+        from ImageMetaTag import shards
+        return shards.read(db_file, required_tags=required_tags, tag_strings=tag_strings,
+                           db_timeout=db_timeout, db_attempts=db_attempts,
+                           n_samples=n_samples, sample_seed=sample_seed,
+                           immutable=immutable, where=where, tag_codes=tag_codes)
     if not os.path.isfile(db_file):
         return None, None
 
-    n_tries = 1
-    read_db = False
-    while not read_db and n_tries <= db_attempts:
+    def _read_db():
+        'opens the database and reads it, for retry_if_locked'
+        dbcn, dbcr = open_db_file(db_file, timeout=db_timeout, read_only=True,
+                                  immutable=immutable)
         try:
-            # open the connection and the cursor:
-            dbcn, dbcr = open_db_file(db_file, timeout=db_timeout)
-            # read it:
-            f_list, out_dict = read_img_info_from_dbcursor(dbcr,
-                                                           required_tags=required_tags,
-                                                           tag_strings=tag_strings,
-                                                           n_samples=n_samples)
-            # close connection:
-            dbcn.close()
-            read_db = True
+            return read_img_info_from_dbcursor(dbcr,
+                                               required_tags=required_tags,
+                                               tag_strings=tag_strings,
+                                               n_samples=n_samples,
+                                               tag_codes=tag_codes,
+                                               sample_seed=sample_seed,
+                                               where=where)
         except sqlite3.OperationalError as op_err:
-            if 'database is locked' in repr(op_err):
-                # database being locked is what the retries and timeouts are for:
-                print('%s database timeout reading from file "%s", %s s' \
-                        % (dt_now_str(), db_file, n_tries * db_timeout))
-                n_tries += 1
-            elif 'no such table: {}'.format(SQLITE_IMG_INFO_TABLE) in repr(op_err):
+            if 'no such table: {}'.format(SQLITE_IMG_INFO_TABLE) in repr(op_err):
                 # the db file exists, but it doesn't have anything in it:
                 return None, None
+            raise
+        finally:
+            dbcn.close()
+
+    return retry_if_locked(_read_db, db_file, db_timeout=db_timeout,
+                           db_attempts=db_attempts, action='reading from')
+
+read_img_info_from_dbfile = read
+
+
+def iter_read(db_file, batch_size=1000, required_tags=None, where=None,
+              yield_batches=False, tag_codes=False, immutable=False,
+              order_by=None, db_timeout=DEFAULT_DB_TIMEOUT):
+    '''
+    A generator that reads the database written by write_img_to_dbfile,
+    without loading it all into memory at once. Rows are read from the
+    database batch_size at a time, using fetchmany.
+
+    Options:
+     * batch_size - the number of rows to read from the database at a time.
+     * required_tags - a list of image tags to return, and to fail if not \
+                       all are present.
+     * where - a dict of tag names & acceptable values, to only read the \
+               images that match (as :func:`ImageMetaTag.db.select_dbfile_by_tags`).
+     * yield_batches - if True, yield a list of (filename, img_info) per \
+                       batch rather than one at a time.
+     * tag_codes - as :func:`ImageMetaTag.db.read`.
+     * immutable - as :func:`ImageMetaTag.db.read`.
+     * order_by - a list of tag names, to yield the images sorted by the \
+                  (stored) values of those tags. For databases with encoded \
+                  tags, this sorts by the codes, so the images with the same \
+                  values are together, but the values are not in order. \
+                  Images without a tag are sorted as if it were 'None'.
+
+    Yields (filename, img_info) pairs, where img_info is a dictionary of the
+    image metadata as *tagname: value*. Nothing is yielded if the database
+    file, or its table, does not exist.
+
+    The database connection is held open until the generator is finished
+    (or closed) so it is best to consume it promptly.
+    '''
+    if db_file is None or not os.path.isfile(db_file):
+        return
+    if batch_size < 1:
+        raise ValueError('batch_size must be >= 1')
+
+    dbcn, dbcr = open_db_file(db_file, timeout=db_timeout, read_only=True,
+                              immutable=immutable)
+    try:
+        schema = get_table_schema(dbcr)
+        field_names = schema['fields']
+        if not field_names:
+            return
+        decode = tag_value_decoder(dbcr, schema, tag_codes=tag_codes)
+        select_cols, where_command, where_values = _select_clauses(
+            dbcr, required_tags=required_tags, where=where)
+        select_command = 'SELECT {} FROM {}'.format(select_cols, SQLITE_IMG_INFO_TABLE)
+        if where_command:
+            select_command += ' WHERE {}'.format(where_command)
+        if order_by:
+            missing_tags = [x for x in order_by if x not in schema['field_set']]
+            if missing_tags:
+                msg = 'Database does not contain all of the tags to order by, missing: {}'
+                raise ValueError(msg.format(missing_tags))
+            # missing tags (NULL) are read as 'None', so are sorted with any 'None' values,
+            # then by rowid, so images with the same values are in the order they were added:
+            if schema['encoded']:
+                order_col = ('IFNULL("{{}}", (SELECT code FROM {} '
+                             "WHERE tag=? AND value='None'))").format(SQLITE_TAG_VALUES_TABLE)
+                where_values = list(where_values) + list(order_by)
             else:
-                # everything else needs to be reported and raised immediately:
-                msg = '{} for file {}'.format(op_err, db_file)
-                raise sqlite3.OperationalError(msg)
+                order_col = 'IFNULL("{}", \'None\')'
+            select_command += ' ORDER BY {}, rowid'.format(
+                ', '.join([order_col.format(info_key_to_db_name(x)) for x in order_by]))
+        dbcr.execute(select_command, where_values)
+        use_fields = list(enumerate([db_name_to_info_key(x[0]) for x in dbcr.description]))[1:]
+        while True:
+            rows = dbcr.fetchmany(batch_size)
+            if not rows:
+                break
+            batch = [(str(row[0]), dict([(key, decode(row[i_fld])) for i_fld, key in use_fields]))
+                     for row in rows]
+            if yield_batches:
+                yield batch
+            else:
+                for img in batch:
+                    yield img
+    finally:
+        dbcn.close()
 
-    # if we went through all the attempts then it is time to raise the error:
-    if n_tries > db_attempts:
-        msg = '{} for file {}'.format(op_err, db_file)
-        raise sqlite3.OperationalError(msg)
 
-    # close connection:
-    dbcn.close()
-    return f_list, out_dict
+def read_columnar(db_file, tags=None, batch_size=10000, immutable=False,
+                  db_timeout=DEFAULT_DB_TIMEOUT,
+                  db_attempts=DEFAULT_DB_ATTEMPTS):
+    '''
+    Reads the database written by write_img_to_dbfile into arrays, by column,
+    rather than a dictionary per image. Each tag is returned as a categorical
+    array: the sorted unique values of the tag, and an integer code for each
+    image that indexes them. These are much more compact than the output of
+    :func:`ImageMetaTag.db.read` and can be filtered with numpy, for instance
+    the filenames of all histograms are::
 
-read_img_info_from_dbfile = read
+        codes, uniques = columns['plot type']
+        fnames[uniques[codes] == 'Histogram']
+
+    Options:
+     * tags - a list of the image tags to return, and to fail if not all are \
+              present. Default is all the tags.
+     * batch_size - the number of rows fetched from the database at a time.
+     * immutable - as :func:`ImageMetaTag.db.read`.
+
+    Returns:
+     * a numpy (object) array of filenames
+     * a dictionary, by tag name, of (codes, uniques) where codes is an integer \
+       numpy array (one per filename) and uniques a numpy (object) array of \
+       the values of that tag.
+
+    Will return None, None if there is a problem.
+    '''
+    if db_file is None:
+        return None, None
+    if not os.path.isfile(db_file):
+        return None, None
+
+    def _read_db():
+        'opens the database and reads it, for retry_if_locked'
+        dbcn, dbcr = open_db_file(db_file, timeout=db_timeout, read_only=True,
+                                  immutable=immutable)
+        try:
+            return _read_columnar_from_dbcursor(dbcr, tags, batch_size)
+        except sqlite3.OperationalError as op_err:
+            if 'no such table: {}'.format(SQLITE_IMG_INFO_TABLE) in repr(op_err):
+                # the db file exists, but it doesn't have anything in it:
+                return None, None
+            raise
+        finally:
+            dbcn.close()
+
+    return retry_if_locked(_read_db, db_file, db_timeout=db_timeout,
+                           db_attempts=db_attempts, action='reading from')
+
+
+def _read_columnar_from_dbcursor(dbcr, tags, batch_size):
+    'Does the work for :func:`ImageMetaTag.db.read_columnar` on an open database cursor'
+    schema = get_table_schema(dbcr)
+    if not schema['fields']:
+        raise sqlite3.OperationalError('no such table: {}'.format(SQLITE_IMG_INFO_TABLE))
+    use_fields = _fields_to_read(schema['fields'], required_tags=tags)
+    decode = tag_value_decoder(dbcr, schema)
+
+    # only select the columns that are needed:
+    select_cols = [SQLITE_IMG_INFO_FNAME]
+    select_cols += ['"{}"'.format(info_key_to_db_name(key)) for _, key in use_fields]
+    dbcr.execute('SELECT {} FROM {}'.format(', '.join(select_cols), SQLITE_IMG_INFO_TABLE))
+
+    # for each tag, a dict of the values (as stored, so codes for encoded tags)
+    # to their position in the list of unique values, and the list of positions.
+    # Each batch of rows is transposed, so the columns are mapped in one go:
+    fnames = []
+    columns = [(_CategoryCodes(), []) for _ in use_fields]
+    while True:
+        rows = dbcr.fetchmany(batch_size)
+        if not rows:
+            break
+        row_cols = list(zip(*rows))
+        fnames.extend(row_cols[0])
+        for (lookup, codes), row_col in zip(columns, row_cols[1:]):
+            codes.extend(map(lookup.__getitem__, row_col))
+
+    out_cols = {}
+    for (_, key), (lookup, codes) in zip(use_fields, columns):
+        uniques = np.array([decode(x) for x in sorted(lookup, key=lookup.get)], dtype=object)
+        codes = np.array(codes, dtype=np.int32)
+        # sort the unique values, and remap the codes to match:
+        order = np.argsort(uniques)
+        remap = np.empty(len(order), dtype=np.int32)
+        remap[order] = np.arange(len(order), dtype=np.int32)
+        out_cols[key] = (remap[codes], uniques[order])
+    return np.array(fnames, dtype=object), out_cols
+
+
+class _CategoryCodes(dict):
+    'A dict that gives each new key the next integer code, when it is looked up'
+    def __missing__(self, key):
+        code = self[key] = len(self)
+        return code
+
+
+def distinct_tag_values(db_file, tags=None, where=None, immutable=False,
+                        db_timeout=DEFAULT_DB_TIMEOUT,
+                        db_attempts=DEFAULT_DB_ATTEMPTS):
+    '''
+    Returns the unique values of tags in a database file, without reading the
+    images from it. The values are found by sqlite, using SELECT DISTINCT,
+    which only needs to read the index when a tag is indexed (see
+    :func:`ImageMetaTag.db.create_tag_indexes`). This gives the keys for each
+    level of an :class:`ImageMetaTag.ImageDict`, for instance, before (or
+    instead of) reading the whole database.
+
+    Options:
+     * tags - a list of what to find the unique values of. Each element can \
+              be a tag name, or a list/tuple of tag names for the unique \
+              combinations of their values. Default is every tag.
+     * where - a dict of tag names & acceptable values, to only use the \
+               images that match (as :func:`ImageMetaTag.db.select_dbfile_by_tags`).
+     * immutable - as :func:`ImageMetaTag.db.read`.
+     * db_timeout - change the database timeout (in seconds).
+     * db_attempts - change the number of attempts to access the database.
+
+    Returns a dict, by the elements of tags (as tuples, for lists of tag names),
+    of the sorted lists of the unique values (or tuples of values). Returns None
+    if the database file, or its table, does not exist.
+    '''
+    return _group_tag_values(db_file, tags, where, False, immutable=immutable,
+                             db_timeout=db_timeout, db_attempts=db_attempts)
+
+
+def tag_value_counts(db_file, tags=None, where=None, immutable=False,
+                     db_timeout=DEFAULT_DB_TIMEOUT,
+                     db_attempts=DEFAULT_DB_ATTEMPTS):
+    '''
+    Returns the number of images with each value of tags in a database file,
+    without reading the images from it. The counts are worked out by sqlite
+    with GROUP BY, which only needs to read the index when a tag is indexed.
+    This can be used to check the coverage of the images, for instance.
+
+    The options are the same as :func:`ImageMetaTag.db.distinct_tag_values`.
+
+    Returns a dict, by the elements of tags (as tuples, for lists of tag names),
+    of dicts of {value: number of images}, where the values are tuples for lists
+    of tag names. Returns None if the database file, or its table, does not exist.
+    '''
+    return _group_tag_values(db_file, tags, where, True, immutable=immutable,
+                             db_timeout=db_timeout, db_attempts=db_attempts)
+
+
+def _group_tag_values(db_file, tags, where, counts, immutable=False,
+                      db_timeout=DEFAULT_DB_TIMEOUT,
+                      db_attempts=DEFAULT_DB_ATTEMPTS):
+    '''
+    Does the work for :func:`ImageMetaTag.db.distinct_tag_values` and
+    (if counts is True) :func:`ImageMetaTag.db.tag_value_counts`.
+    '''
+    if db_file is None or not os.path.isfile(db_file):
+        return None
+
+    def _read_db():
+        'opens the database and reads the tag values, for retry_if_locked'
+        dbcn, dbcr = open_db_file(db_file, timeout=db_timeout, read_only=True,
+                                  immutable=immutable)
+        try:
+            return _group_tag_values_in_dbcr(dbcr, tags, where, counts)
+        except sqlite3.OperationalError as op_err:
+            if 'no such table: {}'.format(SQLITE_IMG_INFO_TABLE) in repr(op_err):
+                # the db file exists, but it doesn't have anything in it:
+                return None
+            raise
+        finally:
+            dbcn.close()
+
+    return retry_if_locked(_read_db, db_file, db_timeout=db_timeout,
+                           db_attempts=db_attempts, action='reading from')
+
+
+def _group_tag_values_in_dbcr(dbcr, tags, where, counts):
+    'Does the work for :func:`ImageMetaTag.db._group_tag_values` on an open database cursor'
+    schema = get_table_schema(dbcr)
+    if tags is None:
+        tags = schema['fields'][1:]
+    tag_groups = [tuple(x) if isinstance(x, (list, tuple)) else x for x in tags]
+    all_tags = []
+    for tag_group in tag_groups:
+        all_tags.extend(tag_group if isinstance(tag_group, tuple) else [tag_group])
+    # check the tags, and get the WHERE clause:
+    _, where_command, where_values = _select_clauses(dbcr, required_tags=all_tags, where=where)
+    where_command = '' if where_command is None else ' WHERE {}'.format(where_command)
+    decode = tag_value_decoder(dbcr, schema)
+
+    tag_values = {}
+    for tag_group in tag_groups:
+        group_tags = tag_group if isinstance(tag_group, tuple) else (tag_group,)
+        db_names = ', '.join(['"{}"'.format(info_key_to_db_name(x)) for x in group_tags])
+        if counts:
+            sel_command = 'SELECT {0}, COUNT(*) FROM {1}{2} GROUP BY {0}'
+        else:
+            sel_command = 'SELECT DISTINCT {0} FROM {1}{2}'
+        sel_command = sel_command.format(db_names, SQLITE_IMG_INFO_TABLE, where_command)
+        rows = dbcr.execute(sel_command, where_values).fetchall()
+        if isinstance(tag_group, tuple):
+            values = [tuple([decode(x) for x in row[:len(group_tags)]]) for row in rows]
+        else:
+            values = [decode(row[0]) for row in rows]
+        if counts:
+            tag_values[tag_group] = dict(zip(values, [row[-1] for row in rows]))
+        else:
+            tag_values[tag_group] = sorted(values)
+    return tag_values
+
+
+def _fields_to_read(field_names, required_tags=None):
+    '''
+    Returns a list of (index, tag name) for the tag fields, in field_names,
+    that are to be read. If required_tags are supplied, then only those are
+    used and a ValueError is raised if they are not all present.
+    '''
+    if required_tags is None:
+        return list(enumerate(field_names))[1:]
+    if not isinstance(required_tags, list):
+        raise ValueError('Input required_tags should be a list of strings')
+    for test_str in required_tags:
+        if not isinstance(test_str, str):
+            raise ValueError('Input required_tags should be a list of strings')
+    missing_tags = [x for x in required_tags if x not in field_names[1:]]
+    if missing_tags:
+        msg = 'Database does not contain all of the required_tags, missing: {}'
+        raise ValueError(msg.format(missing_tags))
+    return [(i_fld, key) for i_fld, key in enumerate(field_names)
+            if i_fld > 0 and key in required_tags]
+
+
+def _select_clauses(dbcr, required_tags=None, where=None):
+    '''
+    Returns the parts of a SELECT from the ImageMetaTag table, for an open
+    database cursor (dbcr), so that sqlite only reads the columns and rows
+    that are needed, rather than everything being read and filtered in python:
+     * the columns to select: the filename and the required_tags, or * for all.
+     * the WHERE clause (without the WHERE) for a dict of tag names & acceptable \
+       values (see :func:`ImageMetaTag.db.where_from_tags`), or None.
+     * the list of values to go with the WHERE clause.
+
+    The tags are checked against the table schema first, so a ValueError is
+    raised straight away if any of them are missing.
+    '''
+    schema = get_table_schema(dbcr)
+    if not schema['fields']:
+        raise sqlite3.OperationalError('no such table: {}'.format(SQLITE_IMG_INFO_TABLE))
+    if required_tags is None:
+        select_cols = '*'
+    else:
+        use_fields = _fields_to_read(schema['fields'], required_tags=required_tags)
+        select_cols = ', '.join([SQLITE_IMG_INFO_FNAME] +
+                                ['"{}"'.format(info_key_to_db_name(key)) for _, key in use_fields])
+    if not where:
+        return select_cols, None, []
+    missing_tags = [x for x in where if x not in schema['field_set']]
+    if missing_tags:
+        msg = 'Database does not contain all of the tags to select by, missing: {}'
+        raise ValueError(msg.format(missing_tags))
+    if schema['encoded']:
+        where = _encode_select_tags(dbcr, schema, where)
+    where_command, where_values = where_from_tags(where)
+    return select_cols, where_command, where_values
 
 
 def merge_db_files(main_db_file, add_db_file, delete_add_db=False,
@@ -170,66 +705,408 @@ def merge_db_files(main_db_file, add_db_file, delete_add_db=False,
                    db_attempts=DEFAULT_DB_ATTEMPTS):
     '''
     Merges two ImageMetaTag database files, with the contents of add_db_file
-    added to the main_db_file. The databases should have the same tags within
-    them for the merge to work.
+    added to the main_db_file. Tags in the add_db_file that are not in the
+    main_db_file are added to it (unless add_strict), and images in the
+    main_db_file get a value of 'None' for tags missing from the add_db_file.
+
+    The add_db_file is attached to the main database, and the images copied
+    across by sqlite, in a single transaction, so this is fast however many
+    images are added. Databases with encoded tags (see
+    :func:`ImageMetaTag.db.create_table_for_img_info`) are merged by reading
+    the add_db_file and writing its contents with
+    :func:`ImageMetaTag.db.write_imgs_to_open_db` instead.
 
     Options:
 
     * add_strict - passed into :func:`ImageMetaTag.db.write_img_to_open_db`
-    * attempt_replace - passed to :func:`ImageMetaTag.db.write_img_to_open_db`
+    * attempt_replace - if True, images that are already in the main_db_file \
+                        have their tags updated (as \
+                        :func:`ImageMetaTag.db.write_img_to_open_db`). \
+                        Otherwise they are left as they are.
     * delete_add_db - if True, the added file will be deleted afterwards
     * delete_added_entries - if delete_add_db is False, this will keep the \
                              add_db_file but remove the entries from it which \
                              were added to the main_db_file. This is useful \
                              if parallel processes are writing to the \
                              databases. Ignored if delete_add_db is True.
+
+    Returns the number of images written to the main_db_file, so not those that
+    were already there, unless attempt_replace. Databases with encoded tags
+    return the number of images read from the add_db_file.
+    '''
+    n_merged = 0
+    if os.path.isfile(add_db_file):
+        def _merge_db():
+            'opens the main database and merges into it, for retry_if_locked'
+            dbcn, dbcr = open_db_file(main_db_file, timeout=db_timeout)
+            try:
+                return _merge_attached_db(dbcr, add_db_file, add_strict=add_strict,
+                                          attempt_replace=attempt_replace,
+                                          delete_added_entries=(delete_added_entries
+                                                                and not delete_add_db))
+            finally:
+                dbcn.close()
+
+        n_merged = retry_if_locked(_merge_db, main_db_file, db_timeout=db_timeout,
+                                   db_attempts=db_attempts, action='writing to')
+        if n_merged is None:
+            n_merged = _merge_db_files_by_reading(main_db_file, add_db_file,
+                                                  delete_added_entries=(delete_added_entries
+                                                                        and not delete_add_db),
+                                                  attempt_replace=attempt_replace,
+                                                  add_strict=add_strict,
+                                                  db_timeout=db_timeout,
+                                                  db_attempts=db_attempts)
+
+    if delete_add_db:
+        rm_db_file(add_db_file)
+    return n_merged
+
+
+def _merge_attached_db(dbcr, add_db_file, add_strict=False, attempt_replace=False,
+                       delete_added_entries=False):
+    '''
+    Does the work for :func:`ImageMetaTag.db.merge_db_files`, merging the
+    add_db_file into the open database cursor (dbcr) by attaching it.
+
+    Returns the number of rows written (inserted or updated) in the main
+    database, or None if either database has encoded tags, and so cannot be
+    merged this way.
     '''
+    add_schema = 'imt_add'
+    dbcr.execute('ATTACH DATABASE ? AS {}'.format(add_schema), (add_db_file,))
+    try:
+        table_info = dbcr.execute('PRAGMA {}.table_info({})'.format(add_schema,
+                                                                      SQLITE_IMG_INFO_TABLE))
+        add_fields = [db_name_to_info_key(x[1]) for x in table_info.fetchall()]
+        if not add_fields:
+            # the add_db_file has nothing in it:
+            return 0
+        add_encoded = dbcr.execute(("SELECT name FROM {}.sqlite_master "
+                                    "WHERE type='table' AND name=?").format(add_schema),
+                                   (SQLITE_TAG_VALUES_TABLE,)).fetchone()
+        schema = get_table_schema(dbcr)
+        if add_encoded is not None or schema['encoded']:
+            return None
+
+        # lock the main database for the whole merge:
+        dbcr.execute('BEGIN IMMEDIATE')
+        try:
+            # bring the table of the main database into line with the add_db_file:
+            invalidate_schema_cache(dbcr)
+            schema = get_table_schema(dbcr)
+            if not schema['fields']:
+                create_table_for_img_info(dbcr, dict([(x, '') for x in add_fields[1:]]))
+                schema = get_table_schema(dbcr)
+            new_fields = [x for x in add_fields if x not in schema['field_set']]
+            if new_fields:
+                _add_new_fields(dbcr, schema, new_fields, add_strict=add_strict)
+
+            # copy the images across:
+            db_names = ['"{}"'.format(info_key_to_db_name(x)) for x in add_fields]
+            n_merged = 0
+            if attempt_replace and len(db_names) > 1 and SQLITE_HAS_UPSERT:
+                # (the WHERE is needed so the ON CONFLICT is not ambiguous)
+                merge_command = ('INSERT INTO main.{0}({1}) SELECT {1} FROM {2}.{0} WHERE 1 '
+                                 'ON CONFLICT({3}) DO UPDATE SET {4}')
+            else:
+                merge_command = 'INSERT OR IGNORE INTO main.{0}({1}) SELECT {1} FROM {2}.{0}'
+                if attempt_replace and len(db_names) > 1:
+                    # without UPSERT, update the images that are already there first:
+                    updates = ', '.join(['{0}=(SELECT {0} FROM {1}.{2} AS imt_added '
+                                         'WHERE imt_added.{3}={2}.{3})'.format(
+                                             x, add_schema, SQLITE_IMG_INFO_TABLE,
+                                             SQLITE_IMG_INFO_FNAME) for x in db_names[1:]])
+                    dbcr.execute('UPDATE main.{0} SET {1} WHERE {2} IN (SELECT {2} FROM {3}.{0})'
+                                 .format(SQLITE_IMG_INFO_TABLE, updates,
+                                         SQLITE_IMG_INFO_FNAME, add_schema))
+                    n_merged += dbcr.rowcount
+            updates = ', '.join(['{0}=excluded.{0}'.format(x) for x in db_names[1:]])
+            merge_command = merge_command.format(SQLITE_IMG_INFO_TABLE, ', '.join(db_names),
+                                                 add_schema, SQLITE_IMG_INFO_FNAME, updates)
+            dbcr.execute(merge_command)
+            n_merged += dbcr.rowcount
+
+            if delete_added_entries:
+                # this is in the same transaction, so only removes what was merged:
+                dbcr.execute('DELETE FROM {}.{}'.format(add_schema, SQLITE_IMG_INFO_TABLE))
+            dbcr.connection.commit()
+        except:
+            dbcr.connection.rollback()
+            raise
+        return n_merged
+    finally:
+        dbcr.execute('DETACH DATABASE {}'.format(add_schema))
 
+
+def _merge_db_files_by_reading(main_db_file, add_db_file, delete_added_entries=False,
+                               attempt_replace=False, add_strict=False,
+                               db_timeout=DEFAULT_DB_TIMEOUT,
+                               db_attempts=DEFAULT_DB_ATTEMPTS):
+    '''
+    Merges two ImageMetaTag database files, as :func:`ImageMetaTag.db.merge_db_files`,
+    by reading in the add_db_file and writing its contents to the main_db_file.
+
+    Returns the number of images merged.
+    '''
     # read what we want to add in:
     add_filelist, add_tags = read(add_db_file, db_timeout=db_timeout, db_attempts=db_attempts)
-    if add_filelist is not None:
-        if len(add_filelist) > 0:
-            n_tries = 1
-            wrote_db = False
-            while not wrote_db and n_tries <= db_attempts:
-                try:
-                    # open the main database
-                    dbcn, dbcr = open_db_file(main_db_file, timeout=db_timeout)
-                    # and add in the new contents:
-                    for add_file, add_info in add_tags.items():
-                        write_img_to_open_db(dbcr, add_file, add_info,
-                                             add_strict=add_strict,
-                                             attempt_replace=attempt_replace)
-                    dbcn.commit()
-                    # if we got here, then we're good!
-                    wrote_db = True
-                    # finally close:
-                    dbcn.close()
-                except sqlite3.OperationalError as op_err:
-                    if 'database is locked' in repr(op_err):
-                        # database being locked is what the retries and timeouts are for:
-                        print('%s database timeout writing to file "%s", %s s' \
-                                        % (dt_now_str(), main_db_file, n_tries * db_timeout))
-                        n_tries += 1
-                    else:
-                        # everything else needs to be reported and raised immediately:
-                        msg = '{} for file {}'.format(op_err, main_db_file)
-                        raise sqlite3.OperationalError(msg)
+    if not add_filelist:
+        return 0
 
-            # if we went through all the attempts then it is time to raise the error:
-            if n_tries > db_attempts:
-                msg = '{} for file {}'.format(op_err, main_db_file)
-                raise sqlite3.OperationalError(msg)
+    def _merge_db():
+        'opens the main database and adds to it, for retry_if_locked'
+        dbcn, dbcr = open_db_file(main_db_file, timeout=db_timeout)
+        try:
+            # add in the new contents:
+            write_imgs_to_open_db(dbcr, add_tags.items(),
+                                  add_strict=add_strict,
+                                  attempt_replace=attempt_replace)
+            dbcn.commit()
+        finally:
+            dbcn.close()
 
-    # delete or tidy:
-    if delete_add_db:
-        rmfile(add_db_file)
-    elif delete_added_entries:
+    retry_if_locked(_merge_db, main_db_file, db_timeout=db_timeout,
+                    db_attempts=db_attempts, action='writing to')
+
+    if delete_added_entries:
         del_plots_from_dbfile(add_db_file, add_filelist, do_vacuum=False,
                               allow_retries=True, skip_warning=True)
+    return len(add_filelist)
+
+
+def merge_many_db_files(main_db_file, shard_db_files, delete_shards=False,
+                        delete_added_entries=False, attempt_replace=False,
+                        add_strict=False,
+                        db_timeout=DEFAULT_DB_TIMEOUT,
+                        db_attempts=DEFAULT_DB_ATTEMPTS):
+    '''
+    Merges many ImageMetaTag database files (shards), such as those written by
+    parallel processes that each have their own database, into the main_db_file.
+
+    This is much faster than calling :func:`ImageMetaTag.db.merge_db_files` for
+    each shard. Each shard is attached in turn and copied into a temporary
+    table, without locking the main_db_file. Then any new tags are added to the
+    main_db_file, and all of the shards are copied into it, in a single transaction.
+
+    Shards may have different tags to each other and the main_db_file, and
+    any of them can have encoded tags (see
+    :func:`ImageMetaTag.db.create_table_for_img_info`).
+
+    Options:
+     * delete_shards - if True, the shard files will be deleted afterwards
+     * delete_added_entries - if delete_shards is False, this will keep the \
+                              shard files but remove the entries from them which \
+                              were added to the main_db_file.
+     * attempt_replace - if True, images that are already in the main_db_file \
+                         have their tags updated. Otherwise they are left as they are.
+     * add_strict - passed into :func:`ImageMetaTag.db.write_img_to_open_db`
+
+    Returns an OrderedDict, by shard file, of a dictionary containing:
+     * n_rows - the number of images written to the main_db_file from the shard. \
+                Images that were already there are only counted if they \
+                are replaced (with attempt_replace).
+     * read_time - the time taken to read the shard, in seconds.
+     * write_time - the time taken to write the shard to the main_db_file, in seconds.
+    '''
+    shard_db_files = [x for x in shard_db_files if os.path.isfile(x)]
+
+    def _merge_db():
+        'opens the main database and merges all the shards into it, for retry_if_locked'
+        dbcn, dbcr = open_db_file(main_db_file, timeout=db_timeout)
+        try:
+            stats = collections.OrderedDict()
+            staged_tags, shard_tags = _stage_shards(dbcr, shard_db_files, stats)
+            if any([x['n_staged'] for x in stats.values()]):
+                _write_staged_shards(dbcr, staged_tags, shard_tags, stats,
+                                     add_strict=add_strict, attempt_replace=attempt_replace)
+            if delete_added_entries and not delete_shards:
+                _del_staged_shards(dbcr, stats)
+        finally:
+            dbcn.close()
+        for shard_stats in stats.values():
+            del shard_stats['rowids'], shard_stats['n_staged']
+        return stats
 
+    stats = retry_if_locked(_merge_db, main_db_file, db_timeout=db_timeout,
+                            db_attempts=db_attempts, action='writing to')
+    if delete_shards:
+        for shard_file in shard_db_files:
+            rm_db_file(shard_file)
+    return stats
 
-def open_or_create_db_file(db_file, img_info, restart_db=False, timeout=DEFAULT_DB_TIMEOUT):
+
+# the names of the attached shard database, and the table it is copied to,
+# in merge_many_db_files:
+_SHARD_SCHEMA = 'imt_shard'
+_SHARD_STAGING_TABLE = 'imt_staging'
+
+
+def _stage_shards(dbcr, shard_db_files, stats):
+    '''
+    Copies the shards into a temporary table, for an open database cursor (dbcr),
+    one after the other, with their tags decoded if need be. The range of rowids
+    of each in the temporary table are added to the stats, as well as the
+    number of images and read time.
+
+    Returns an OrderedDict of the tag names (in the order they are first found)
+    to the names of their columns in the temporary table, and a list of the
+    tag names in each shard.
+    '''
+    staged_tags = collections.OrderedDict()
+    shard_tags = []
+    dbcr.execute('DROP TABLE IF EXISTS temp.{}'.format(_SHARD_STAGING_TABLE))
+    dbcr.execute('CREATE TEMP TABLE {}({} TEXT)'.format(_SHARD_STAGING_TABLE,
+                                                        SQLITE_IMG_INFO_FNAME))
+    for shard_file in shard_db_files:
+        time_start = time.time()
+        dbcr.execute('ATTACH DATABASE ? AS {}'.format(_SHARD_SCHEMA), (shard_file,))
+        try:
+            table_info = dbcr.execute('PRAGMA {}.table_info({})'.format(_SHARD_SCHEMA,
+                                                                          SQLITE_IMG_INFO_TABLE))
+            field_names = [db_name_to_info_key(x[1]) for x in table_info.fetchall()]
+            tag_names = field_names[1:]
+            encoded = dbcr.execute(("SELECT name FROM {}.sqlite_master "
+                                    "WHERE type='table' AND name=?").format(_SHARD_SCHEMA),
+                                   (SQLITE_TAG_VALUES_TABLE,)).fetchone() is not None
+            for tag_name in tag_names:
+                if tag_name not in staged_tags:
+                    staged_tags[tag_name] = 'tag{}'.format(len(staged_tags))
+                    dbcr.execute('ALTER TABLE temp.{} ADD COLUMN {}'.format(
+                        _SHARD_STAGING_TABLE, staged_tags[tag_name]))
+            first_rowid = dbcr.execute('SELECT IFNULL(MAX(rowid), 0) + 1 FROM temp.{}'.format(
+                _SHARD_STAGING_TABLE)).fetchone()[0]
+            if field_names:
+                if encoded:
+                    # (the image's column is qualified, in case its tag has the
+                    # same name as a column of the tag values table):
+                    values = '(SELECT value FROM {0}.{1} WHERE code={0}.{2}."{{0}}")'.format(
+                        _SHARD_SCHEMA, SQLITE_TAG_VALUES_TABLE, SQLITE_IMG_INFO_TABLE)
+                else:
+                    values = '"{0}"'
+                shard_cols = [values.format(info_key_to_db_name(x)) for x in tag_names]
+                stage_command = 'INSERT INTO temp.{}({}) SELECT {} FROM {}.{}'.format(
+                    _SHARD_STAGING_TABLE,
+                    ', '.join([SQLITE_IMG_INFO_FNAME] + [staged_tags[x] for x in tag_names]),
+                    ', '.join([SQLITE_IMG_INFO_FNAME] + shard_cols),
+                    _SHARD_SCHEMA, SQLITE_IMG_INFO_TABLE)
+                dbcr.execute(stage_command)
+                n_rows = dbcr.rowcount
+            else:
+                n_rows = 0
+            # this only writes to the temporary table, so does not lock the main database:
+            dbcr.connection.commit()
+        except:
+            # (the shard cannot be detached during a transaction)
+            dbcr.connection.rollback()
+            _detach_after_error(dbcr, _SHARD_SCHEMA, shard_file)
+            raise
+        dbcr.execute('DETACH DATABASE {}'.format(_SHARD_SCHEMA))
+        shard_tags.append(tag_names)
+        stats[shard_file] = {'n_staged': n_rows,
+                             'n_rows': 0,
+                             'read_time': time.time() - time_start,
+                             'write_time': 0.0,
+                             'rowids': (first_rowid, first_rowid + n_rows - 1)}
+    return staged_tags, shard_tags
+
+
+def _detach_after_error(dbcr, schema_name, db_file):
+    '''
+    Detaches the database schema_name, attached from db_file, while an error
+    is being handled, printing a warning rather than raising a new error if
+    that fails, so the original error is not lost.
+    '''
+    try:
+        dbcr.execute('DETACH DATABASE {}'.format(schema_name))
+    except sqlite3.Error as detach_err:
+        msg = 'WARNING: unable to detach database file {} ({})'
+        print(msg.format(db_file, detach_err))
+
+
+def _write_staged_shards(dbcr, staged_tags, shard_tags, stats,
+                         add_strict=False, attempt_replace=False):
+    '''
+    Writes the shards, copied into the temporary table by
+    :func:`ImageMetaTag.db._stage_shards`, into the ImageMetaTag table of an
+    open database cursor (dbcr), in one transaction.
+    '''
+    dbcr.execute('BEGIN IMMEDIATE')
+    try:
+        invalidate_schema_cache(dbcr)
+        schema = get_table_schema(dbcr)
+        if not schema['fields']:
+            create_table_for_img_info(dbcr, dict([(x, '') for x in staged_tags]))
+            schema = get_table_schema(dbcr)
+        new_fields = [x for x in staged_tags if x not in schema['field_set']]
+        if new_fields:
+            schema = _add_new_fields(dbcr, schema, new_fields, add_strict=add_strict)
+
+        if schema['encoded']:
+            # add all the new tag values, then look up their codes as they are copied:
+            for tag_name, staged_col in staged_tags.items():
+                dbcr.execute(('INSERT OR IGNORE INTO main.{}(tag, value) '
+                              "SELECT DISTINCT ?, IFNULL({}, 'None') FROM temp.{}").format(
+                                  SQLITE_TAG_VALUES_TABLE, staged_col, _SHARD_STAGING_TABLE),
+                             (tag_name,))
+            values = ("(SELECT code FROM main.{} WHERE tag='{{0}}' "
+                      "AND value=IFNULL(temp.{}.{{1}}, 'None'))").format(SQLITE_TAG_VALUES_TABLE,
+                                                                      _SHARD_STAGING_TABLE)
+        else:
+            values = '{1}'
+
+        for shard_stats, tag_names in zip(stats.values(), shard_tags):
+            if not shard_stats['n_staged']:
+                continue
+            time_start = time.time()
+            db_names = ['"{}"'.format(info_key_to_db_name(x)) for x in tag_names]
+            staged_cols = [values.format(x.replace("'", "''"), staged_tags[x]) for x in tag_names]
+            if not attempt_replace or not db_names:
+                write_command = 'INSERT OR IGNORE INTO main.{0}({1}) SELECT {2} FROM temp.{3}'
+            elif SQLITE_HAS_UPSERT:
+                write_command = 'INSERT INTO main.{0}({1}) SELECT {2} FROM temp.{3}'
+            else:
+                write_command = 'INSERT OR REPLACE INTO main.{0}({1}) SELECT {2} FROM temp.{3}'
+            write_command += ' WHERE rowid BETWEEN ? AND ?'
+            if attempt_replace and db_names and SQLITE_HAS_UPSERT:
+                write_command += ' ON CONFLICT({4}) DO UPDATE SET {5}'
+            updates = ', '.join(['{0}=excluded.{0}'.format(x) for x in db_names])
+            write_command = write_command.format(
+                SQLITE_IMG_INFO_TABLE, ', '.join([SQLITE_IMG_INFO_FNAME] + db_names),
+                ', '.join([SQLITE_IMG_INFO_FNAME] + staged_cols), _SHARD_STAGING_TABLE,
+                SQLITE_IMG_INFO_FNAME, updates)
+            dbcr.execute(write_command, shard_stats['rowids'])
+            # (images that were already there, and not replaced, are not counted):
+            shard_stats['n_rows'] = dbcr.rowcount
+            shard_stats['write_time'] = time.time() - time_start
+        dbcr.connection.commit()
+    except:
+        dbcr.connection.rollback()
+        raise
+
+
+def _del_staged_shards(dbcr, stats):
+    '''
+    Deletes the images that were merged by :func:`ImageMetaTag.db.merge_many_db_files`
+    from each of the shards, using the temporary table they were copied to.
+    '''
+    del_command = ('DELETE FROM {0}.{1} WHERE {2} IN '
+                   '(SELECT {2} FROM temp.{3} WHERE rowid BETWEEN ? AND ?)')
+    del_command = del_command.format(_SHARD_SCHEMA, SQLITE_IMG_INFO_TABLE,
+                                     SQLITE_IMG_INFO_FNAME, _SHARD_STAGING_TABLE)
+    for shard_file, shard_stats in stats.items():
+        if not shard_stats['n_staged']:
+            continue
+        dbcr.execute('ATTACH DATABASE ? AS {}'.format(_SHARD_SCHEMA), (shard_file,))
+        try:
+            dbcr.execute(del_command, shard_stats['rowids'])
+            dbcr.connection.commit()
+        finally:
+            dbcr.execute('DETACH DATABASE {}'.format(_SHARD_SCHEMA))
+
+
+def open_or_create_db_file(db_file, img_info, restart_db=False, timeout=DEFAULT_DB_TIMEOUT,
+                           encode_tags=False):
     '''
     Opens a database file and sets up initial tables, then returns the connection and cursor.
 
@@ -240,18 +1117,21 @@ def open_or_create_db_file(db_file, img_info, restart_db=False, timeout=DEFAULT_
     Options:
      * restart_db - when Truem this deletes the current db file and starts again, \
                    if it already exists.
+     * encode_tags - if the table needs to be created, then create it with \
+                     encoded tags (see \
+                     :func:`ImageMetaTag.db.create_table_for_img_info`).
 
     Returns an open database connection (dbcn) and cursor (dbcr)
     '''
 
     if not os.path.isfile(db_file) or restart_db:
         if os.path.isfile(db_file):
-            os.remove(db_file)
+            rm_db_file(db_file)
         # create a new database file:
-        dbcn = sqlite3.connect(db_file)
+        dbcn = connect_db(db_file, timeout=timeout)
         dbcr = dbcn.cursor()
         # and create the table:
-        create_table_for_img_info(dbcr, img_info)
+        create_table_for_img_info(dbcr, img_info, encode_tags=encode_tags)
     else:
         # open the database file:
         dbcn, dbcr = open_db_file(db_file, timeout=timeout)
@@ -259,17 +1139,156 @@ def open_or_create_db_file(db_file, img_info, restart_db=False, timeout=DEFAULT_
         table_names = list_tables(dbcr)
         if SQLITE_IMG_INFO_TABLE not in table_names:
             # create it if required:
-            create_table_for_img_info(dbcr, img_info)
+            create_table_for_img_info(dbcr, img_info, encode_tags=encode_tags)
     return dbcn, dbcr
 
 
-def create_table_for_img_info(dbcr, img_info):
-    'Creates a database table, in a database cursor, to store for the input img_info'
+def enable_change_log(db_file, timeout=DEFAULT_DB_TIMEOUT):
+    '''
+    Enables a change log in a database file, so that the images that have
+    been added, updated or removed can be read with
+    :func:`ImageMetaTag.db.changes_since`, rather than re-reading the whole
+    database to find out what has changed.
+
+    The change log is kept by triggers on the ImageMetaTag table, so every
+    change is logged, however it is made, but writing to the database is a
+    bit slower. It is kept in three tables: a sequence number, which goes up
+    with each change, the sequence number of the last change to each image,
+    and tombstones (with their sequence number) for the images that have been
+    deleted.
+    '''
+    dbcn, dbcr = open_db_file(db_file, timeout=timeout)
+    try:
+        if not get_table_schema(dbcr)['fields']:
+            msg = 'Database file {} has no {} table, so cannot have a change log'
+            raise ValueError(msg.format(db_file, SQLITE_IMG_INFO_TABLE))
+        dbcr.execute('BEGIN IMMEDIATE')
+        if SQLITE_CHANGE_SEQ_TABLE not in list_tables(dbcr):
+            dbcr.execute(('CREATE TABLE {}(id INTEGER PRIMARY KEY CHECK (id = 0), '
+                          'seq INTEGER NOT NULL)').format(SQLITE_CHANGE_SEQ_TABLE))
+            dbcr.execute('INSERT INTO {} VALUES(0, 0)'.format(SQLITE_CHANGE_SEQ_TABLE))
+            dbcr.execute(('CREATE TABLE {}({} TEXT PRIMARY KEY, seq INTEGER NOT NULL, '
+                          'created INTEGER NOT NULL)').format(SQLITE_CHANGES_TABLE,
+                                                              SQLITE_IMG_INFO_FNAME))
+            dbcr.execute('CREATE INDEX {0}_seq ON {0}(seq)'.format(SQLITE_CHANGES_TABLE))
+            dbcr.execute('CREATE TABLE {}({} TEXT PRIMARY KEY, seq INTEGER NOT NULL)'.format(
+                SQLITE_TOMBSTONES_TABLE, SQLITE_IMG_INFO_FNAME))
+            dbcr.execute('CREATE INDEX {0}_seq ON {0}(seq)'.format(SQLITE_TOMBSTONES_TABLE))
+            # the images already in the database are logged as being there from the start:
+            dbcr.execute('INSERT INTO {0}({1}, seq, created) SELECT {1}, 0, 0 FROM {2}'.format(
+                SQLITE_CHANGES_TABLE, SQLITE_IMG_INFO_FNAME, SQLITE_IMG_INFO_TABLE))
+        for trigger_sql in _change_log_triggers():
+            dbcr.execute(trigger_sql)
+        dbcn.commit()
+    finally:
+        dbcn.close()
+
+
+def _change_log_triggers():
+    '''
+    Returns the commands to create the triggers that keep the change log,
+    see :func:`ImageMetaTag.db.enable_change_log`
+    '''
+    next_seq = 'UPDATE {0} SET seq = seq + 1;'.format(SQLITE_CHANGE_SEQ_TABLE)
+    this_seq = '(SELECT seq FROM {0})'.format(SQLITE_CHANGE_SEQ_TABLE)
+    # These cannot rely on conflict resolution (INSERT OR IGNORE etc.), as that
+    # is overridden by the statement that fires the trigger. An INSERT OR REPLACE
+    # of an existing image only fires the insert trigger, so that keeps the
+    # sequence number of when the image was created:
+    log_change = ('INSERT INTO {0}({1}, seq, created) SELECT NEW.{1}, {2}, {2} '
+                  'WHERE NOT EXISTS (SELECT 1 FROM {0} WHERE {1} = NEW.{1}); '
+                  'UPDATE {0} SET seq = {2} WHERE {1} = NEW.{1};')
+    log_change = log_change.format(SQLITE_CHANGES_TABLE, SQLITE_IMG_INFO_FNAME, this_seq)
+    log_delete = ('DELETE FROM {0} WHERE {1} = OLD.{1}; '
+                  'DELETE FROM {2} WHERE {1} = OLD.{1}; '
+                  'INSERT INTO {2}({1}, seq) VALUES(OLD.{1}, {3});')
+    log_delete = log_delete.format(SQLITE_CHANGES_TABLE, SQLITE_IMG_INFO_FNAME,
+                                   SQLITE_TOMBSTONES_TABLE, this_seq)
+    unbury = 'DELETE FROM {0} WHERE {1} = NEW.{1};'.format(SQLITE_TOMBSTONES_TABLE,
+                                                          SQLITE_IMG_INFO_FNAME)
+    trigger = 'CREATE TRIGGER IF NOT EXISTS imt_log_{0} AFTER {1} ON {2} BEGIN {3} END'
+    return [trigger.format('insert', 'INSERT', SQLITE_IMG_INFO_TABLE,
+                           next_seq + ' ' + unbury + ' ' + log_change),
+            trigger.format('update', 'UPDATE', SQLITE_IMG_INFO_TABLE,
+                           next_seq + ' ' + log_change),
+            trigger.format('delete', 'DELETE', SQLITE_IMG_INFO_TABLE,
+                           next_seq + ' ' + log_delete)]
+
+
+def changes_since(db_file, token=0, required_tags=None, tag_strings=None,
+                  db_timeout=DEFAULT_DB_TIMEOUT, db_attempts=DEFAULT_DB_ATTEMPTS):
+    '''
+    Reads the changes to a database file, with a change log (see
+    :func:`ImageMetaTag.db.enable_change_log`), since the token from a
+    previous call. A token of 0 returns all the images added since the
+    change log was enabled.
+
+    Options:
+     * required_tags - as :func:`ImageMetaTag.db.read`
+     * tag_strings - as :func:`ImageMetaTag.db.read`
+
+    Returns:
+     * a dictionary, by filename, of the image metadata of the images added
+     * a dictionary, by filename, of the image metadata of the images updated
+     * a list of the filenames of the images removed
+     * the token to use for the next call
+    '''
+    def _read_changes():
+        'opens the database and reads the changes, for retry_if_locked'
+        dbcn, dbcr = open_db_file(db_file, timeout=db_timeout, read_only=True)
+        try:
+            if SQLITE_CHANGE_SEQ_TABLE not in list_tables(dbcr):
+                raise ValueError('Database file {} does not have a change log'.format(db_file))
+            # read everything from the same snapshot of the database:
+            dbcr.execute('BEGIN')
+            new_token = dbcr.execute('SELECT seq FROM {}'.format(
+                SQLITE_CHANGE_SEQ_TABLE)).fetchone()[0]
+            if token > new_token:
+                msg = 'Token {} is newer than the change log of database file {}'
+                raise ValueError(msg.format(token, db_file))
+            changed_cmd = ('SELECT {0}.* FROM {0} JOIN {1} ON {0}.{2} = {1}.{2} '
+                           'WHERE {1}.seq > ? AND {1}.created {{}} ?')
+            changed_cmd = changed_cmd.format(SQLITE_IMG_INFO_TABLE, SQLITE_CHANGES_TABLE,
+                                             SQLITE_IMG_INFO_FNAME)
+            changed = []
+            for created_test in ['>', '<=']:
+                db_contents = dbcr.execute(changed_cmd.format(created_test),
+                                           (token, token)).fetchall()
+                changed.append(process_select_star_from(db_contents, dbcr,
+                                                        required_tags=required_tags,
+                                                        tag_strings=tag_strings)[1])
+            removed = dbcr.execute('SELECT {} FROM {} WHERE seq > ?'.format(
+                SQLITE_IMG_INFO_FNAME, SQLITE_TOMBSTONES_TABLE), (token,)).fetchall()
+            dbcn.rollback()
+        finally:
+            dbcn.close()
+        return changed[0], changed[1], [x[0] for x in removed], new_token
+
+    return retry_if_locked(_read_changes, db_file, db_timeout=db_timeout,
+                           db_attempts=db_attempts, action='reading from')
+
+
+def create_table_for_img_info(dbcr, img_info, encode_tags=False):
+    '''
+    Creates a database table, in a database cursor, to store for the input img_info
+
+    If encode_tags is True, then the tag columns hold integer codes rather than the tag
+    values themselves. Each unique tag value is stored once, in a separate table of
+    values, which can make the database file much smaller and faster to read when there
+    are many images but few different values of each tag. Reading and writing the
+    database is the same either way, as the values are encoded/decoded by this module.
+    '''
+    invalidate_schema_cache(dbcr)
+    if encode_tags:
+        dbcr.execute(('CREATE TABLE IF NOT EXISTS {}(code INTEGER PRIMARY KEY, '
+                      'tag TEXT NOT NULL, value TEXT NOT NULL, '
+                      'UNIQUE(tag, value))').format(SQLITE_TAG_VALUES_TABLE))
 
     create_command = 'CREATE TABLE {}({} TEXT PRIMARY KEY,'.format(SQLITE_IMG_INFO_TABLE,
                                                                    SQLITE_IMG_INFO_FNAME)
     for key in list(img_info.keys()):
-        create_command += ' "{}" TEXT,'.format(info_key_to_db_name(key))
+        create_command += ' "{}" {},'.format(info_key_to_db_name(key),
+                                            _tag_col_type(dbcr, key, encode_tags))
     create_command = create_command[0:-1] + ')'
     # Can make a rare race condition if multiple processes try to create the file at the same time;
     # If that happens, the error is:
@@ -290,46 +1309,431 @@ def create_table_for_img_info(dbcr, img_info):
         raise sqlite3.Error(sq_err)
 
 
-def open_db_file(db_file, timeout=DEFAULT_DB_TIMEOUT):
+def _tag_col_type(dbcr, key, encode_tags):
+    '''
+    The type, and default, of a tag column in the ImageMetaTag table.
+    Images without the tag have a value of 'None'.
+    '''
+    if encode_tags:
+        return 'INTEGER DEFAULT {:d}'.format(_tag_value_code(dbcr, key, 'None'))
+    return "TEXT DEFAULT 'None'"
+
+
+def _tag_value_code(dbcr, tag, value, add=True):
+    '''
+    Looks up the code for a tag value in the table of tag values, adding it if
+    it is new (and add is True). Returns None if it is not present.
+    '''
+    sel_command = 'SELECT code FROM {} WHERE tag=? AND value=?'.format(SQLITE_TAG_VALUES_TABLE)
+    result = dbcr.connection.execute(sel_command, (tag, value)).fetchone()
+    if result is None and add:
+        add_command = 'INSERT OR IGNORE INTO {}(tag, value) VALUES(?, ?)'
+        dbcr.connection.execute(add_command.format(SQLITE_TAG_VALUES_TABLE), (tag, value))
+        result = dbcr.connection.execute(sel_command, (tag, value)).fetchone()
+    if result is None:
+        return None
+    return result[0]
+
+
+def encode_tag_value(dbcr, schema, tag, value, add=True):
+    '''
+    Returns the code used for a tag value, in a database with encoded tags,
+    for an open database cursor (dbcr) and its schema (from
+    :func:`ImageMetaTag.db.get_table_schema`). New values are added to the
+    table of values, unless add is False, when None is returned.
+
+    Codes are cached in the schema. As new codes are not saved until the
+    transaction is committed, a connection whose transaction is rolled back
+    should not be used again.
+    '''
+    tag_codes = schema['encoder'].setdefault(tag, {})
+    str_val = str(value)
+    code = tag_codes.get(str_val)
+    if code is None:
+        code = _tag_value_code(dbcr, tag, str_val, add=add)
+        if code is not None:
+            tag_codes[str_val] = code
+    return code
+
+
+def _encode_rows(dbcr, schema, tag_names, rows):
+    'Encodes the tag values of rows ([filename] + values of tag_names) in place'
+    for row in rows:
+        for i_tag, tag_name in enumerate(tag_names):
+            row[i_tag + 1] = encode_tag_value(dbcr, schema, tag_name, row[i_tag + 1])
+
+
+def _encode_select_tags(dbcr, schema, select_tags):
+    '''
+    Converts a dict of tag names & acceptable values to the equivalent codes,
+    for a database with encoded tags. Values that are not in the database
+    cannot match anything, so are given a code of -1.
+    '''
+    def _code(tag_name, tag_val):
+        code = encode_tag_value(dbcr, schema, tag_name, tag_val, add=False)
+        return -1 if code is None else code
+
+    encoded_tags = {}
+    for tag_name, tag_val in select_tags.items():
+        if isinstance(tag_val, (list, tuple)):
+            encoded_tags[tag_name] = [_code(tag_name, x) for x in tag_val]
+        else:
+            encoded_tags[tag_name] = _code(tag_name, tag_val)
+    return encoded_tags
+
+
+def tag_value_decoder(dbcr, schema, tag_codes=False):
+    '''
+    Returns a function to convert a value, as read from the ImageMetaTag
+    table, into the tag value (as a string) for an open database cursor (dbcr)
+    and its schema (from :func:`ImageMetaTag.db.get_table_schema`).
+
+    For a database with encoded tags, this decodes the values. If tag_codes is
+    True the codes themselves are returned, without decoding.
+    '''
+    if not schema['encoded']:
+        if tag_codes:
+            raise ValueError('tag_codes are only available for databases with encoded tags')
+        return str
+    if tag_codes:
+        return lambda code: code
+
+    sel_command = 'SELECT code, value FROM {}'.format(SQLITE_TAG_VALUES_TABLE)
+    if schema['decoder'] is None:
+        schema['decoder'] = dict(dbcr.connection.execute(sel_command).fetchall())
+    decoder = schema['decoder']
+
+    def decode(code):
+        'decodes a tag value, reloading the codes if it is not known'
+        try:
+            return decoder[code]
+        except KeyError:
+            if code is None:
+                return 'None'
+            # it could have been added by another connection:
+            decoder.update(dbcr.connection.execute(sel_command).fetchall())
+            if code not in decoder:
+                msg = 'Tag value code {} not found in table {}'
+                raise ValueError(msg.format(code, SQLITE_TAG_VALUES_TABLE))
+            return decoder[code]
+    return decode
+
+
+def read_tag_values(db_file, timeout=DEFAULT_DB_TIMEOUT):
+    '''
+    For a database file with encoded tags, returns a dictionary of the tag
+    values, by their codes, as {code: (tag name, value)}. This can be used
+    to interpret what is returned by :func:`ImageMetaTag.db.read` with
+    tag_codes=True.
+    '''
+    dbcn, dbcr = open_db_file(db_file, timeout=timeout, read_only=True)
+    try:
+        if not get_table_schema(dbcr)['encoded']:
+            raise ValueError('Database file {} does not have encoded tags'.format(db_file))
+        sel_command = 'SELECT code, tag, value FROM {}'.format(SQLITE_TAG_VALUES_TABLE)
+        tag_values = dict([(x[0], (x[1], x[2])) for x in dbcr.execute(sel_command)])
+    finally:
+        dbcn.close()
+    return tag_values
+
+
+def open_db_file(db_file, timeout=DEFAULT_DB_TIMEOUT, read_only=False, immutable=False):
     '''
     Just opens an existing db_file, using timeouts but no retries.
 
+    The connection is made by :func:`ImageMetaTag.db.connect_db`.
+
+    Options:
+     * read_only - open the database file read-only. Readers do not need to \
+                   write to the database, so this avoids taking any locks that \
+                   are not needed.
+     * immutable - as well as read_only, tell sqlite that the file will not \
+                   change, so it is read without any locking at all. Only use \
+                   this for files that nothing writes to, such as snapshots \
+                   from :func:`ImageMetaTag.db.publish_snapshot`.
+
     Returns an open database connection (dbcn) and cursor (dbcr)
     '''
 
-    dbcn = sqlite3.connect(db_file, timeout=timeout)
+    dbcn = connect_db(db_file, timeout=timeout, read_only=read_only, immutable=immutable)
     dbcr = dbcn.cursor()
 
     return dbcn, dbcr
 
 
-def read_db_file_to_mem(db_file, timeout=DEFAULT_DB_TIMEOUT):
+def connect_db(db_file, timeout=DEFAULT_DB_TIMEOUT,
+               journal_mode=DEFAULT_DB_JOURNAL_MODE,
+               synchronous=DEFAULT_DB_SYNCHRONOUS,
+               mmap_size=DEFAULT_DB_MMAP_SIZE,
+               cache_size=DEFAULT_DB_CACHE_SIZE,
+               auto_vacuum=DEFAULT_DB_AUTO_VACUUM,
+               read_only=False, immutable=False):
+    '''
+    The connection factory for all ImageMetaTag database connections.
+
+    As well as the busy timeout, this sets up the connection so that large
+    numbers of parallel readers and writers can share a database file:
+
+    * journal_mode - the sqlite journal mode. The default, 'WAL', means that \
+                     readers never block writers (and vice versa). This is \
+                     stored in the database file, so only needs setting once. \
+                     None leaves the journal mode unchanged.
+    * synchronous - the sqlite synchronous setting. 'NORMAL' is safe with WAL \
+                    journaling, and avoids an fsync on every commit.
+    * mmap_size - the maximum number of bytes of the database file to access \
+                  using memory mapped I/O. 0 disables it.
+    * cache_size - the size of the page cache, in pages, or in KiB if negative.
+    * auto_vacuum - the sqlite auto_vacuum setting for new database files. \
+                    The default, 'INCREMENTAL', means that free space can be \
+                    reclaimed with :func:`ImageMetaTag.db.compact`. This can only \
+                    be set before anything is written to the file, so is ignored \
+                    for existing files (see \
+                    :func:`ImageMetaTag.db.enable_incremental_vacuum`).
+    * read_only - if True, the database file is opened read-only (with a \
+                  mode=ro URI and query_only), and the journal_mode and \
+                  synchronous settings are not changed.
+    * immutable - if True, the database file is opened read-only, and sqlite \
+                  is told that it will not change, so does no locking.
+
+    In python2, which cannot open a URI, read_only and immutable connections
+    use query_only alone, so they still take the usual read locks.
+
+    The defaults are set in ImageMetaTag (DEFAULT_DB_JOURNAL_MODE etc.) and
+    any of these can be set to None to use the sqlite default.
+
+    Returns an open database connection (dbcn)
+    '''
+    if read_only or immutable:
+        if SQLITE_HAS_URI:
+            db_uri = 'file:{}?mode=ro'.format(pathname2url(os.path.abspath(db_file)))
+            if immutable:
+                db_uri += '&immutable=1'
+            dbcn = sqlite3.connect(db_uri, timeout=timeout, factory=ImtConnection, uri=True)
+        else:
+            # python2 cannot open a URI, so open the file as usual, with
+            # query_only to stop anything being written (but with locking):
+            dbcn = sqlite3.connect(db_file, timeout=timeout, factory=ImtConnection)
+        dbcn.execute('PRAGMA query_only = ON')
+        journal_mode = synchronous = auto_vacuum = None
+    else:
+        dbcn = sqlite3.connect(db_file, timeout=timeout, factory=ImtConnection)
+    dbcn.execute('PRAGMA busy_timeout = {:d}'.format(int(timeout * 1000)))
+    if auto_vacuum is not None and dbcn.execute('PRAGMA page_count').fetchone()[0] == 0:
+        # this is a new file, and this needs to be set before the journal mode:
+        dbcn.execute('PRAGMA auto_vacuum = {}'.format(auto_vacuum))
+    if journal_mode is not None and db_file != ':memory:':
+        dbcn.execute('PRAGMA journal_mode = {}'.format(journal_mode))
+    if synchronous is not None:
+        dbcn.execute('PRAGMA synchronous = {}'.format(synchronous))
+    if mmap_size is not None:
+        dbcn.execute('PRAGMA mmap_size = {:d}'.format(mmap_size))
+    if cache_size is not None:
+        dbcn.execute('PRAGMA cache_size = {:d}'.format(cache_size))
+    return dbcn
+
+
+class ImtConnection(sqlite3.Connection):
+    '''
+    The sqlite3.Connection made by :func:`ImageMetaTag.db.connect_db`.
+
+    This is a standard connection, which also holds a cache of the
+    img_info table columns and INSERT commands (see
+    :func:`ImageMetaTag.db.get_table_schema`) so they do not need to be
+    worked out for every image written.
+    '''
+    def __init__(self, *args, **kwargs):
+        super(ImtConnection, self).__init__(*args, **kwargs)
+        self.imt_schema = None
+
+
+def get_table_schema(dbcr):
+    '''
+    Returns the schema of the ImageMetaTag table, for an open database
+    cursor (dbcr), as a dict containing:
+
+     * fields - the list of field names, as img_info keys, starting with \
+                the filename field.
+     * field_set - a set of the field names, for fast lookups.
+     * commands - a dict of INSERT commands, that have already been built, \
+                  keyed by the tuple of tag names and the type of insert.
+     * encoded - True if the database has encoded tags.
+     * encoder/decoder - caches of the codes of encoded tags.
+
+    When the connection was made by :func:`ImageMetaTag.db.connect_db` this
+    is cached on the connection, until the table is changed by this module
+    (see :func:`ImageMetaTag.db.invalidate_schema_cache`). The fields will be
+    empty if the table does not exist.
+    '''
+    schema = getattr(dbcr.connection, 'imt_schema', None)
+    if schema is None:
+        # use a new cursor, so this does not change what is in dbcr:
+        dbcn = dbcr.connection
+        table_info = dbcn.execute('PRAGMA main.table_info({})'.format(SQLITE_IMG_INFO_TABLE))
+        field_names = [db_name_to_info_key(x[1]) for x in table_info.fetchall()]
+        values_table = dbcn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?",
+                                    (SQLITE_TAG_VALUES_TABLE,)).fetchone()
+        schema = {'fields': field_names,
+                  'field_set': set(field_names),
+                  'commands': {},
+                  'encoded': values_table is not None,
+                  'encoder': {},
+                  'decoder': None}
+        if field_names and hasattr(dbcr.connection, 'imt_schema'):
+            dbcr.connection.imt_schema = schema
+    return schema
+
+
+def invalidate_schema_cache(dbcr):
+    '''
+    Clears the cached schema of the ImageMetaTag table, for an open database
+    cursor (dbcr). This needs to be called whenever the table is created or
+    changed.
+    '''
+    if hasattr(dbcr.connection, 'imt_schema'):
+        dbcr.connection.imt_schema = None
+
+
+def insert_command(schema, tag_names, insert_cmd='INSERT', upsert=False):
+    '''
+    Returns the command to add a row to the ImageMetaTag table, for a
+    tuple of tag_names, using the INSERT command insert_cmd (which can be
+    'INSERT OR REPLACE' etc.). Commands are cached in the table schema, from
+    :func:`ImageMetaTag.db.get_table_schema`.
+
+    If upsert is True, then an image that is already in the table has the
+    tag_names updated, using ON CONFLICT(fname) DO UPDATE, leaving its
+    other tags as they were.
+    '''
+    cmd_key = (tag_names, insert_cmd, upsert)
+    try:
+        return schema['commands'][cmd_key]
+    except KeyError:
+        db_names = ['"{}"'.format(info_key_to_db_name(x)) for x in tag_names]
+        add_command = '{} INTO {}({}, {}) VALUES({})'
+        add_command = add_command.format(
+            insert_cmd, SQLITE_IMG_INFO_TABLE, SQLITE_IMG_INFO_FNAME,
+            ', '.join(db_names), ','.join(['?'] * (len(tag_names) + 1)))
+        if upsert:
+            updates = ', '.join(['{0}=excluded.{0}'.format(x) for x in db_names])
+            add_command += ' ON CONFLICT({}) DO UPDATE SET {}'.format(
+                SQLITE_IMG_INFO_FNAME, updates)
+        schema['commands'][cmd_key] = add_command
+        return add_command
+
+
+def _update_command(schema, tag_names):
+    '''
+    Returns the command to update the tag_names of an image in the ImageMetaTag
+    table, taking the same values as :func:`ImageMetaTag.db.insert_command`
+    (the filename, then the values of tag_names). Commands are cached in the
+    table schema.
+    '''
+    cmd_key = (tag_names, 'UPDATE')
+    try:
+        return schema['commands'][cmd_key]
+    except KeyError:
+        updates = ['"{}"=?{}'.format(info_key_to_db_name(x), i_tag + 2)
+                   for i_tag, x in enumerate(tag_names)]
+        upd_command = 'UPDATE {} SET {} WHERE {}=?1'.format(
+            SQLITE_IMG_INFO_TABLE, ', '.join(updates), SQLITE_IMG_INFO_FNAME)
+        schema['commands'][cmd_key] = upd_command
+        return upd_command
+
+
+def _replace_rows(dbcr, schema, tag_names, rows):
+    '''
+    Adds rows ([filename] + values of tag_names) to the ImageMetaTag table,
+    for attempt_replace. Images that are already present have the tag_names
+    updated, and keep the values of their other tags.
+    '''
+    if not tag_names:
+        # (nothing to update)
+        dbcr.executemany(insert_command(schema, tag_names, insert_cmd='INSERT OR IGNORE'), rows)
+    elif SQLITE_HAS_UPSERT:
+        dbcr.executemany(insert_command(schema, tag_names, upsert=True), rows)
+    else:
+        # without UPSERT, update the images that are present, then add the rest:
+        dbcr.executemany(_update_command(schema, tag_names), rows)
+        dbcr.executemany(insert_command(schema, tag_names, insert_cmd='INSERT OR IGNORE'), rows)
+
+
+def retry_if_locked(db_op, db_file, db_timeout=DEFAULT_DB_TIMEOUT,
+                    db_attempts=DEFAULT_DB_ATTEMPTS, action='writing to'):
+    '''
+    Calls db_op(), which should open, use and close a database connection,
+    and returns what it returns. If the database is locked, then db_op is
+    retried, up to db_attempts times. Any other sqlite3.OperationalError is
+    raised immediately.
+
+    Arguments:
+     * db_op - the function to call, with no arguments.
+     * db_file - the database file being used, for messages.
+
+    Options:
+     * db_timeout - the database timeout, used for messages.
+     * db_attempts - the number of attempts before raising the error.
+     * action - a description of what is being done, for messages.
+    '''
+    n_tries = 1
+    while True:
+        try:
+            return db_op()
+        except sqlite3.OperationalError as op_err:
+            if 'database is locked' in repr(op_err) and n_tries < db_attempts:
+                # database being locked is what the retries and timeouts are for:
+                print('%s database timeout %s file "%s", %s s' \
+                        % (dt_now_str(), action, db_file, n_tries * db_timeout))
+                n_tries += 1
+            else:
+                # everything else needs to be reported and raised immediately,
+                # as does a lock when we have gone through all the attempts:
+                msg = '{} for file {}'.format(op_err, db_file)
+                raise sqlite3.OperationalError(msg)
+
+
+def read_db_file_to_mem(db_file, timeout=DEFAULT_DB_TIMEOUT, use_mmap=False):
     '''
     Opens a pre-existing database file into a copy held in memory. This can be accessed much
     faster when doing extenstive work (a lot of select operations, for instance).
 
-    There is a time cost in doing this; it takes a few seconds to read in a large database,
-    so it is only worth doing when doing a lot of operations.
+    The copy is made page by page, using the sqlite backup API, which is quick
+    (well under a second for 250k rows) and does not need any more memory than
+    the copy itself. Older versions of python, without the backup API, have to
+    rebuild the database from a dump of its contents, which takes a few seconds
+    for a large database.
 
-    Tests on selects on a large-ish database (250k rows) suggested it was worth doing
-    for > 100 selects.
+    Options:
+     * use_mmap - if True, the database file is not copied. Instead, it is opened \
+                  read-only, with the whole file memory mapped, so its pages are \
+                  read directly from the operating system's file cache. This is \
+                  almost instant, and shares memory with other processes reading \
+                  the same file, but the connection cannot be written to and will \
+                  see changes made to the file by other processes.
 
     Returns an open database connection (dbcn) and cursor (dbcr)
     '''
+    if use_mmap:
+        # the memory map needs to cover the whole file:
+        mmap_size = max(DEFAULT_DB_MMAP_SIZE, os.path.getsize(db_file))
+        dbcn = connect_db(db_file, timeout=timeout, mmap_size=mmap_size, read_only=True)
+        return dbcn, dbcn.cursor()
 
-    # read the database into an in-memory file object:
-    #dbcn = sqlite3.connect(db_file)
-    dbcn, _ = open_db_file(db_file, timeout=timeout)
-    memfile = StringIO()
-    for line in dbcn.iterdump():
-        memfile.write(u'{}\n'.format(line))
-    dbcn.close()
-    memfile.seek(0)
-
-    # Create a database in memory and import from memfile
-    dbcn = sqlite3.connect(":memory:")
-    dbcn.cursor().executescript(memfile.read())
-    dbcn.commit()
+    file_cn = connect_db(db_file, timeout=timeout, read_only=True)
+    try:
+        dbcn = connect_db(":memory:")
+        if hasattr(file_cn, 'backup'):
+            file_cn.backup(dbcn)
+        else:
+            # no backup API, so read the database into an in-memory file object,
+            # and import from that:
+            memfile = StringIO()
+            for line in file_cn.iterdump():
+                memfile.write(u'{}\n'.format(line))
+            memfile.seek(0)
+            dbcn.cursor().executescript(memfile.read())
+            dbcn.commit()
+    finally:
+        file_cn.close()
     dbcr = dbcn.cursor()
 
     return dbcn, dbcr
@@ -344,76 +1748,322 @@ def write_img_to_open_db(dbcr, filename, img_info,
     * add_strict: if True then it will report a ValueError if you \
                   try and include fields that aren't defined in the table. \
                   If False, then adding a new metadata tag to the \
-                  database will cause it be rewritten with the new item \
-                  as a new column using \
-                  :func:`ImageMetaTag.db.recrete_table_new_cols` \
+                  database will add it as a new column using \
+                  :func:`ImageMetaTag.db.add_table_cols` \
                   All pre-existing images will have \
-                  the new tag set to 'None'. It is best to avoid using \
-                  this functionality as it can be slow for large \
-                  databases. Instead, all images should be ideally have \
-                  all expected metadata tags included from the start \
-                  but set to 'None' where they are not used.
-    * attempt_replace: if True, then it will attempt to replace a database \
-                  entry if the image is already present. \
+                  the new tag set to 'None'.
+    * attempt_replace: if True, then an image that is already present \
+                  has its tags updated to the values in img_info. Any \
+                  tags not in img_info keep their value (as an UPSERT). \
                   Otherwise it will ignore it.
     '''
 
-    # now add in the information:
-    # get the name of the fields from the cursor descripton:
-    _ = dbcr.execute('select * from %s' % SQLITE_IMG_INFO_TABLE).fetchone()
-    field_names = [r[0] for r in dbcr.description]
-    # convert these to keys:
-    field_names = [db_name_to_info_key(x) for x in field_names]
-    # now build the command
-    add_command = 'INSERT INTO {}({},'.format(SQLITE_IMG_INFO_TABLE,
-                                              SQLITE_IMG_INFO_FNAME)
-    add_list = [filename]
-    invalid_fieldnames = []
-
-    for key, item in img_info.items():
-        add_command += ' "{}",'.format(info_key_to_db_name(key))
-        add_list.append(item)
-        if key not in field_names:
-            # this is a problem that needs sorting:
-            invalid_fieldnames.append(key)
+    # get the name of the fields, as keys, from the (cached) table schema:
+    schema = get_table_schema(dbcr)
+    if not schema['fields']:
+        # the table does not exist yet, so create it:
+        create_table_for_img_info(dbcr, img_info)
+        schema = get_table_schema(dbcr)
 
+    tag_names = tuple(img_info.keys())
+    add_list = [filename] + [img_info[x] for x in tag_names]
+    invalid_fieldnames = [x for x in tag_names if x not in schema['field_set']]
     if invalid_fieldnames != []:
-        if add_strict:
-            msg = ('Attempting to add a line to the database that '
-                   'include fields not present in the database: {}')
-            raise ValueError(msg.format(invalid_fieldnames))
-        else:
-            # need to recreate the database table afresh, because if we
-            # don't then it won't be correctly labelled by column:
-            recrete_table_new_cols(dbcr, field_names, invalid_fieldnames)
+        schema = _add_new_fields(dbcr, schema, invalid_fieldnames,
+                                 add_strict=add_strict)
 
-    # add in the right number of ?
-    add_command = add_command[0:-1] + ') VALUES(' + '?,'*(len(add_list)-1) + '?)'
+    if schema['encoded']:
+        _encode_rows(dbcr, schema, tag_names, [add_list])
+
+    add_command = insert_command(schema, tag_names)
     try:
         dbcr.execute(add_command, add_list)
-    except sqlite3.OperationalError as op_err_file:
-        err_check = 'no such table: {}'.format(SQLITE_IMG_INFO_TABLE)
-        if err_check in repr(op_err_file):
-            create_table_for_img_info(dbcr, img_info)
-            dbcr.execute(add_command, add_list)
-        else:
-            raise op_err_file
     except sqlite3.IntegrityError:
         if attempt_replace:
-            # try an INSERT OR REPLACE
-            add_repl_command = add_command.replace('INSERT ',
-                                                   'INSERT OR REPLACE ')
+            # update the tags it has been given.
             # if this fails, want it to report it's error message as is,
             # so do, or do not, there is no 'try':
-            dbcr.execute(add_repl_command, add_list)
+            _replace_rows(dbcr, schema, tag_names, [add_list])
         else:
             # this file is already in the database
             # (as the primary key, so do nothing...)
             pass
-    except sqlite3.InterfaceError as intfc_error:
-        raise intfc_error
-    finally:
-        pass
+
+
+def _add_new_fields(dbcr, schema, new_fields, add_strict=False):
+    '''
+    Adds new_fields (as img_info keys) to the ImageMetaTag table, or raises
+    a ValueError if add_strict. The schema may be out of date, if another
+    connection has changed the table, so it is refreshed first.
+
+    Returns the new table schema.
+    '''
+    invalidate_schema_cache(dbcr)
+    schema = get_table_schema(dbcr)
+    new_fields = [x for x in new_fields if x not in schema['field_set']]
+    if new_fields != []:
+        if add_strict:
+            msg = ('Attempting to add a line to the database that '
+                   'include fields not present in the database: {}')
+            raise ValueError(msg.format(new_fields))
+        else:
+            add_table_cols(dbcr, schema['fields'], new_fields)
+            schema = get_table_schema(dbcr)
+    return schema
+
+
+def add_table_cols(dbcr, current_cols, new_cols):
+    '''
+    for a given database cursor (dbcr) this adds new columns (as img_info
+    keys) to the ImageMetaTag database table, with ALTER TABLE ADD COLUMN.
+    All pre-existing images will have the new tags set to 'None'.
+
+    This only changes the table definition, so is fast however large the
+    table is. If it fails, the table is rebuilt with the new columns
+    using :func:`ImageMetaTag.db.recrete_table_new_cols`.
+    '''
+    alter_command = 'ALTER TABLE {} ADD COLUMN "{}" {}'
+    encode_tags = get_table_schema(dbcr)['encoded']
+    invalidate_schema_cache(dbcr)
+    try:
+        for new_col in new_cols:
+            try:
+                dbcr.execute(alter_command.format(SQLITE_IMG_INFO_TABLE,
+                                                  info_key_to_db_name(new_col),
+                                                  _tag_col_type(dbcr, new_col, encode_tags)))
+            except sqlite3.OperationalError as op_err:
+                if 'duplicate column name' in repr(op_err):
+                    # another process has just added it, which is fine:
+                    pass
+                else:
+                    raise
+    except sqlite3.OperationalError as op_err:
+        if 'database is locked' in repr(op_err):
+            raise
+        msg = 'WARNING: unable to add columns to database table ({}), rebuilding it'
+        print(msg.format(op_err))
+        # rebuild with what is still missing:
+        schema = get_table_schema(dbcr)
+        new_cols = [x for x in new_cols if x not in schema['field_set']]
+        recrete_table_new_cols(dbcr, schema['fields'], new_cols)
+    invalidate_schema_cache(dbcr)
+
+
+def write_imgs_to_open_db(dbcr, img_rows, add_strict=False,
+                          attempt_replace=False):
+    '''
+    Adds many images to the open database cursor (dbcr) at once. This is much
+    faster than calling :func:`ImageMetaTag.db.write_img_to_open_db` for
+    each image, as it uses one executemany per set of tag names.
+
+    Arguments:
+     * img_rows - an iterable of (filename, img_info) pairs.
+
+    Options:
+     * add_strict - as :func:`ImageMetaTag.db.write_img_to_open_db`. \
+                    New tags, from all of the img_info dicts, are added to \
+                    the table in a single schema change.
+     * attempt_replace - if True, images that are already present have \
+                         their tags updated, as \
+                         :func:`ImageMetaTag.db.write_img_to_open_db`. \
+                         Otherwise they are ignored.
+
+    Returns the number of images processed.
+    '''
+    # group the rows by their tag names, so each group shares a command:
+    grouped_rows = collections.OrderedDict()
+    first_info = None
+    n_rows = 0
+    for filename, img_info in img_rows:
+        if first_info is None:
+            first_info = img_info
+        tag_names = tuple(img_info.keys())
+        row = [filename] + [img_info[x] for x in tag_names]
+        grouped_rows.setdefault(tag_names, []).append(row)
+        n_rows += 1
+    if n_rows == 0:
+        return 0
+
+    schema = get_table_schema(dbcr)
+    if not schema['fields']:
+        # the table does not exist yet, so create it:
+        create_table_for_img_info(dbcr, first_info)
+        schema = get_table_schema(dbcr)
+
+    invalid_fieldnames = []
+    for tag_names in grouped_rows:
+        for key in tag_names:
+            if key not in schema['field_set'] and key not in invalid_fieldnames:
+                invalid_fieldnames.append(key)
+    if invalid_fieldnames != []:
+        schema = _add_new_fields(dbcr, schema, invalid_fieldnames,
+                                 add_strict=add_strict)
+
+    for tag_names, rows in grouped_rows.items():
+        if schema['encoded']:
+            _encode_rows(dbcr, schema, tag_names, rows)
+        if attempt_replace:
+            _replace_rows(dbcr, schema, tag_names, rows)
+        else:
+            add_command = insert_command(schema, tag_names,
+                                         insert_cmd='INSERT OR IGNORE')
+            dbcr.executemany(add_command, rows)
+    return n_rows
+
+
+class BatchedDbWriter(object):
+    '''
+    A write-behind buffer for adding image metadata to a database file.
+
+    Rather than opening the database, inserting a single row and committing
+    for every image (as :func:`ImageMetaTag.db.write_img_to_dbfile` does),
+    the rows are held in memory and written in a single transaction, using
+    executemany, once max_rows have been added or max_seconds have passed
+    since the last flush. Any remaining rows are flushed on exit, so it is
+    best used as a context manager (if the with statement is left by an
+    exception, the rows are still flushed, but an error in flushing them
+    is printed as a warning, so the original exception is raised)::
+
+        with ImageMetaTag.db.BatchedDbWriter(db_file) as db_writer:
+            for ...:
+                ImageMetaTag.savefig(filename, img_tags=img_tags,
+                                     db_file=db_writer)
+
+    Arguments:
+     * db_file - the database file to write to. If it does not exist, it \
+                 will be created. This can also be the directory of a sharded \
+                 database (see :mod:`ImageMetaTag.shards`), in which case the \
+                 rows for each shard are written in their own transaction.
+
+    Options:
+     * max_rows - the number of rows to buffer before they are flushed.
+     * max_seconds - the time, in seconds, after which the buffer is flushed. \
+                     This is checked as rows are added.
+     * add_strict - passed into :func:`ImageMetaTag.db.write_img_to_open_db`
+     * attempt_replace - passed to :func:`ImageMetaTag.db.write_img_to_open_db`
+     * db_timeout - change the database timeout (in seconds).
+     * db_attempts - change the number of attempts to write to the database.
+
+    Objects:
+     * n_rows - the number of rows written to the database so far.
+     * n_flushes - the number of flushes (transactions) made so far.
+     * lock_wait - the time, in seconds, spent waiting for the database \
+                   write lock.
+    '''
+    def __init__(self, db_file, max_rows=1000, max_seconds=60,
+                 add_strict=False, attempt_replace=False,
+                 db_timeout=DEFAULT_DB_TIMEOUT,
+                 db_attempts=DEFAULT_DB_ATTEMPTS):
+        if db_file is None:
+            raise ValueError('BatchedDbWriter requires a database file')
+        if max_rows < 1:
+            raise ValueError('max_rows must be >= 1')
+        self.db_file = db_file
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.add_strict = add_strict
+        self.attempt_replace = attempt_replace
+        self.db_timeout = db_timeout
+        self.db_attempts = db_attempts
+
+        self.n_rows = 0
+        self.n_flushes = 0
+        self.lock_wait = 0.0
+        self._buffer = []
+        self._last_flush = time.time()
+
+    def __repr__(self):
+        msg = ('BatchedDbWriter("{}"): {} rows written in {} flushes, '
+               '{:.3f} s waiting on locks, {} rows buffered')
+        return msg.format(self.db_file, self.n_rows, self.n_flushes,
+                          self.lock_wait, len(self._buffer))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+            return False
+        # the images will have been written to disk already, so still try to
+        # flush what we have, but without hiding the exception that got us here:
+        try:
+            self.flush()
+        except Exception as flush_err:
+            msg = 'WARNING: unable to flush {} rows to {} ({}), after {}: {}'
+            print(msg.format(len(self._buffer), self.db_file, flush_err,
+                             exc_type.__name__, exc_value))
+        return False
+
+    def add(self, img_filename, img_info):
+        '''
+        Adds an image, and its metadata, to the buffer. The buffer is
+        flushed if it has reached max_rows, or max_seconds have passed
+        since the last flush.
+        '''
+        if len(img_info) == 0:
+            raise ValueError('Size of image info dict is zero')
+        # take a copy, as the calling routine may reuse the dict:
+        self._buffer.append((img_filename, dict(img_info)))
+        if (len(self._buffer) >= self.max_rows or
+                time.time() - self._last_flush >= self.max_seconds):
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes all of the buffered rows to the database file, in a single
+        transaction.
+        '''
+        if len(self._buffer) == 0:
+            self._last_flush = time.time()
+            return
+
+        if os.path.isdir(self.db_file):
+            # a sharded database, so each shard gets its own transaction:
+            from ImageMetaTag import shards
+            shard_rows = shards.group_by_shard(self.db_file, self._buffer)
+        else:
+            shard_rows = [(self.db_file, self._buffer)]
+        for db_file, img_rows in shard_rows:
+            retry_if_locked(lambda: self._write_buffer(db_file, img_rows), db_file,
+                            db_timeout=self.db_timeout,
+                            db_attempts=self.db_attempts, action='writing to')
+
+        self.n_rows += len(self._buffer)
+        self.n_flushes += 1
+        self._buffer = []
+        self._last_flush = time.time()
+
+    def _write_buffer(self, db_file, img_rows):
+        'opens the database and writes the buffered img_rows, for retry_if_locked'
+        dbcn = None
+        got_lock = False
+        lock_st = time.time()
+        try:
+            dbcn, dbcr = open_or_create_db_file(db_file, img_rows[0][1],
+                                                timeout=self.db_timeout)
+            # commit anything done in creating the database, then take the
+            # write lock now, so we know how long we waited:
+            dbcn.commit()
+            dbcr.execute('BEGIN IMMEDIATE')
+            got_lock = True
+            self.lock_wait += time.time() - lock_st
+            write_imgs_to_open_db(dbcr, img_rows,
+                                  add_strict=self.add_strict,
+                                  attempt_replace=self.attempt_replace)
+            dbcn.commit()
+        except sqlite3.OperationalError as op_err:
+            if 'database is locked' in repr(op_err) and not got_lock:
+                # all of this attempt was spent waiting for the lock:
+                self.lock_wait += time.time() - lock_st
+            raise
+        finally:
+            if dbcn is not None:
+                dbcn.close()
+
+    def close(self):
+        'Flushes any remaining rows. Equivalent to leaving the with statement.'
+        self.flush()
 
 
 def list_tables(dbcr):
@@ -424,7 +2074,8 @@ def list_tables(dbcr):
 
 
 def read_img_info_from_dbcursor(dbcr, required_tags=None, tag_strings=None,
-                                n_samples=None):
+                                n_samples=None, tag_codes=False, sample_seed=None,
+                                where=None):
     '''
     Reads from an open database cursor (dbcr) for
     :func:`ImageMetaTag.db.read` and other routines.
@@ -432,36 +2083,147 @@ def read_img_info_from_dbcursor(dbcr, required_tags=None, tag_strings=None,
     Options
      * required_tags - a list of image tags to return, and to fail if not all \
                        are present
-     * tag_strings - an input list that will be populated with the unique \
-                     values of the image tags
+     * tag_strings - an input list, or dict, that will be populated with the \
+                     unique values of the image tags
      * n_samples - if provided, only the given number of entries will be \
                    loaded from the database, at random. Must be an integer \
                    or None (default None)
+     * tag_codes - for databases with encoded tags, return the codes \
+                   rather than the tag values.
+     * sample_seed - the seed for the random sample, when using n_samples.
+     * where - a dict of tag names & acceptable values, to only read the \
+               images that match (see :func:`ImageMetaTag.db.where_from_tags`).
+
+    Only the required_tags, and the images that match where, are read from the
+    database (see :func:`ImageMetaTag.db.select_dbcr_by_tags`).
+    '''
+    db_contents = _select_rows(dbcr, required_tags=required_tags, n_samples=n_samples,
+                               sample_seed=sample_seed, where=where)
+    # and convert that to a useful dict/list combo:
+    filename_list, out_dict = process_select_star_from(db_contents, dbcr,
+                                                       required_tags=required_tags,
+                                                       tag_strings=tag_strings,
+                                                       tag_codes=tag_codes)
+    return filename_list, out_dict
+
+
+def _sample_rows(dbcr, n_samples, sample_seed=None, chunk_size=500,
+                 select_cols='*', where_command=None, where_values=()):
+    '''
+    Reads a random sample of n_samples rows (or all of them, if there are
+    fewer) from the ImageMetaTag table, for an open database cursor (dbcr),
+    as a SELECT of select_cols would. Only rows that match where_command
+    (with its where_values, see :func:`ImageMetaTag.db._select_clauses`) are
+    sampled. The same sample_seed gives the same sample, as long as the
+    database has not changed.
+
+    Rows are picked by choosing random rowids, and trying again for any that
+    are missing (as images have been deleted), so the time taken depends on
+    the sample size rather than the size of the table. If the sample is a large
+    part of the table, or most rowids are missing, then the sample is taken
+    from all the rowids, in one pass, with reservoir sampling.
+    '''
+    rng = random.Random(sample_seed)
+    # (these are separate sub-queries, so sqlite can find each without a table scan)
+    min_rowid, max_rowid = dbcr.execute('SELECT (SELECT MIN(rowid) FROM {0}), '
+                                        '(SELECT MAX(rowid) FROM {0})'.format(
+                                            SQLITE_IMG_INFO_TABLE)).fetchone()
+    if min_rowid is None:
+        return []
+    n_range = max_rowid - min_rowid + 1
+
+    # the rows that can be sampled:
+    where_prefix = '' if where_command is None else '({}) AND '.format(where_command)
+    where_values = list(where_values)
+    check_cmd = 'SELECT rowid FROM {} WHERE {}rowid IN ({{}})'.format(SQLITE_IMG_INFO_TABLE,
+                                                                     where_prefix)
+    sample = []
+    if 2 * n_samples < n_range:
+        tried = set()
+        # the fraction of rowids that are in use, which starts off optimistic:
+        density = 1.0
+        while len(sample) < n_samples and density >= 0.1:
+            n_draw = int((n_samples - len(sample)) / density * 1.1) + 10
+            n_draw = min(n_draw, (n_range - len(tried)) // 2)
+            if n_draw < 1:
+                break
+            draws = []
+            while len(draws) < n_draw:
+                rowid = rng.randint(min_rowid, max_rowid)
+                if rowid not in tried:
+                    tried.add(rowid)
+                    draws.append(rowid)
+            found = set()
+            for i_chunk in range(0, len(draws), chunk_size):
+                chunk = draws[i_chunk:i_chunk + chunk_size]
+                found.update([x[0] for x in dbcr.execute(
+                    check_cmd.format(','.join(['?'] * len(chunk))), where_values + chunk)])
+            # keep them in the order they were drawn, so the sample is still random:
+            for rowid in draws:
+                if rowid in found and len(sample) < n_samples:
+                    sample.append(rowid)
+            density = max(len(found), 1) / float(len(draws))
+    if len(sample) < n_samples:
+        # sample all of the rowids instead:
+        sample = []
+        rowid_cmd = 'SELECT rowid FROM {}'.format(SQLITE_IMG_INFO_TABLE)
+        if where_command is not None:
+            rowid_cmd += ' WHERE {}'.format(where_command)
+        rowid_cr = dbcr.connection.execute(rowid_cmd, where_values)
+        i_row = 0
+        while True:
+            rows = rowid_cr.fetchmany(10000)
+            if not rows:
+                break
+            for (rowid,) in rows:
+                if i_row < n_samples:
+                    sample.append(rowid)
+                else:
+                    i_replace = rng.randint(0, i_row)
+                    if i_replace < n_samples:
+                        sample[i_replace] = rowid
+                i_row += 1
+
+    # now read the rows of the sample:
+    sample.sort()
+    read_cmd = 'SELECT {} FROM {} WHERE rowid IN ({{}})'.format(select_cols,
+                                                                SQLITE_IMG_INFO_TABLE)
+    db_contents = []
+    for i_chunk in range(0, len(sample), chunk_size):
+        chunk = sample[i_chunk:i_chunk + chunk_size]
+        db_contents.extend(dbcr.execute(read_cmd.format(','.join(['?'] * len(chunk))),
+                                        chunk).fetchall())
+    return db_contents
+
+
+def _select_rows(dbcr, required_tags=None, n_samples=None, sample_seed=None, where=None):
+    '''
+    Selects the rows, for :func:`ImageMetaTag.db.read_img_info_from_dbcursor`,
+    that are then processed by :func:`ImageMetaTag.db.process_select_star_from`.
+    The options are as read_img_info_from_dbcursor.
     '''
-    # read in the data from the database:
+    # only select what is needed from the database:
+    select_cols, where_command, where_values = _select_clauses(dbcr, required_tags=required_tags,
+                                                               where=where)
     if n_samples is None:
-        sel_com = 'SELECT * FROM {}'.format(SQLITE_IMG_INFO_TABLE)
-        db_contents = dbcr.execute(sel_com).fetchall()
+        sel_com = 'SELECT {} FROM {}'.format(select_cols, SQLITE_IMG_INFO_TABLE)
+        if where_command:
+            sel_com += ' WHERE {}'.format(where_command)
+        db_contents = dbcr.execute(sel_com, where_values).fetchall()
     else:
         if not isinstance(n_samples, int):
             raise ValueError('n_samples must be an integer')
         elif n_samples < 1:
             raise ValueError('n_samples must be > 1')
         # read only a sample of lines:
-        read_cmd = ('SELECT * FROM {0} WHERE {1} IN (SELECT {1} FROM {0} '
-                    'ORDER BY RANDOM() LIMIT {2})')
-        read_cmd = read_cmd.format(SQLITE_IMG_INFO_TABLE,
-                                   SQLITE_IMG_INFO_FNAME, n_samples)
-        db_contents = dbcr.execute(read_cmd).fetchall()
-    # and convert that to a useful dict/list combo:
-    filename_list, out_dict = process_select_star_from(db_contents, dbcr,
-                                                       required_tags=required_tags,
-                                                       tag_strings=tag_strings)
-    return filename_list, out_dict
+        db_contents = _sample_rows(dbcr, n_samples, sample_seed=sample_seed,
+                                   select_cols=select_cols, where_command=where_command,
+                                   where_values=where_values)
+    return db_contents
 
 
 def process_select_star_from(db_contents, dbcr, required_tags=None,
-                             tag_strings=None):
+                             tag_strings=None, tag_codes=False):
     '''
     Converts the output from a select * from ....  command into a standard
     output format. Requires a database cursor (dbcr) to identify the field
@@ -470,8 +2232,11 @@ def process_select_star_from(db_contents, dbcr, required_tags=None,
     Options:
      * required_tags - a list of image tags to return, and to fail if not \
                        all are present
-     * tag_strings - an input list that will be populated with the unique \
-                     values of the image tags
+     * tag_strings - an input list, or dict, that will be populated with the \
+                     unique values of the image tags (see \
+                     :func:`ImageMetaTag.db.read`)
+     * tag_codes - for databases with encoded tags, return the codes \
+                   rather than the tag values.
 
     Returns:
      * as :func:`ImageMetaTag.db.read`, but filtered according to the select.
@@ -479,103 +2244,49 @@ def process_select_star_from(db_contents, dbcr, required_tags=None,
      * a dictionary, by filename, containing a dictionary of the image \
        metadata as tagname: value
     '''
-    # get the name of the fields from the cursor descripton:
     out_dict = {}
     filename_list = []
     # get the name of the fields from the cursor descripton:
-    field_names = [r[0] for r in dbcr.description]
-
-    # the required_tags input is a list of tag names (as strings):
-    if required_tags is not None:
-        if not isinstance(required_tags, list):
-            raise ValueError('Input required_tags should be a list of strings')
-        else:
-            for test_str in required_tags:
-                if not isinstance(test_str, str):
-                    raise ValueError('Input required_tags should be a list of strings')
-
-    if tag_strings is not None:
-        if not isinstance(tag_strings, list):
-            raise ValueError('Input tag_strings should be a list')
+    field_names = [db_name_to_info_key(r[0]) for r in dbcr.description]
+    # and which of them we want, checking for the required_tags:
+    use_fields = _fields_to_read(field_names, required_tags=required_tags)
+    # how to get the tag value from what is in the table:
+    decode = tag_value_decoder(dbcr, get_table_schema(dbcr), tag_codes=tag_codes)
+
+    # the pool of unique strings, to use as references:
+    if tag_strings is None or tag_codes:
+        string_pool = None
+    elif isinstance(tag_strings, dict):
+        string_pool = tag_strings
+    elif isinstance(tag_strings, list):
+        string_pool = dict([(x, x) for x in tag_strings])
+    else:
+        raise ValueError('Input tag_strings should be a list or dict')
 
     # now iterate and make a dictionary to return,
     # with the tests outside the loops so they're not tested for every row and element:
-    if required_tags is None and tag_strings is None:
-        for row in db_contents:
-            fname = str(row[0])
-            filename_list.append(fname)
-            img_info = {}
-            for tag_name, tag_val in zip(field_names[1:], row[1:]):
-                img_info[db_name_to_info_key(tag_name)] = str(tag_val)
-            out_dict[fname] = img_info
-            # return None, None if the contents are empty:
-            if len(filename_list) == 0 and len(out_dict) == 0:
-                return None, None
-    elif required_tags is not None and tag_strings is None:
-        for row in db_contents:
-            fname = str(row[0])
-            filename_list.append(fname)
-            img_info = {}
-            for tag_name, tag_val in zip(field_names[1:], row[1:]):
-                tag_name_full = db_name_to_info_key(tag_name)
-                if tag_name_full in required_tags:
-                    img_info[tag_name_full] = str(tag_val)
-            if len(img_info) != len(required_tags):
-                raise ValueError('Database entry does not contain all of the required_tags')
-
-            out_dict[fname] = img_info
-            # return None, None if the contents are empty:
-            if len(filename_list) == 0 and len(out_dict) == 0:
-                return None, None
-    elif required_tags is None and tag_strings is not None:
-        # we want all tags, but we want them as referneces to a common list:
+    if string_pool is None:
         for row in db_contents:
             fname = str(row[0])
             filename_list.append(fname)
-            img_info = {}
-            for tag_name, tag_val in zip(field_names[1:], row[1:]):
-                str_tag_val = str(tag_val)
-                try:
-                    # loacate the tag_string in the list:
-                    tag_index = tag_strings.index(str_tag_val)
-                    # and refernece it:
-                    img_info[db_name_to_info_key(tag_name)] = tag_strings[tag_index]
-                except ValueError:
-                    # tag not yet in the tag_strings list, so
-                    # add the new string onto the end:
-                    tag_strings.append(str_tag_val)
-                    # and reference it:
-                    img_info[db_name_to_info_key(tag_name)] = tag_strings[-1]
-            out_dict[fname] = img_info
-            # return None, None if the contents are empty:
-            if len(filename_list) == 0 and len(out_dict) == 0:
-                return None, None
+            out_dict[fname] = dict([(key, decode(row[i_fld])) for i_fld, key in use_fields])
     else:
-        # we want to filter the tags, and we want them as referneces to a common list:
+        pool_get = string_pool.get
+        append_new = tag_strings.append if isinstance(tag_strings, list) else None
         for row in db_contents:
             fname = str(row[0])
             filename_list.append(fname)
             img_info = {}
-            for tag_name, tag_val in zip(field_names[1:], row[1:]):
-                # test to see if the tag name is required:
-                tag_name_full = db_name_to_info_key(tag_name)
-                if tag_name_full in required_tags:
-                    str_tag_val = str(tag_val)
-                    try:
-                        # loacate the tag_string in the list:
-                        tag_index = tag_strings.index(str_tag_val)
-                        # and refernece it:
-                        img_info[tag_name_full] = tag_strings[tag_index]
-                    except ValueError:
-                        # tag not yet in the tag_strings list, so
-                        # add the new string onto the end:
-                        tag_strings.append(str_tag_val)
-                        # and reference it:
-                        img_info[tag_name_full] = tag_strings[-1]
+            for i_fld, key in use_fields:
+                str_tag_val = decode(row[i_fld])
+                # reference the string in the pool, adding it if it is new:
+                pooled_val = pool_get(str_tag_val)
+                if pooled_val is None:
+                    pooled_val = string_pool[str_tag_val] = str_tag_val
+                    if append_new is not None:
+                        append_new(str_tag_val)
+                img_info[key] = pooled_val
             out_dict[fname] = img_info
-            # return None, None if the contents are empty:
-            if len(filename_list) == 0 and len(out_dict) == 0:
-                return None, None
 
     # we're good, return the data:
     return filename_list, out_dict
@@ -583,189 +2294,540 @@ def process_select_star_from(db_contents, dbcr, required_tags=None,
 
 def del_plots_from_dbfile(db_file, filenames, do_vacuum=True, allow_retries=True,
                           db_timeout=DEFAULT_DB_TIMEOUT, db_attempts=DEFAULT_DB_ATTEMPTS,
-                          skip_warning=False):
+                          skip_warning=False, max_lock_seconds=0.25, shard_values=None):
     '''
     deletes a list of files from a database file created by :mod:`ImageMetaTag.db`
 
-    * do_vacuum - if True, the database will be restructured/cleaned after the delete
+    The filenames are deleted in chunks, each in its own transaction, so that
+    concurrent processes writing to the database have a chance to do so. The
+    filenames in a chunk are loaded into a temporary table and deleted with a
+    single statement. The size of the chunks is adjusted so that the database
+    is locked for about max_lock_seconds at a time.
+
+    * do_vacuum - if True, the database will be restructured/cleaned after the delete. \
+                  Databases with incremental auto vacuum are compacted \
+                  (see :func:`ImageMetaTag.db.compact`) rather than given a full VACUUM.
     * allow_retries - if True, retries will be allowed if the database is locked.\
-                    If False there are no retries, but sleep commands try to avoid the need\
-                    when doing a large number of deletes.
+                    If False there are no retries.
     * db_timeout - overide default database timeouts, if doing retries
     * db_attempts - overide default number of attempts, if doing retries
     * skip_warning - do not warn if a filename, that has been requested to be deleted,\
                    does not exist in the database
+    * max_lock_seconds - the target time, in seconds, to hold the database lock \
+                         for each chunk of deletes.
+    * shard_values - for a sharded database (see :mod:`ImageMetaTag.shards`), \
+                     the values of the shard tag for the images, if they \
+                     are known, so that only those shards are searched. \
+                     Otherwise, the images are deleted from all of the shards.
+
+    Returns the number of images deleted.
     '''
     if not isinstance(filenames, list):
         fn_list = [filenames]
     else:
         fn_list = filenames
 
-    # delete command to use:
-    del_cmd = "DELETE FROM {} WHERE {}=?"
     if db_file is None:
-        pass
-    else:
-        if not os.path.isfile(db_file) or len(fn_list) == 0:
-            pass
-        else:
-            if allow_retries:
-                # split the list of filenames up into appropciately sized chunks, so that
-                # concurrent delete commands each have a chance to complete:
-                # 200 is arbriatily chosen, but seems to work
-                chunk_size = 200
-                chunks = __gen_chunk_of_list(fn_list, chunk_size)
-                for chunk_o_filenames in chunks:
-                    # within each chunk of files, need to open the db, with time out retries etc:
-                    n_tries = 1
-                    wrote_db = False
-                    while not wrote_db and n_tries <= db_attempts:
-                        try:
-                            # open the database
-                            dbcn, dbcr = open_db_file(db_file, timeout=db_timeout)
-                            # go through the file chunk, one by one, and delete:
-                            for fname in chunk_o_filenames:
-                                try:
-                                    dbcr.execute(del_cmd.format(SQLITE_IMG_INFO_TABLE,
-                                                                SQLITE_IMG_INFO_FNAME), (fname,))
-                                except sqlite3.OperationalError as op_err_file:
-                                    err_check = 'no such table: {}'.format(SQLITE_IMG_INFO_TABLE)
-                                    if err_check in op_err_file:
-                                        # the db file exists, but it doesn't have anything in it:
-                                        if not skip_warning:
-                                            msg = ('WARNING: Unable to delete file entry "{}" from'
-                                                   ' database "{}" as database table is missing')
-                                            print(msg.format(fname, db_file))
-                                        return
-
-                                    if not skip_warning:
-                                        # if this fails, print a warning...
-                                        # need to figure out why this might happen
-                                        msg = ('WARNING: unable to delete file entry:'
-                                               ' "{}", type "{}" from database')
-                                        print(msg.format(fname, type(fname)))
-                            dbcn.commit()
-                            # if we got here, then we're good!
-                            wrote_db = True
-                            # finally close (for this chunk)
-                            dbcn.close()
-                        except sqlite3.OperationalError as op_err:
-                            if 'database is locked' in repr(op_err):
-                                # database being locked is what the retries and timeouts are for:
-                                msg = '{} database timeout deleting from file "{}", {} s'
-                                print(msg.format(dt_now_str(), db_file, n_tries * db_timeout))
-                                n_tries += 1
-                            elif 'disk I/O error' in repr(op_err):
-                                msg = '{} for file {}'.format(op_err, db_file)
-                                raise IOError(msg)
-                            else:
-                                # everything else needs to be reported and raised immediately:
-                                msg = '{} for file {}'.format(op_err, db_file)
-                                raise ValueError(msg)
-
-                    # if we went through all the attempts then it is time to raise the error:
-                    if n_tries > db_attempts:
+        return 0
+    if os.path.isdir(db_file):
+        from ImageMetaTag import shards
+        return shards.del_plots(db_file, fn_list, shard_values=shard_values,
+                                do_vacuum=do_vacuum, allow_retries=allow_retries,
+                                db_timeout=db_timeout, db_attempts=db_attempts,
+                                skip_warning=skip_warning,
+                                max_lock_seconds=max_lock_seconds)
+    if not os.path.isfile(db_file) or len(fn_list) == 0:
+        return 0
+    if not allow_retries:
+        db_attempts = 1
+
+    dbcn, dbcr = open_db_file(db_file, timeout=db_timeout)
+    try:
+        n_missing = 0
+        n_deleted = 0
+        chunk_size = 1000
+        i_chunk = 0
+        while i_chunk < len(fn_list):
+            chunk_o_filenames = fn_list[i_chunk:i_chunk + chunk_size]
+            i_chunk += len(chunk_o_filenames)
+
+            def _del_chunk():
+                'deletes the chunk of files, for retry_if_locked'
+                try:
+                    return _del_fnames_from_dbcr(dbcr, chunk_o_filenames)
+                except sqlite3.OperationalError as op_err:
+                    dbcn.rollback()
+                    if 'database is locked' in repr(op_err):
+                        # database being locked is what the retries and timeouts are for:
+                        raise
+                    elif 'no such table: main.{}'.format(SQLITE_IMG_INFO_TABLE) in repr(op_err):
+                        # the db file exists, but it doesn't have anything in it:
+                        return None
+                    elif 'disk I/O error' in repr(op_err):
                         msg = '{} for file {}'.format(op_err, db_file)
-                        raise sqlite3.OperationalError(msg)
-
+                        raise IOError(msg)
+                    else:
+                        # everything else needs to be reported and raised immediately:
+                        msg = '{} for file {}'.format(op_err, db_file)
+                        raise ValueError(msg)
+
+            deleted = retry_if_locked(_del_chunk, db_file, db_timeout=db_timeout,
+                                      db_attempts=db_attempts, action='deleting from')
+            if deleted is None:
+                if not skip_warning:
+                    msg = ('WARNING: Unable to delete file entries from'
+                           ' database "{}" as database table is missing')
+                    print(msg.format(db_file))
+                return 0
+            n_chunk_deleted, n_unique, lock_seconds = deleted
+            n_deleted += n_chunk_deleted
+            n_missing += n_unique - n_chunk_deleted
+
+            # adjust the chunk size, so the lock is held for about max_lock_seconds,
+            # but without changing too much from one chunk to the next:
+            scale = max_lock_seconds / max(lock_seconds, 1e-3)
+            chunk_size = int(chunk_size * min(max(scale, 0.25), 4.0))
+            chunk_size = min(max(chunk_size, 10), 100000)
+
+        if n_missing and not skip_warning:
+            msg = 'WARNING: {} of the files to delete were not in database "{}"'
+            print(msg.format(n_missing, db_file))
+
+        # (there is nothing to reclaim if nothing was deleted):
+        if do_vacuum and n_deleted > 0:
+            if _incremental_vacuum(dbcn):
+                _compact_dbcn(dbcn)
             else:
-                # just open the database:
-                dbcn, dbcr = open_db_file(db_file)
-                # delete the contents:
-                for i_fn, fname in enumerate(fn_list):
-                    try:
-                        dbcr.execute(del_cmd.format(SQLITE_IMG_INFO_TABLE), (fname,))
-                    except:
-                        if not skip_warning:
-                            # if this fails, print a warning...
-                            # need to figure out why this happens
-                            msg = ('WARNING: unable to delete file entry:'
-                                   ' "{}", type "{}" from database')
-                            print(msg.format(fname, type(fname)))
-                    # commit every 100 to give other processes a chance:
-                    if i_fn % 100 == 0:
-                        dbcn.commit()
-                        time.sleep(1)
-                # commit, and vacuum if required:
-                dbcn.commit()
-
-            if do_vacuum:
-                if allow_retries:
-                    # need to re-open the db, if we allowed retries:
-                    dbcn, dbcr = open_db_file(db_file)
                 dbcn.execute("VACUUM")
-                dbcn.close()
-            elif not allow_retries:
-                dbcn.close()
+    finally:
+        dbcn.close()
+    return n_deleted
+
+
+def compact(db_file, max_pages=None, max_seconds=None, step_pages=200,
+            db_timeout=DEFAULT_DB_TIMEOUT, db_attempts=DEFAULT_DB_ATTEMPTS):
+    '''
+    Reclaims the space in a database file that has been freed by deleting
+    images, with an incremental vacuum. Rather than rewriting the whole file
+    and locking it until that is done, as a full VACUUM does, the free pages
+    are removed in steps of step_pages, each in its own short transaction, so
+    other processes can write to the database in between.
+
+    The database needs to have been created with incremental auto vacuum,
+    which is the default (see :func:`ImageMetaTag.db.connect_db`). Older
+    databases can be converted with :func:`ImageMetaTag.db.enable_incremental_vacuum`.
+
+    Options:
+     * max_pages - the maximum number of pages to reclaim. Default is all of them.
+     * max_seconds - stop after (about) this number of seconds.
+     * step_pages - the number of pages to reclaim in each step.
+     * db_timeout - change the database timeout (in seconds).
+     * db_attempts - change the number of attempts to access the database.
+
+    Returns the number of pages reclaimed.
+    '''
+    if not os.path.isfile(db_file):
+        return 0
+
+    def _compact_db():
+        'opens the database and compacts it, for retry_if_locked'
+        dbcn = connect_db(db_file, timeout=db_timeout)
+        try:
+            if not _incremental_vacuum(dbcn):
+                msg = ('WARNING: database "{}" does not use incremental auto vacuum, '
+                       'so cannot be compacted. See ImageMetaTag.db.enable_incremental_vacuum')
+                print(msg.format(db_file))
+                return 0
+            return _compact_dbcn(dbcn, max_pages=max_pages, max_seconds=max_seconds,
+                                 step_pages=step_pages)
+        finally:
+            dbcn.close()
+
+    return retry_if_locked(_compact_db, db_file, db_timeout=db_timeout,
+                           db_attempts=db_attempts, action='compacting')
+
+
+def _incremental_vacuum(dbcn):
+    'Returns True if the open database connection (dbcn) uses incremental auto vacuum'
+    # auto_vacuum is 0 for NONE, 1 for FULL and 2 for INCREMENTAL:
+    return dbcn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+
+
+def _compact_dbcn(dbcn, max_pages=None, max_seconds=None, step_pages=200):
+    'Does the work for :func:`ImageMetaTag.db.compact`, on an open database connection'
+    time_start = time.time()
+    n_reclaimed = 0
+    n_free = dbcn.execute('PRAGMA freelist_count').fetchone()[0]
+    while n_free > 0:
+        n_step = min(n_free, step_pages)
+        if max_pages is not None:
+            n_step = min(n_step, max_pages - n_reclaimed)
+        if n_step <= 0:
+            break
+        # (executescript runs the pragma to completion, execute only does one page)
+        dbcn.executescript('PRAGMA incremental_vacuum({:d});'.format(n_step))
+        n_free_before = n_free
+        n_free = dbcn.execute('PRAGMA freelist_count').fetchone()[0]
+        n_reclaimed += n_free_before - n_free
+        if n_free >= n_free_before:
+            # nothing is happening, so stop:
+            break
+        if max_seconds is not None and time.time() - time_start >= max_seconds:
+            break
+    return n_reclaimed
+
+
+def publish_snapshot(db_file, snapshot_path,
+                     db_timeout=DEFAULT_DB_TIMEOUT, db_attempts=DEFAULT_DB_ATTEMPTS):
+    '''
+    Publishes a snapshot of a database file, for processes that only read it
+    (web page builders, for instance), so that heavy reads never get in the
+    way of the processes writing to the live database.
+
+    The snapshot is a compact, consistent copy of the database, made with
+    VACUUM INTO (or the backup API, with versions of sqlite before 3.27). It
+    is written to a temporary file next to snapshot_path, which is then
+    renamed into place, so readers always see either the previous snapshot
+    or the new one, never a partial copy. Readers that already have the
+    previous snapshot open carry on reading it.
+
+    The snapshot is not written to after it is published, so can be read
+    with immutable=True (see :func:`ImageMetaTag.db.read`), which does no
+    locking at all.
+
+    Options:
+     * db_timeout - change the database timeout (in seconds).
+     * db_attempts - change the number of attempts to access the database.
+
+    Returns the time taken to make the snapshot, in seconds.
+    '''
+    if not os.path.isfile(db_file):
+        msg = 'Database file {} does not exist, so cannot be published'
+        raise ValueError(msg.format(db_file))
+    if os.path.abspath(db_file) == os.path.abspath(snapshot_path):
+        raise ValueError('A database cannot be published as a snapshot of itself')
+
+    time_start = time.time()
+    # the temporary file needs to be on the same file system as the snapshot,
+    # for the rename to be atomic:
+    tmp_path = '{}.{}.tmp'.format(snapshot_path, os.getpid())
+
+    def _snapshot_db():
+        'opens the database and copies it to tmp_path, for retry_if_locked'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        # VACUUM INTO only needs a read transaction, but is refused with query_only,
+        # so this cannot use a read-only connection:
+        dbcn = connect_db(db_file, timeout=db_timeout)
+        try:
+            if sqlite3.sqlite_version_info >= (3, 27, 0):
+                dbcn.execute('VACUUM INTO ?', (tmp_path,))
+            else:
+                _backup_to_file(dbcn, tmp_path)
+        finally:
+            dbcn.close()
+
+    try:
+        retry_if_locked(_snapshot_db, db_file, db_timeout=db_timeout,
+                        db_attempts=db_attempts, action='publishing')
+        if hasattr(os, 'replace'):
+            os.replace(tmp_path, snapshot_path)
+        else:
+            # python2, where rename is atomic, and replaces snapshot_path, on posix:
+            os.rename(tmp_path, snapshot_path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return time.time() - time_start
+
 
+def _backup_to_file(dbcn, file_path):
+    '''
+    Copies the open database connection (dbcn) to a new file, in rollback journal
+    mode, for :func:`ImageMetaTag.db.publish_snapshot` with older versions of sqlite.
+    '''
+    file_cn = sqlite3.connect(file_path)
+    try:
+        if hasattr(dbcn, 'backup'):
+            dbcn.backup(file_cn)
+        else:
+            file_cn.executescript('\n'.join(dbcn.iterdump()))
+        # the copy should not need a -wal file next to it:
+        file_cn.execute('PRAGMA journal_mode = DELETE')
+        file_cn.commit()
+    finally:
+        file_cn.close()
+
+
+def enable_incremental_vacuum(db_file, db_timeout=DEFAULT_DB_TIMEOUT,
+                              db_attempts=DEFAULT_DB_ATTEMPTS):
+    '''
+    Converts a database file, created before ImageMetaTag used incremental
+    auto vacuum, so that it can be compacted with :func:`ImageMetaTag.db.compact`.
+
+    This needs a full VACUUM, which rewrites the file and locks it while that
+    is done, but only needs doing once.
+    '''
+    def _enable():
+        'opens the database and converts it, for retry_if_locked'
+        dbcn = connect_db(db_file, timeout=db_timeout)
+        try:
+            if not _incremental_vacuum(dbcn):
+                dbcn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                dbcn.execute('VACUUM')
+        finally:
+            dbcn.close()
+
+    retry_if_locked(_enable, db_file, db_timeout=db_timeout,
+                    db_attempts=db_attempts, action='vacuuming')
+
+
+def _del_fnames_from_dbcr(dbcr, filenames):
+    '''
+    Deletes the filenames from the ImageMetaTag table of an open database
+    cursor (dbcr), in one transaction, using a temporary table of the filenames.
 
-def __gen_chunk_of_list(in_list, chunk_size):
-    'gnerator that yields a chunk of list, of length chunk size'
-    for ndx in range(0, len(in_list), chunk_size):
-        yield in_list[ndx:min(ndx + chunk_size, len(in_list))]
+    Returns the number of images deleted, the number of unique filenames and
+    the time the database was locked for, in seconds.
+    '''
+    del_table = 'imt_del'
+    dbcr.execute('CREATE TEMP TABLE IF NOT EXISTS {}({} TEXT PRIMARY KEY)'.format(
+        del_table, SQLITE_IMG_INFO_FNAME))
+    dbcr.execute('DELETE FROM temp.{}'.format(del_table))
+    dbcr.executemany('INSERT OR IGNORE INTO temp.{} VALUES(?)'.format(del_table),
+                     [(x,) for x in filenames])
+    n_unique = dbcr.execute('SELECT COUNT(*) FROM temp.{}'.format(del_table)).fetchone()[0]
+    # this only writes to the temporary table, so does not lock the main database:
+    dbcr.connection.commit()
+
+    dbcr.execute('BEGIN IMMEDIATE')
+    time_locked = time.time()
+    try:
+        dbcr.execute('DELETE FROM main.{0} WHERE {1} IN (SELECT {1} FROM temp.{2})'.format(
+            SQLITE_IMG_INFO_TABLE, SQLITE_IMG_INFO_FNAME, del_table))
+        n_deleted = dbcr.rowcount
+        dbcr.connection.commit()
+    except:
+        dbcr.connection.rollback()
+        raise
+    return n_deleted, n_unique, time.time() - time_locked
 
 
-def select_dbfile_by_tags(db_file, select_tags):
+def select_dbfile_by_tags(db_file, select_tags, immutable=False, required_tags=None):
     '''
     Selects from a database file the entries that match a dict of field names/acceptable values.
 
+    The database is opened read-only, or immutable (see :func:`ImageMetaTag.db.read`).
+    Only the required_tags are read, if they are given (see
+    :func:`ImageMetaTag.db.select_dbcr_by_tags`).
+
+    db_file can also be the directory of a sharded database (see
+    :mod:`ImageMetaTag.shards`), in which case only the shards that can match
+    the select_tags are read.
+
     Returns the output, processed by :func:`ImageMetaTag.db.process_select_star_from`
     '''
     if db_file is None:
         sel_results = None
+    elif os.path.isdir(db_file):
+        from ImageMetaTag import shards
+        sel_results = shards.select(db_file, select_tags, immutable=immutable,
+                                    required_tags=required_tags)
     else:
         if not os.path.isfile(db_file):
             sel_results = None
         else:
             # just open the database:
-            dbcn, dbcr = open_db_file(db_file)
+            dbcn, dbcr = open_db_file(db_file, read_only=True, immutable=immutable)
             # do the select:
-            sel_results = select_dbcr_by_tags(dbcr, select_tags)
+            sel_results = select_dbcr_by_tags(dbcr, select_tags, required_tags=required_tags)
             dbcn.close()
     return sel_results
 
 
-def select_dbcr_by_tags(dbcr, select_tags):
+def select_dbcr_by_tags(dbcr, select_tags, required_tags=None):
     '''
     Selects from an open database cursor (dbcr) the entries that match a dict of field
     names & acceptable values.
 
+    The selection is done by sqlite, with a WHERE clause, and only the filename and
+    the required_tags (a list of tag names, default all of them) are read.
+    A ValueError is raised if any of the tags are not in the database.
+
     Returns the output, processed by :func:`ImageMetaTag.db.process_select_star_from`
     '''
-    if len(select_tags) == 0:
-        # just read and return the whole thing:
-        return read_img_info_from_dbcursor(dbcr)
-    else:
-        # convert these to lists:
-        tag_names = list(select_tags.keys())
-        tag_values = [select_tags[x] for x in tag_names]
-        # Right... this is where I need to understand how to do a select!
-        #select_command = 'SELECT * FROM %s WHERE symbol=?' % SQLITE_IMG_INFO_TABLE
-        select_command = 'SELECT * FROM %s WHERE ' % SQLITE_IMG_INFO_TABLE
-        n_tags = len(tag_names)
-
-        use_tag_values = []
-        for i_tag, tag_name, tag_val in zip(list(range(n_tags)), tag_names, tag_values):
-            if isinstance(tag_val, (list, tuple)):
-                # if a list or tuple, then use IN:
-                select_command += '%s IN (' % info_key_to_db_name(tag_name)
-                select_command += ', '.join(['?']*len(tag_val))
-                select_command += ')'
-                if i_tag+1 < n_tags:
-                    select_command += ' AND '
-                use_tag_values.extend(tag_val)
-            else:
-                # do an exact match:
-                if i_tag+1 < n_tags:
-                    select_command += '%s = ? AND ' % info_key_to_db_name(tag_name)
-                else:
-                    select_command += '%s = ?' % info_key_to_db_name(tag_name)
-                use_tag_values.append(tag_val)
-        db_contents = dbcr.execute(select_command, use_tag_values).fetchall()
-        # and convert that to a useful dict/list combo:
-        filename_list, out_dict = process_select_star_from(db_contents, dbcr)
+    if len(select_tags) > 0:
+        # keep a record of what is selected, to advise on indexes:
+        INDEX_ADVISOR.record(select_tags)
+    return read_img_info_from_dbcursor(dbcr, required_tags=required_tags, where=select_tags)
 
-    return filename_list, out_dict
+
+def where_from_tags(select_tags):
+    '''
+    Converts a dict of tag names & acceptable values into an SQL WHERE
+    clause, for the ImageMetaTag table. A value can be a single value, for
+    an exact match, or a list/tuple of values.
+
+    Returns the clause (without the WHERE) and the list of values to go with it.
+    '''
+    where_parts = []
+    use_tag_values = []
+    for tag_name, tag_val in select_tags.items():
+        if isinstance(tag_val, (list, tuple)):
+            # if a list or tuple, then use IN:
+            where_parts.append('"{}" IN ({})'.format(info_key_to_db_name(tag_name),
+                                                    ', '.join(['?'] * len(tag_val))))
+            use_tag_values.extend(tag_val)
+        else:
+            # do an exact match:
+            where_parts.append('"{}" = ?'.format(info_key_to_db_name(tag_name)))
+            use_tag_values.append(tag_val)
+    return ' AND '.join(where_parts), use_tag_values
+
+
+def tag_index_name(tags):
+    'The name of the index, in the database, for a list of tags'
+    return 'imt_idx({})'.format(','.join([info_key_to_db_name(x) for x in tags]))
+
+
+def create_tag_indexes(db_file, tags=None,
+                       db_timeout=DEFAULT_DB_TIMEOUT,
+                       db_attempts=DEFAULT_DB_ATTEMPTS):
+    '''
+    Creates indexes on the tag columns of a database file, so that
+    selecting images by their tags (see
+    :func:`ImageMetaTag.db.select_dbfile_by_tags`) does not need to scan the
+    whole table.
+
+    Options:
+     * tags - a list of what to index. Each element can be a tag name, for \
+              a single column index, or a list/tuple of tag names for a \
+              multi-column index. Multi-column indexes are most useful when \
+              the same tags are selected together, with the tags that are \
+              selected by exact matches first. If None (default) every tag \
+              has a single column index. \
+              :class:`ImageMetaTag.db.TagIndexAdvisor` can recommend these.
+
+    Indexes that already exist are left as they are.
+
+    Returns a list of the tag tuples that were indexed.
+    '''
+    def _create_indexes():
+        'creates the indexes, for retry_if_locked'
+        dbcn, dbcr = open_db_file(db_file, timeout=db_timeout)
+        try:
+            indexed = create_tag_indexes_in_dbcr(dbcr, tags=tags)
+            dbcn.commit()
+        finally:
+            dbcn.close()
+        return indexed
+
+    return retry_if_locked(_create_indexes, db_file, db_timeout=db_timeout,
+                           db_attempts=db_attempts, action='indexing')
+
+
+def create_tag_indexes_in_dbcr(dbcr, tags=None):
+    '''
+    Does the work for :func:`ImageMetaTag.db.create_tag_indexes` on an open
+    database cursor (dbcr).
+    '''
+    field_names = get_table_schema(dbcr)['fields']
+    if tags is None:
+        tags = field_names[1:]
+    index_tags = []
+    for tag in tags:
+        if isinstance(tag, (list, tuple)):
+            index_tags.append(tuple(tag))
+        else:
+            index_tags.append((tag,))
+    missing_tags = [x for x in set(sum(index_tags, ())) if x not in field_names]
+    if missing_tags:
+        msg = 'Cannot index tags that are not in the database: {}'
+        raise ValueError(msg.format(missing_tags))
+
+    index_command = 'CREATE INDEX IF NOT EXISTS "{}" ON {}({})'
+    for these_tags in index_tags:
+        db_names = ['"{}"'.format(info_key_to_db_name(x)) for x in these_tags]
+        dbcr.execute(index_command.format(tag_index_name(these_tags),
+                                          SQLITE_IMG_INFO_TABLE,
+                                          ', '.join(db_names)))
+    # make sure the query planner knows enough to use the new indexes:
+    dbcr.execute('PRAGMA optimize')
+    return index_tags
+
+
+class TagIndexAdvisor(object):
+    '''
+    Keeps a count of the combinations of tags that are used to select
+    images from a database, so it can recommend (and create) the indexes
+    that would make those selects faster.
+
+    Every select by :func:`ImageMetaTag.db.select_dbcr_by_tags` is recorded
+    in the module's INDEX_ADVISOR, so after a typical workload::
+
+        ImageMetaTag.db.INDEX_ADVISOR.create(db_file)
+
+    will index the database for it.
+
+    Objects:
+     * counts - a collections.Counter of the number of selects, keyed by \
+                the tuple of tags that an index for the select would use. \
+                Tags selected by exact matches come first, then tags \
+                selected from a list of values.
+    '''
+    def __init__(self):
+        self.counts = collections.Counter()
+
+    def __repr__(self):
+        return 'TagIndexAdvisor: {}'.format(dict(self.counts))
+
+    def record(self, select_tags):
+        'Records a select, using a dict of tag names and values to select'
+        exact_tags = sorted([x for x, y in select_tags.items()
+                             if not isinstance(y, (list, tuple))])
+        list_tags = sorted([x for x, y in select_tags.items()
+                            if isinstance(y, (list, tuple))])
+        self.counts[tuple(exact_tags + list_tags)] += 1
+
+    def recommend(self, min_count=1, max_indexes=None):
+        '''
+        Returns a list of the tag tuples that should be indexed, most used
+        first. Selects that were used fewer than min_count times are
+        ignored, as are those that can use an index that is already
+        recommended (because it starts with the same tags).
+        '''
+        recommended = []
+        for tags, count in self.counts.most_common():
+            if count < min_count:
+                break
+            covered = any([set(x[0:len(tags)]) == set(tags) for x in recommended])
+            if not covered:
+                recommended.append(tags)
+            if max_indexes is not None and len(recommended) >= max_indexes:
+                break
+        return recommended
+
+    def create(self, db_file, min_count=1, max_indexes=None, **kwargs):
+        '''
+        Creates the recommended indexes in a database file, using
+        :func:`ImageMetaTag.db.create_tag_indexes` (which takes the kwargs).
+        Returns the list of tag tuples that were indexed.
+        '''
+        recommended = self.recommend(min_count=min_count,
+                                     max_indexes=max_indexes)
+        if not recommended:
+            return []
+        return create_tag_indexes(db_file, tags=recommended, **kwargs)
+
+    def reset(self):
+        'Forgets all of the selects recorded so far'
+        self.counts.clear()
+
+
+# the advisor that records all selects made by this module:
+INDEX_ADVISOR = TagIndexAdvisor()
 
 
 def recrete_table_new_cols(dbcr, current_cols, new_cols):
@@ -778,16 +2840,21 @@ def recrete_table_new_cols(dbcr, current_cols, new_cols):
     connections/processes will see an intermediate/incorrect database).
 
     Because of this, this process is slow and should be avoided if at all
-    possible.
+    possible. It is only used if :func:`ImageMetaTag.db.add_table_cols`
+    fails.
     '''
     msg = 'WARNING: recreating database table with new image tags: {}'
     print(msg.format(new_cols))
+    invalidate_schema_cache(dbcr)
+
+    # the tag indexes, and change log triggers, are dropped with the table,
+    # so keep a note of them:
+    index_sql = dbcr.execute(("SELECT sql FROM sqlite_master WHERE type IN ('index', 'trigger') "
+                              "AND tbl_name=? AND sql IS NOT NULL"),
+                             (SQLITE_IMG_INFO_TABLE,)).fetchall()
 
-    # read the cuirrent contents of the database:
-    _f_list, img_infos = read_img_info_from_dbcursor(dbcr)
-    _ = dbcr.execute('select * from %s' % SQLITE_IMG_INFO_TABLE).fetchone()
-    current_flds = [r[0] for r in dbcr.description]
-    current_keys = [db_name_to_info_key(x) for x in current_flds]
+    schema = get_table_schema(dbcr)
+    current_keys = schema['fields']
 
     # rename the current database table, checking to see if there is already
     # a tmp table (delete it if so):
@@ -800,7 +2867,6 @@ def recrete_table_new_cols(dbcr, current_cols, new_cols):
         dbcr.execute(drop_tmp_table_comm)
     # now do the rename:
     alter_command = 'ALTER TABLE "{}" RENAME TO "{}";'
-    alter_command.format(SQLITE_IMG_INFO_TABLE, tmp_table)
     dbcr.execute(alter_command.format(SQLITE_IMG_INFO_TABLE, tmp_table))
 
     # now recreate the table with the new elements:
@@ -808,35 +2874,21 @@ def recrete_table_new_cols(dbcr, current_cols, new_cols):
     for keyname in current_cols + new_cols:
         if keyname != SQLITE_IMG_INFO_FNAME:
             new_key_dict[keyname] = ''
+    create_table_for_img_info(dbcr, new_key_dict, encode_tags=schema['encoded'])
 
-    create_table_for_img_info(dbcr, new_key_dict)
-    # and pull the list of fields, in order:
-    _ = dbcr.execute('select * from %s' % SQLITE_IMG_INFO_TABLE).fetchone()
-    new_flds = [r[0] for r in dbcr.description]
-    new_keys = [db_name_to_info_key(x) for x in new_flds]
-
-    # now populate the new table:
-    ins_comm = 'INSERT INTO {} VALUES ({}?);'.format(SQLITE_IMG_INFO_TABLE,
-                                                     '?,'*(len(new_keys)-1))
-    # now make a list of tuples ordered
-    ins_this = []
-    for img in img_infos:
-        img_info = img_infos[img]
-        # now build up what into to add, starting with the img filename:
-        this_ins = [img]
-        for key in new_keys[1:]:
-            if key in current_keys:
-                # got it from previous data, so use it:
-                this_ins.append(img_info[key])
-            else:
-                # add it as None:
-                this_ins.append('None')
-        ins_this.append(tuple(this_ins))
-    # and exectuemany on the insert command:
-    dbcr.executemany(ins_comm, ins_this)
+    # now populate the new table, with the current contents (as they are
+    # stored, so encoded tags stay encoded), leaving the new tags to take
+    # their default value of 'None':
+    copy_cols = ', '.join(['"{}"'.format(info_key_to_db_name(x)) for x in current_keys])
+    ins_comm = 'INSERT INTO {0}({1}) SELECT {1} FROM "{2}";'
+    dbcr.execute(ins_comm.format(SQLITE_IMG_INFO_TABLE, copy_cols, tmp_table))
 
     # need to drop the _tmp table now as it has been superceded:
     dbcr.execute(drop_tmp_table_comm)
+    invalidate_schema_cache(dbcr)
+    # and put the indexes and triggers back:
+    for (sql,) in index_sql:
+        dbcr.execute(sql)
 
 
 def scan_dir_for_db(basedir, db_file, img_tag_req=None, add_strict=False,
@@ -897,6 +2949,9 @@ is True, in which case the database file will be restarted as empty. Use with ca
 
     os.chdir(basedir)
     first_img = True
+    # images are written to the database in batches of this size:
+    write_batch_size = 1000
+    img_rows = []
     for root, dirs, files in os.walk('./', followlinks=True, topdown=True):
         if not subdir_excl_list is None:
             dirs[:] = [d for d in dirs if not d in subdir_excl_list]
@@ -936,8 +2991,11 @@ is True, in which case the database file will be restarted as empty. Use with ca
                             dbcn, dbcr = open_or_create_db_file(db_file, img_info,
                                                                 restart_db=True)
                             first_img = False
-                        write_img_to_open_db(dbcr, img_name, img_info,
-                                             add_strict=add_strict)
+                        img_rows.append((img_name, img_info))
+                        if len(img_rows) >= write_batch_size:
+                            write_imgs_to_open_db(dbcr, img_rows,
+                                                  add_strict=add_strict)
+                            img_rows = []
                         if verbose:
                             print(img_name)
 
@@ -956,8 +3014,9 @@ is True, in which case the database file will be restarted as empty. Use with ca
                                     print('len(n_adds)=%s, currently every %s' \
                                             % (len(n_adds), add_interval))
 
-    # commit and close, and we are done:
+    # write the last batch, commit and close, and we are done:
     if not first_img:
+        write_imgs_to_open_db(dbcr, img_rows, add_strict=add_strict)
         dbcn.commit()
         dbcn.close()
 
@@ -966,6 +3025,17 @@ is True, in which case the database file will be restarted as empty. Use with ca
     return None
 
 
+def rm_db_file(db_file):
+    '''
+    Deletes a database file, along with any WAL/shared memory/journal files
+    that sqlite may have left beside it. Deleting the database without these
+    can cause a new database, of the same name, to be corrupted.
+    '''
+    _close_pooled_connection(db_file)
+    for suffix in ['-wal', '-shm', '-journal', '']:
+        rmfile(db_file + suffix)
+
+
 def rmfile(path):
     """
     os.remove, but does not complain if the file has already been
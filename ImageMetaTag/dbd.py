@@ -0,0 +1,526 @@
+'''
+This module contains imt-dbd, a daemon that owns an ImageMetaTag database file
+and writes image metadata to it on behalf of other processes, along with the
+functions those processes use to send it their metadata.
+
+When a large number of processes save images at the same time, writing to the
+same database, they spend most of their time waiting for each other to
+release the database lock. Instead, they can send the metadata to imt-dbd over
+a Unix domain socket, by using a db_file of the form::
+
+    unix:///path/to/imt.db.sock
+
+(or unix:///path/to/socket?db=/path/to/imt.db) with :func:`ImageMetaTag.savefig`
+or :func:`ImageMetaTag.db.write_img_to_dbfile`. The daemon writes everything it
+has been sent, from all of the processes, in a single transaction, then replies
+to them all, so each process still waits until its metadata is in the database.
+If the daemon is not running, the metadata is written directly to the database
+file instead.
+
+Messages, in both directions, are JSON objects encoded as utf-8, each preceded
+by its length as a 4 byte, big endian, unsigned integer. A request is either::
+
+    {"op": "write", "rows": [[filename, {tag: value, ...}], ...],
+     "add_strict": false, "attempt_replace": false}
+
+or {"op": "ping"}, and the reply is {"ok": true, ...} or
+{"ok": false, "error": message, "type": name of the exception}.
+
+The daemon only writes to the database. Reading is done directly from the
+database file as usual. It needs Unix domain sockets, so cannot be run on
+Windows, although this module can still be imported there.
+
+(C) Crown copyright Met Office. All rights reserved.
+Released under BSD 3-Clause License. See LICENSE for more details.
+'''
+
+import os
+import sys
+import errno
+import json
+import socket
+import sqlite3
+import struct
+import threading
+import time
+try:
+    import socketserver
+    import queue
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    import SocketServer as socketserver
+    import Queue as queue
+    from urlparse import urlparse, parse_qs
+
+from ImageMetaTag import db
+from ImageMetaTag import DEFAULT_DB_TIMEOUT, DEFAULT_DB_ATTEMPTS
+from ImageMetaTag.db import DBD_URL_SCHEME
+
+# the suffix of the default socket, for a database file:
+DBD_SOCKET_SUFFIX = '.sock'
+# the framing of messages: the length of the message as a 4 byte, big endian, unsigned int:
+_FRAME_HEADER = struct.Struct('!I')
+# sockets that could not be connected to, which have been reported:
+_WARNED_SOCKETS = set()
+
+
+def is_dbd_url(db_file):
+    'Returns True if db_file is the address of an imt-dbd daemon, rather than a file'
+    return isinstance(db_file, str) and db_file.startswith(DBD_URL_SCHEME)
+
+
+def parse_dbd_url(db_url):
+    '''
+    Splits the address of an imt-dbd daemon (unix:///path/to/socket, with an
+    optional ?db=/path/to/db_file) into the path of its socket, and the database
+    file it writes to. If the database file is not given, it is the socket path
+    without its .sock suffix.
+
+    Returns the socket path and the database file.
+    '''
+    if not is_dbd_url(db_url):
+        msg = 'Address of imt-dbd "{}" should start with "{}"'
+        raise ValueError(msg.format(db_url, DBD_URL_SCHEME))
+    parsed = urlparse(db_url)
+    socket_path = parsed.path
+    db_file = parse_qs(parsed.query).get('db', [None])[0]
+    if db_file is None:
+        if not socket_path.endswith(DBD_SOCKET_SUFFIX):
+            msg = 'Address of imt-dbd "{}" needs a ?db= database file, or a socket ending in {}'
+            raise ValueError(msg.format(db_url, DBD_SOCKET_SUFFIX))
+        db_file = socket_path[:-len(DBD_SOCKET_SUFFIX)]
+    return socket_path, db_file
+
+
+def send_message(sock, message):
+    'Sends a message (a dict, that can be encoded as JSON) over a connected socket'
+    data = json.dumps(message, separators=(',', ':')).encode('utf-8')
+    sock.sendall(_FRAME_HEADER.pack(len(data)) + data)
+
+
+def recv_message(sock):
+    '''
+    Receives a message (as sent by :func:`ImageMetaTag.dbd.send_message`) from a
+    connected socket. Returns None if the socket is closed before a message starts.
+    '''
+    header = _recv_exactly(sock, _FRAME_HEADER.size)
+    if header is None:
+        return None
+    data = _recv_exactly(sock, _FRAME_HEADER.unpack(header)[0])
+    if data is None:
+        raise IOError('imt-dbd connection closed part way through a message')
+    return json.loads(data.decode('utf-8'))
+
+
+def _recv_exactly(sock, n_bytes):
+    'Receives n_bytes from a socket, or returns None if it is closed first'
+    chunks = []
+    while n_bytes > 0:
+        chunk = sock.recv(min(n_bytes, 1024 * 1024))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        n_bytes -= len(chunk)
+    return b''.join(chunks)
+
+
+def request(socket_path, message, timeout=DEFAULT_DB_TIMEOUT * DEFAULT_DB_ATTEMPTS):
+    '''
+    Sends a message to the imt-dbd daemon listening on socket_path, and returns
+    its reply. Errors reported by the daemon are raised, as a ValueError if that
+    is what the daemon raised, or an IOError otherwise.
+
+    If the daemon cannot be connected to, the socket.error (an OSError in
+    python3) is raised as it is, so the caller can decide what to do.
+    '''
+    return _request(_connect(socket_path, timeout), socket_path, message)
+
+
+def _connect(socket_path, timeout):
+    '''
+    Returns a socket connected to the imt-dbd daemon on socket_path. If the
+    daemon is busy (so its queue of connections is full) this keeps trying,
+    for up to timeout seconds.
+    '''
+    time_start = time.time()
+    while True:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(timeout)
+            sock.connect(socket_path)
+            return sock
+        except socket.error as sock_err:
+            sock.close()
+            if sock_err.errno != errno.EAGAIN or time.time() - time_start > timeout:
+                raise
+        except:
+            sock.close()
+            raise
+        time.sleep(0.001)
+
+
+def _request(sock, socket_path, message):
+    'Does the work for :func:`ImageMetaTag.dbd.request`, on a connected socket, which is closed'
+    try:
+        send_message(sock, message)
+        reply = recv_message(sock)
+    finally:
+        sock.close()
+    if reply is None:
+        raise IOError('imt-dbd on {} closed the connection without replying'.format(socket_path))
+    if not reply.get('ok'):
+        msg = 'imt-dbd on {}: {}'.format(socket_path, reply.get('error'))
+        if reply.get('type') == 'ValueError':
+            raise ValueError(msg)
+        raise IOError(msg)
+    return reply
+
+
+def write_imgs(db_url, imgs, add_strict=False, attempt_replace=False,
+               timeout=DEFAULT_DB_TIMEOUT, keep_open=False):
+    '''
+    Writes a list of images and their metadata, as (filename, img_info) pairs,
+    through the imt-dbd daemon at db_url (see :func:`ImageMetaTag.dbd.parse_dbd_url`).
+    This returns when the daemon has committed them to the database.
+
+    If the daemon is not running, then the images are written directly to its
+    database file, by :func:`ImageMetaTag.db.write_img_to_dbfile` (with keep_open),
+    and a warning is printed the first time this happens for each socket.
+
+    Returns True if the images were written by the daemon.
+    '''
+    socket_path, db_file = parse_dbd_url(db_url)
+    message = {'op': 'write',
+               'rows': [[x, y] for x, y in imgs],
+               'add_strict': add_strict,
+               'attempt_replace': attempt_replace}
+    try:
+        # the daemon retries while the database is locked, so wait as long as it might:
+        sock = _connect(socket_path, timeout * DEFAULT_DB_ATTEMPTS)
+    except socket.error as sock_err:
+        if sock_err.errno not in (errno.ENOENT, errno.ECONNREFUSED):
+            raise
+        # the daemon is not there, so write directly:
+        if socket_path not in _WARNED_SOCKETS:
+            msg = 'WARNING: imt-dbd is not running on {} ({}), writing directly to {}'
+            print(msg.format(socket_path, sock_err, db_file))
+            _WARNED_SOCKETS.add(socket_path)
+        for img_filename, img_info in imgs:
+            db.write_img_to_dbfile(db_file, img_filename, img_info, add_strict=add_strict,
+                                   attempt_replace=attempt_replace, timeout=timeout,
+                                   keep_open=keep_open)
+        return False
+    _request(sock, socket_path, message)
+    return True
+
+
+class _WriteRequest(object):
+    'The images sent by one client, which are waiting to be written by the DbDaemon'
+    def __init__(self, rows, add_strict, attempt_replace):
+        self.rows = rows
+        self.add_strict = add_strict
+        self.attempt_replace = attempt_replace
+        self.error = None
+        self.done = threading.Event()
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    'Handles the messages from a client connection to a DbDaemon'
+    def handle(self):
+        daemon = self.server.imt_daemon
+        while True:
+            try:
+                message = recv_message(self.request)
+            except (IOError, ValueError) as err:
+                # (a ValueError is a message that is not valid JSON)
+                send_message(self.request, {'ok': False, 'error': str(err),
+                                            'type': type(err).__name__})
+                return
+            if message is None:
+                return
+            try:
+                reply = daemon.handle_message(message)
+            except Exception as err:
+                reply = {'ok': False, 'error': str(err), 'type': type(err).__name__}
+            send_message(self.request, reply)
+
+
+if hasattr(socket, 'AF_UNIX'):
+    class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        'The server for a DbDaemon, with a thread per client connection'
+        daemon_threads = True
+        # lots of processes can connect at once:
+        request_queue_size = socket.SOMAXCONN
+else:
+    # (Unix domain sockets are not available, on Windows, so there is no daemon)
+    _UnixServer = None
+
+
+class DbDaemon(object):
+    '''
+    The imt-dbd daemon, which owns an ImageMetaTag database file and writes
+    the images sent to it, over a Unix domain socket, by other processes (see
+    :mod:`ImageMetaTag.dbd`). It is usually run with the imt-dbd script, but
+    can be used directly::
+
+        daemon = ImageMetaTag.dbd.DbDaemon(db_file)
+        daemon.serve_forever()
+
+    A single writer thread writes everything that has been sent while it was
+    writing the last batch in one transaction (up to max_rows), so a busy
+    daemon writes large batches and a quiet one writes straight away. If a
+    batch fails, its requests are written one at a time, so only the request
+    that caused the problem gets the error.
+
+    Arguments:
+     * db_file - the database file to write to. If it does not exist, it \
+                 will be created.
+
+    Options:
+     * socket_path - the socket to listen on. Default is db_file with .sock \
+                     added, which can then be used as unix://db_file.sock
+     * max_rows - the maximum number of rows to write in one transaction.
+     * encode_tags - if the database is created, create it with encoded tags \
+                     (see :func:`ImageMetaTag.db.create_table_for_img_info`).
+     * db_timeout - change the database timeout (in seconds).
+     * db_attempts - change the number of attempts to write to the database.
+     * verbose - print a line for each batch written.
+
+    Objects:
+     * n_rows - the number of rows written to the database so far.
+     * n_batches - the number of batches (transactions) written so far.
+    '''
+    def __init__(self, db_file, socket_path=None, max_rows=10000, encode_tags=False,
+                 db_timeout=DEFAULT_DB_TIMEOUT, db_attempts=DEFAULT_DB_ATTEMPTS,
+                 verbose=False):
+        if max_rows < 1:
+            raise ValueError('max_rows must be >= 1')
+        self.db_file = os.path.abspath(db_file)
+        if socket_path is None:
+            socket_path = self.db_file + DBD_SOCKET_SUFFIX
+        self.socket_path = os.path.abspath(socket_path)
+        self.max_rows = max_rows
+        self.encode_tags = encode_tags
+        self.db_timeout = db_timeout
+        self.db_attempts = db_attempts
+        self.verbose = verbose
+
+        self.n_rows = 0
+        self.n_batches = 0
+        self._queue = queue.Queue()
+        # requests are only queued while this is True, so none are left behind on shutdown:
+        self._accepting = False
+        self._queue_lock = threading.Lock()
+        self._server = None
+        self._writer = None
+
+    def __repr__(self):
+        msg = 'DbDaemon("{}" on "{}"): {} rows written in {} batches'
+        return msg.format(self.db_file, self.socket_path, self.n_rows, self.n_batches)
+
+    def start(self):
+        '''
+        Starts listening on the socket, and writing to the database, in
+        background threads. Use :func:`ImageMetaTag.dbd.DbDaemon.shutdown` to stop.
+        '''
+        if _UnixServer is None:
+            raise OSError('imt-dbd needs Unix domain sockets, which are not available')
+        self._remove_stale_socket()
+        self._accepting = True
+        self._server = _UnixServer(self.socket_path, _RequestHandler)
+        self._server.imt_daemon = self
+        self._writer = threading.Thread(target=self._write_loop, name='imt-dbd writer')
+        self._writer.daemon = True
+        self._writer.start()
+        server_thread = threading.Thread(target=self._server.serve_forever,
+                                         name='imt-dbd server')
+        server_thread.daemon = True
+        server_thread.start()
+
+    def serve_forever(self):
+        'Starts the daemon, and runs until it is interrupted (by SIGINT/SIGTERM)'
+        import signal
+
+        def _stop(signum, frame):
+            'signal handler, to stop the daemon'
+            raise KeyboardInterrupt
+        signal.signal(signal.SIGTERM, _stop)
+        self.start()
+        if self.verbose:
+            print('{} imt-dbd writing to {}, listening on {}'.format(
+                db.dt_now_str(), self.db_file, self.socket_path))
+        try:
+            while self._writer.is_alive():
+                self._writer.join(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        '''
+        Stops accepting new connections, writes everything that has already
+        been received, and removes the socket. Clients that send images after
+        this get an error.
+        '''
+        with self._queue_lock:
+            self._accepting = False
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            db.rmfile(self.socket_path)
+        if self._writer is not None:
+            # (nothing more can be queued, so this is the last thing the writer gets)
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+
+    def _remove_stale_socket(self):
+        'Removes the socket file left by a daemon that was not shut down, if there is one'
+        if not os.path.exists(self.socket_path):
+            return
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except socket.error:
+            # nothing is listening, so it is stale:
+            db.rmfile(self.socket_path)
+            return
+        finally:
+            sock.close()
+        raise IOError('imt-dbd is already running on {}'.format(self.socket_path))
+
+    def handle_message(self, message):
+        'Handles a message from a client, and returns the reply'
+        op_name = message.get('op') if isinstance(message, dict) else None
+        if op_name == 'ping':
+            return {'ok': True, 'db_file': self.db_file,
+                    'n_rows': self.n_rows, 'n_batches': self.n_batches}
+        elif op_name == 'write':
+            write_req = _WriteRequest([(x, y) for x, y in message['rows']],
+                                      bool(message.get('add_strict')),
+                                      bool(message.get('attempt_replace')))
+            if write_req.rows:
+                with self._queue_lock:
+                    if not self._accepting:
+                        return {'ok': False, 'error': 'imt-dbd is shutting down',
+                                'type': 'IOError'}
+                    self._queue.put(write_req)
+                # wait for the writer, unless it has stopped:
+                while not write_req.done.wait(1):
+                    if self._writer is None or not self._writer.is_alive():
+                        return {'ok': False, 'error': 'imt-dbd writer has stopped',
+                                'type': 'IOError'}
+            if write_req.error is not None:
+                return {'ok': False, 'error': str(write_req.error),
+                        'type': type(write_req.error).__name__}
+            return {'ok': True, 'n_rows': len(write_req.rows)}
+        return {'ok': False, 'error': 'Unknown imt-dbd message: {}'.format(message),
+                'type': 'ValueError'}
+
+    def _write_loop(self):
+        'The writer thread, which writes the queued requests in batches'
+        try:
+            stopping = False
+            while not stopping:
+                write_req = self._queue.get()
+                if write_req is None:
+                    break
+                batch = [write_req]
+                n_rows = len(write_req.rows)
+                # and everything else that has been sent since the last batch:
+                while n_rows < self.max_rows:
+                    try:
+                        write_req = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if write_req is None:
+                        stopping = True
+                        break
+                    batch.append(write_req)
+                    n_rows += len(write_req.rows)
+                self._write_batch(batch)
+        finally:
+            db._close_pooled_connection(self.db_file)
+            # if the writer failed, nothing else will be written, so tell any waiting clients:
+            while True:
+                try:
+                    write_req = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if write_req is not None:
+                    write_req.error = IOError('imt-dbd writer has stopped')
+                    write_req.done.set()
+
+    def _write_batch(self, batch):
+        'Writes a batch of requests, in one transaction, and tells the clients'
+        time_start = time.time()
+        try:
+            db.retry_if_locked(lambda: self._write_requests(batch), self.db_file,
+                               db_timeout=self.db_timeout, db_attempts=self.db_attempts)
+        except Exception as err:
+            locked = isinstance(err, sqlite3.OperationalError) and 'database is locked' in repr(err)
+            if len(batch) > 1 and not locked:
+                # find the request that caused the problem:
+                for write_req in batch:
+                    self._write_batch([write_req])
+                return
+            # nothing in the batch was written, so every client gets the error:
+            for write_req in batch:
+                write_req.error = err
+        else:
+            n_rows = sum([len(x.rows) for x in batch])
+            self.n_rows += n_rows
+            self.n_batches += 1
+            if self.verbose:
+                print('{} imt-dbd wrote {} rows from {} requests in {:.3f} s'.format(
+                    db.dt_now_str(), n_rows, len(batch), time.time() - time_start))
+        for write_req in batch:
+            write_req.done.set()
+
+    def _write_requests(self, batch):
+        'Writes a batch of requests to the database, in one transaction'
+        dbcn, dbcr = db._pooled_db_file(self.db_file, batch[0].rows[0][1],
+                                        timeout=self.db_timeout,
+                                        encode_tags=self.encode_tags)
+        try:
+            for write_req in batch:
+                db.write_imgs_to_open_db(dbcr, write_req.rows,
+                                         add_strict=write_req.add_strict,
+                                         attempt_replace=write_req.attempt_replace)
+            dbcn.commit()
+        except:
+            # as write_img_to_dbfile, start again with a new connection:
+            db._close_pooled_connection(self.db_file)
+            raise
+
+
+def main(argv=None):
+    'Runs imt-dbd from the command line'
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Writes image metadata to an ImageMetaTag database, for other processes')
+    parser.add_argument('db_file', help='ImageMetaTag database file')
+    parser.add_argument('--socket', dest='socket_path', default=None,
+                        help='socket to listen on (default db_file{})'.format(DBD_SOCKET_SUFFIX))
+    parser.add_argument('--max-rows', dest='max_rows', type=int, default=10000,
+                        help='maximum number of rows to write in one transaction')
+    parser.add_argument('--encode-tags', dest='encode_tags', action='store_true',
+                        help='create the database with encoded tags')
+    parser.add_argument('--timeout', dest='db_timeout', type=float, default=DEFAULT_DB_TIMEOUT,
+                        help='database timeout, in seconds')
+    parser.add_argument('--verbose', '-v', action='store_true', dest='verbose',
+                        help='print a line for each batch written')
+    args = parser.parse_args(argv)
+    daemon = DbDaemon(args.db_file, socket_path=args.socket_path, max_rows=args.max_rows,
+                      encode_tags=args.encode_tags, db_timeout=args.db_timeout,
+                      verbose=args.verbose)
+    daemon.serve_forever()
+    if args.verbose:
+        print('{} imt-dbd stopped: {}'.format(db.dt_now_str(), daemon))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
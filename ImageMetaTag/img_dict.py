@@ -142,6 +142,63 @@ class ImageDict(object):
         outstr = self.dict_print(self.dict, indent=1, outstr=outstr)
         return outstr
 
+    @classmethod
+    def from_db(cls, db_file, tagorder, where=None, batch_size=10000,
+                immutable=False, **kwargs):
+        '''
+        Creates an ImageDict directly from a database file, written by
+        :mod:`ImageMetaTag.db`, with the levels of the dictionary given by
+        tagorder (a list of tag names) and the image filenames as the payload.
+
+        This is equivalent to reading the database, and appending the
+        output of :func:`ImageMetaTag.dict_heirachy_from_list` for each image,
+        but much quicker for large databases. The images are read in order
+        of their tags (see :func:`ImageMetaTag.db.iter_read`), so each one is
+        added to the branch of the dictionary that was added to last, or a
+        new branch, without merging dictionaries. Missing tags are read as
+        'None', and sorted with any images whose tag is 'None'. Only the tags in tagorder
+        are read, and the images are not all held in memory.
+
+        Options:
+         * where - a dict of tag names & acceptable values, to only use the \
+                   images that match (as \
+                   :func:`ImageMetaTag.db.select_dbfile_by_tags`).
+         * batch_size - the number of images to read from the database at a time.
+         * immutable - see :func:`ImageMetaTag.db.read`.
+
+        Any other keyword arguments (level_names, selector_animated etc.)
+        are passed to :class:`ImageMetaTag.ImageDict`.
+
+        Returns None if there are no images in the database (that match where).
+        '''
+        # (imported here, as ImageMetaTag.db imports from this module)
+        from ImageMetaTag import db
+
+        n_levels = len(tagorder)
+        out_dict = {}
+        # the values at each level of the last image, and the dict for each level
+        # of the branch that it was added to:
+        last_values = [None] * n_levels
+        branch = [out_dict] + [None] * (n_levels - 1)
+        for batch in db.iter_read(db_file, batch_size=batch_size, required_tags=tagorder,
+                                  where=where, yield_batches=True, immutable=immutable,
+                                  order_by=tagorder):
+            for img_file, img_info in batch:
+                values = [img_info[x] for x in tagorder]
+                # find the first level where this image differs from the last:
+                i_level = 0
+                while i_level < n_levels - 1 and values[i_level] == last_values[i_level]:
+                    i_level += 1
+                # and move to the branch from there, adding it if it is new:
+                for j_level in range(i_level, n_levels - 1):
+                    branch[j_level + 1] = branch[j_level].setdefault(values[j_level], {})
+                branch[-1][values[-1]] = img_file
+                last_values = values
+
+        if not out_dict:
+            return None
+        return cls(out_dict, **kwargs)
+
     def append(self, new_dict, devmode=False, skip_key_relist=False):
         '''
         appends a new dictionary (with a single element in each layer!) into
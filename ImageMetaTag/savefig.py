@@ -17,7 +17,6 @@ Released under BSD 3-Clause License. See LICENSE for more details.
 import os
 import sys
 import io
-import sqlite3
 import pdb
 from datetime import datetime
 import matplotlib.pyplot as plt
@@ -25,7 +24,7 @@ import matplotlib.pyplot as plt
 from PIL import Image, ImageChops, PngImagePlugin
 import numpy as np
 
-from ImageMetaTag import db, META_IMG_FORMATS, RESERVED_TAGS
+from ImageMetaTag import db, dbd, META_IMG_FORMATS, RESERVED_TAGS
 from ImageMetaTag import POSTPROC_IMG_FORMATS, DPI_IMG_FORMATS
 from ImageMetaTag import DEFAULT_DB_TIMEOUT, DEFAULT_DB_ATTEMPTS
 
@@ -40,7 +39,7 @@ def savefig(filename, fig=None, img_tags=None, img_format=None, img_converter=0,
             db_file=None, db_timeout=DEFAULT_DB_TIMEOUT,
             db_attempts=DEFAULT_DB_ATTEMPTS,
             db_replace=False, db_add_strict=False, db_full_paths=False,
-            verbose=False):
+            db_keep_open=False, verbose=False):
     '''
     A wrapper around matplotlib.pyplot.savefig, to include file size
     optimisation and image tagging.
@@ -64,7 +63,16 @@ def savefig(filename, fig=None, img_tags=None, img_format=None, img_converter=0,
                   interlace, transparency etc.)
      * db_file - a database file to be used by \
                  :func:`ImageMetaTag.db.write_img_to_dbfile` to store all \
-                 image metadata so they can be quickly accessed.
+                 image metadata so they can be quickly accessed. \
+                 This can also be a :class:`ImageMetaTag.db.BatchedDbWriter` \
+                 in which case the metadata is buffered and written in \
+                 batches (and the db_timeout, db_attempts, db_replace and \
+                 db_add_strict options of the writer are used instead). \
+                 It can also be the address of an imt-dbd daemon, \
+                 unix:///path/to/socket (see :mod:`ImageMetaTag.dbd`), \
+                 which writes to the database for all of the processes \
+                 saving images, or the directory of a sharded database \
+                 (see :mod:`ImageMetaTag.shards`).
      * db_full_paths - by default, if the images can be expressed as relative \
                        path to the database file then the database will \
                        contain only relative links, unless db_full_paths is \
@@ -72,20 +80,21 @@ def savefig(filename, fig=None, img_tags=None, img_format=None, img_converter=0,
      * db_timeout - change the database timeout (in seconds).
      * db_attempts - change the number of attempts to write to the database.
      * db_replace - if True, an image's metadata will be replaced in the \
-                    database if it already exists. This can be slow, and the \
+                    database if it already exists (any tags that are not in \
+                    img_tags keep their value). This can be slow, and the \
                     metadata is usually the same so the default is \
                     db_replace=False.
      * db_add_strict - if True, any attempt to add an image whose metadata \
                        tag_names are not present in a pre-existing database \
                        will result in a ValueError being raised. \
                        If False, then adding a new metadata tag to the \
-                       database will cause it be rewritten with the new item \
-                       as a new column. All pre-existing images will have \
-                       the new tag set to 'None'. It is best to avoid using \
-                       this functionality as it can be slow for large \
-                       databases. Instead, all images should be ideally have \
-                       all expected metadata tags included from the start \
-                       but set to 'None' where they are not used.
+                       database will add it as a new column. All \
+                       pre-existing images will have the new tag set to \
+                       'None'.
+     * db_keep_open - if True, the database connection is kept open, and \
+                      reused by the next call to savefig with the same \
+                      db_file, which is much quicker when saving a lot of \
+                      images (see :func:`ImageMetaTag.db.write_img_to_dbfile`).
      * dpi - change the image resolution passed into matplotlib.savefig.
      * keep_open - by default, this savefig wrapper closes the figure after \
                    use, except if keep_open is True.
@@ -184,43 +193,40 @@ def savefig(filename, fig=None, img_tags=None, img_format=None, img_converter=0,
         if verbose:
             db_st = datetime.now()
 
+        if isinstance(db_file, db.BatchedDbWriter):
+            db_writer = db_file
+            db_file = db_writer.db_file
+        else:
+            db_writer = None
+
         # if the image path can be expressed as a relative path compared
         # to the database file, then do so (unless told otherwise).
-        db_dir = os.path.split(db_file)[0]
+        if dbd.is_dbd_url(db_file):
+            db_dir = os.path.split(dbd.parse_dbd_url(db_file)[1])[0]
+        elif os.path.isdir(db_file):
+            # a sharded database, with its shard files in that directory:
+            db_dir = db_file
+        else:
+            db_dir = os.path.split(db_file)[0]
         if filename.startswith(db_dir) and not db_full_paths:
             db_filename = os.path.relpath(filename, db_dir)
         else:
             db_filename = filename
 
-        wrote_db = False
-        n_tries = 1
-        while not wrote_db and n_tries <= db_attempts:
-            try:
+        if db_writer is not None:
+            # the writer handles its own retries when it flushes:
+            db_writer.add(db_filename, img_tags)
+        else:
+            def _write_db():
+                'writes the image metadata, for db.retry_if_locked'
                 db.write_img_to_dbfile(db_file, db_filename, img_tags,
                                        timeout=db_timeout,
                                        attempt_replace=db_replace,
-                                       add_strict=db_add_strict)
-                wrote_db = True
-            except sqlite3.OperationalError as op_err:
-                if 'database is locked' in repr(op_err):
-                    # database being locked is what the retries and timeouts
-                    # are for:
-                    msg = ('{} database timeout for image "{}", writing to '
-                           'file "{}", {} s')
-                    print(msg.format(db.dt_now_str(),
-                                     db_file,
-                                     write_file,
-                                     n_tries * db_timeout))
-                    n_tries += 1
-                else:
-                    # everything else needs to be reported and raised
-                    # immediately:
-                    msg = '{} for file {}'.format(op_err, db_file)
-                    raise sqlite3.OperationalError(msg)
-            except Exception:
-                raise
-        if n_tries > db_attempts:
-            raise sqlite3.OperationalError(op_err)
+                                       add_strict=db_add_strict,
+                                       keep_open=db_keep_open)
+            action = 'for image "{}", writing to'.format(write_file)
+            db.retry_if_locked(_write_db, db_file, db_timeout=db_timeout,
+                               db_attempts=db_attempts, action=action)
         if verbose:
             msg = 'Database write took: {}'
             print(msg.format(str(datetime.now() - db_st)))
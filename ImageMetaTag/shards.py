@@ -0,0 +1,569 @@
+'''
+This module contains the functions for a sharded ImageMetaTag database, where
+the images are split between several database files, in a directory, by the
+value of one of their tags (the shard tag, such as 'plot type'). Each shard is
+an ordinary ImageMetaTag database file, which is much smaller, and so quicker
+to read, vacuum and back up, than a single database file of all the images.
+
+The directory contains a small manifest, imt_shards.json, which names the
+shard tag::
+
+    {"format": "ImageMetaTag shards", "version": 1, "shard_tag": "plot type"}
+
+along with the shard files, named imt_shard_<hash>.db from a hash of the value
+of the shard tag. As the shard for an image is found from its tag value, the
+manifest does not change as new shards are added, so any number of processes
+can write to a sharded database at the same time.
+
+The directory of a sharded database can be used as the db_file for
+:func:`ImageMetaTag.savefig`, :func:`ImageMetaTag.db.write_img_to_dbfile`,
+:class:`ImageMetaTag.db.BatchedDbWriter`, :func:`ImageMetaTag.db.read`,
+:func:`ImageMetaTag.db.select_dbfile_by_tags` and
+:func:`ImageMetaTag.db.del_plots_from_dbfile`, which then use the functions
+here. Reads and selects that give the values of the shard tag only read those
+shards. Everything else reads all of the shards, in parallel threads.
+
+A sharded database is created with :func:`ImageMetaTag.shards.create`, or
+from an existing database file with :func:`ImageMetaTag.shards.split_db_file`.
+
+(C) Crown copyright Met Office. All rights reserved.
+Released under BSD 3-Clause License. See LICENSE for more details.
+'''
+
+import os
+import json
+import bisect
+import collections
+import fnmatch
+import hashlib
+import random
+import sqlite3
+import threading
+from multiprocessing.pool import ThreadPool
+
+from ImageMetaTag import db
+from ImageMetaTag import DEFAULT_DB_TIMEOUT, DEFAULT_DB_ATTEMPTS
+
+# the name of the manifest, in the directory of a sharded database:
+SHARD_MANIFEST = 'imt_shards.json'
+SHARD_FORMAT = 'ImageMetaTag shards'
+SHARD_VERSION = 1
+# the shard files are named SHARD_PREFIX + a hash of the tag value + SHARD_SUFFIX:
+SHARD_PREFIX = 'imt_shard_'
+SHARD_SUFFIX = '.db'
+# the maximum number of threads used to read the shards at once:
+MAX_SHARD_THREADS = 8
+
+# the manifests that have been read, by file, along with the stat of the file:
+_MANIFESTS = {}
+
+
+def create(shard_dir, shard_tag):
+    '''
+    Creates a sharded database, in the directory shard_dir, where the images
+    are split between the shards by the value of their shard_tag. The
+    directory is created if needed. If the sharded database already exists,
+    with the same shard_tag, it is left as it is.
+
+    Returns the manifest, as a dict.
+    '''
+    manifest = read_manifest(shard_dir)
+    if manifest is not None:
+        if manifest['shard_tag'] != shard_tag:
+            msg = 'Database "{}" is already sharded by "{}", not "{}"'
+            raise ValueError(msg.format(shard_dir, manifest['shard_tag'], shard_tag))
+        return manifest
+    if os.path.exists(shard_dir) and not os.path.isdir(shard_dir):
+        msg = 'Cannot create a sharded database "{}" as it is not a directory'
+        raise ValueError(msg.format(shard_dir))
+    if not os.path.isdir(shard_dir):
+        try:
+            os.makedirs(shard_dir)
+        except OSError:
+            # another process may have just created it:
+            if not os.path.isdir(shard_dir):
+                raise
+
+    manifest = {'format': SHARD_FORMAT, 'version': SHARD_VERSION, 'shard_tag': shard_tag}
+    # write to a temporary file and rename it, so the manifest is never seen half written:
+    manifest_file = os.path.join(shard_dir, SHARD_MANIFEST)
+    tmp_file = '{}.{}.tmp'.format(manifest_file, os.getpid())
+    with open(tmp_file, 'w') as file_handle:
+        json.dump(manifest, file_handle)
+    if hasattr(os, 'replace'):
+        os.replace(tmp_file, manifest_file)
+    else:
+        os.rename(tmp_file, manifest_file)
+    return read_manifest(shard_dir)
+
+
+def read_manifest(shard_dir):
+    '''
+    Reads the manifest of a sharded database, and returns it as a dict,
+    or None if shard_dir is not a sharded database.
+
+    The manifest is kept in memory, and only read again if the file changes.
+    '''
+    manifest_file = os.path.abspath(os.path.join(shard_dir, SHARD_MANIFEST))
+    try:
+        stat = os.stat(manifest_file)
+    except OSError:
+        return None
+    file_id = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime)
+    cached = _MANIFESTS.get(manifest_file)
+    if cached is not None and cached[0] == file_id:
+        return cached[1]
+
+    with open(manifest_file) as file_handle:
+        manifest = json.load(file_handle)
+    if manifest.get('format') != SHARD_FORMAT or 'shard_tag' not in manifest:
+        msg = 'File "{}" is not the manifest of a sharded ImageMetaTag database'
+        raise ValueError(msg.format(manifest_file))
+    if manifest.get('version', 0) > SHARD_VERSION:
+        msg = 'Sharded database "{}" is version {}, but only up to {} can be used'
+        raise ValueError(msg.format(shard_dir, manifest['version'], SHARD_VERSION))
+    # (json gives unicode strings in python2, but tag names are str):
+    manifest['shard_tag'] = str(manifest['shard_tag'])
+    _MANIFESTS[manifest_file] = (file_id, manifest)
+    return manifest
+
+
+def _shard_tag(shard_dir):
+    'The shard tag of a sharded database, raising a ValueError if it is not one'
+    manifest = read_manifest(shard_dir)
+    if manifest is None:
+        msg = 'Directory "{}" is not a sharded database, as it has no {}'
+        raise ValueError(msg.format(shard_dir, SHARD_MANIFEST))
+    return manifest['shard_tag']
+
+
+def shard_file(shard_dir, value):
+    '''
+    The shard file, in the sharded database shard_dir, for the images with
+    the given value of the shard tag. The file may not exist yet.
+    '''
+    if not isinstance(value, bytes):
+        value = u'{}'.format(value).encode('utf-8')
+    shard_name = '{}{}{}'.format(SHARD_PREFIX, hashlib.sha1(value).hexdigest()[:16],
+                                 SHARD_SUFFIX)
+    return os.path.join(shard_dir, shard_name)
+
+
+def shard_file_for_img(shard_dir, img_info):
+    '''
+    The shard file, in the sharded database shard_dir, for an image with
+    the metadata img_info. A ValueError is raised if the image does not
+    have the shard tag.
+    '''
+    shard_tag = _shard_tag(shard_dir)
+    if shard_tag not in img_info:
+        msg = 'Image metadata needs a "{}" tag, to write it to the sharded database "{}"'
+        raise ValueError(msg.format(shard_tag, shard_dir))
+    return shard_file(shard_dir, img_info[shard_tag])
+
+
+def shard_files(shard_dir, values=None):
+    '''
+    Lists the shard files of a sharded database that exist: all of them,
+    or only those for a list of values of the shard tag.
+    '''
+    if values is None:
+        pattern = '{}*{}'.format(SHARD_PREFIX, SHARD_SUFFIX)
+        shard_paths = [os.path.join(shard_dir, x)
+                       for x in fnmatch.filter(os.listdir(shard_dir), pattern)]
+    else:
+        shard_paths = set([shard_file(shard_dir, x) for x in values])
+    return sorted([x for x in shard_paths if os.path.isfile(x)])
+
+
+def group_by_shard(shard_dir, img_rows):
+    '''
+    Groups an iterable of (filename, img_info) pairs by the shard they
+    belong to, in the sharded database shard_dir.
+
+    Returns a list of (shard file, list of (filename, img_info) pairs).
+    '''
+    shard_tag = _shard_tag(shard_dir)
+    shard_rows = collections.OrderedDict()
+    # (the same values come up many times, so only hash each one once):
+    value_shards = {}
+    for img_row in img_rows:
+        try:
+            value = img_row[1][shard_tag]
+        except KeyError:
+            msg = 'Image metadata needs a "{}" tag, to write it to the sharded database "{}"'
+            raise ValueError(msg.format(shard_tag, shard_dir))
+        shard_path = value_shards.get(value)
+        if shard_path is None:
+            shard_path = value_shards[value] = shard_file(shard_dir, value)
+        shard_rows.setdefault(shard_path, []).append(img_row)
+    return list(shard_rows.items())
+
+
+def _where_shard_files(shard_dir, where):
+    '''
+    The shard files that can contain images that match where (a dict of tag
+    names & acceptable values), or None if shard_dir is not a sharded database.
+    '''
+    manifest = read_manifest(shard_dir)
+    if manifest is None:
+        return None
+    if not where or manifest['shard_tag'] not in where:
+        return shard_files(shard_dir)
+    values = where[manifest['shard_tag']]
+    if not isinstance(values, (list, tuple)):
+        values = [values]
+    return shard_files(shard_dir, values)
+
+
+def _map_shards(shard_op, shard_args, n_threads=None):
+    '''
+    Returns [shard_op(x) for x in shard_args], with the calls made in up to
+    n_threads parallel threads (default MAX_SHARD_THREADS). sqlite does not hold
+    python's global interpreter lock while it reads, so the shards are
+    read at the same time.
+    '''
+    if n_threads is None:
+        n_threads = MAX_SHARD_THREADS
+    n_threads = min(n_threads, len(shard_args))
+    if n_threads <= 1:
+        return [shard_op(x) for x in shard_args]
+    pool = ThreadPool(n_threads)
+    try:
+        return pool.map(shard_op, shard_args)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _shard_where(where, tag_set):
+    '''
+    Returns the where (a dict of tag names & acceptable values) to use for a
+    shard that has the tags in tag_set. As in a single database file, images
+    in a shard without one of the tags have a value of 'None' for it, so the
+    tag is left out if 'None' is acceptable. Returns None if none of the
+    images in the shard can match.
+    '''
+    shard_where = {}
+    if not where:
+        return shard_where
+    for tag_name, tag_val in where.items():
+        if tag_name in tag_set:
+            shard_where[tag_name] = tag_val
+        elif isinstance(tag_val, (list, tuple)):
+            if 'None' not in tag_val:
+                return None
+        elif tag_val != 'None':
+            return None
+    return shard_where
+
+
+def _read_shard_tags(shard_paths, immutable=False, db_timeout=DEFAULT_DB_TIMEOUT,
+                     db_attempts=DEFAULT_DB_ATTEMPTS, n_threads=None):
+    '''
+    Reads the tag names in each of the shard_paths, in parallel threads.
+
+    Returns a dict, by shard file, of the list of its tag names, and a list
+    of all the tag names, in any shard, in the order they are first found.
+    '''
+    def _read_tags(shard_path):
+        'reads the tag names of one shard, for _map_shards'
+        def _read_db():
+            'opens the shard and reads its schema, for retry_if_locked'
+            dbcn, dbcr = db.open_db_file(shard_path, timeout=db_timeout, read_only=True,
+                                         immutable=immutable)
+            try:
+                # (the first field is the filename):
+                return db.get_table_schema(dbcr)['fields'][1:]
+            finally:
+                dbcn.close()
+
+        return db.retry_if_locked(_read_db, shard_path, db_timeout=db_timeout,
+                                  db_attempts=db_attempts, action='reading from')
+
+    tags_by_shard = dict(zip(shard_paths, _map_shards(_read_tags, shard_paths,
+                                                      n_threads=n_threads)))
+    all_tags = collections.OrderedDict()
+    for shard_path in shard_paths:
+        for tag_name in tags_by_shard[shard_path]:
+            all_tags[tag_name] = True
+    return tags_by_shard, list(all_tags)
+
+
+def read(shard_dir, required_tags=None, tag_strings=None,
+         db_timeout=DEFAULT_DB_TIMEOUT, db_attempts=DEFAULT_DB_ATTEMPTS,
+         n_samples=None, sample_seed=None, immutable=False, where=None,
+         tag_codes=False, n_threads=None):
+    '''
+    Reads a sharded database, as :func:`ImageMetaTag.db.read`, which describes
+    the options and what is returned. Only the shards that can have images
+    that match where are read, in up to n_threads parallel threads (default
+    MAX_SHARD_THREADS).
+
+    The result is the same as for a single database file of all the images.
+    Shards can have different tags, so the tags of all the shards are found
+    first, and images in a shard without one of them have a value of 'None'
+    for it. A ValueError is only raised if a required tag, or a tag in
+    where, is not in any of the shards.
+
+    A random sample, of n_samples, is taken from all of the images that
+    match, so is split between the shards in proportion to the number of
+    matching images in each of them.
+
+    Each shard has its own tag codes, so tag_codes cannot be used.
+    '''
+    if tag_codes:
+        raise ValueError('tag_codes cannot be read from a sharded database')
+    shard_paths = _where_shard_files(shard_dir, where)
+    if shard_paths is None:
+        return None, None
+    all_paths = shard_files(shard_dir)
+    if not all_paths:
+        # no images have been written to the database yet:
+        return None, None
+
+    # all the tags, in all the shards, as a single database file would have:
+    tags_by_shard, all_tags = _read_shard_tags(all_paths, immutable=immutable,
+                                               db_timeout=db_timeout,
+                                               db_attempts=db_attempts,
+                                               n_threads=n_threads)
+    if not all_tags:
+        return None, None
+    # this checks the required_tags, as for a single database file:
+    use_tags = [x[1] for x in db._fields_to_read([db.SQLITE_IMG_INFO_FNAME] + all_tags,
+                                                 required_tags=required_tags)]
+    missing_tags = [x for x in (where or {}) if x not in all_tags]
+    if missing_tags:
+        msg = 'Database does not contain all of the tags to select by, missing: {}'
+        raise ValueError(msg.format(missing_tags))
+    # (a shard that has been created since the tags were read has no tags, so is skipped):
+    shard_paths = [x for x in shard_paths if tags_by_shard.get(x)]
+
+    if n_samples is None:
+        shard_samples = [None] * len(shard_paths)
+    else:
+        shard_samples = _split_sample(shard_paths, tags_by_shard, n_samples,
+                                      sample_seed=sample_seed, where=where,
+                                      immutable=immutable, db_timeout=db_timeout,
+                                      db_attempts=db_attempts, n_threads=n_threads)
+
+    # all the shards add to one pool of strings, so they share the same strings:
+    if isinstance(tag_strings, list):
+        string_pool = dict([(x, x) for x in tag_strings])
+    else:
+        string_pool = tag_strings
+    process_lock = threading.Lock()
+
+    def _read_shard(shard_arg):
+        'reads the images from one shard, for _map_shards'
+        shard_path, shard_n_samples = shard_arg
+        shard_tags = tags_by_shard[shard_path]
+        shard_where = _shard_where(where, set(shard_tags))
+        if shard_n_samples == 0 or shard_where is None:
+            return [], {}
+        if shard_n_samples is None or sample_seed is None:
+            shard_seed = None
+        else:
+            shard_seed = '{}:{}'.format(sample_seed, os.path.basename(shard_path))
+        if required_tags is None:
+            shard_required = None
+        else:
+            shard_required = [x for x in required_tags if x in shard_tags]
+        # the tags this shard does not have, which are 'None' for its images:
+        fill_tags = [x for x in use_tags if x not in shard_tags]
+
+        def _read_db():
+            'opens the shard and reads it, for retry_if_locked'
+            dbcn, dbcr = db.open_db_file(shard_path, timeout=db_timeout, read_only=True,
+                                         immutable=immutable)
+            try:
+                db_contents = db._select_rows(dbcr, required_tags=shard_required,
+                                              n_samples=shard_n_samples,
+                                              sample_seed=shard_seed, where=shard_where)
+                # the rows from each shard are processed one at a time, as
+                # they share the string pool (and it needs the GIL anyway):
+                with process_lock:
+                    shard_fnames, shard_dict = db.process_select_star_from(
+                        db_contents, dbcr, required_tags=shard_required,
+                        tag_strings=string_pool)
+                    if fill_tags:
+                        none_str = 'None'
+                        if string_pool is not None:
+                            none_str = string_pool.setdefault(none_str, none_str)
+                        for img_info in shard_dict.values():
+                            for tag_name in fill_tags:
+                                img_info.setdefault(tag_name, none_str)
+                    return shard_fnames, shard_dict
+            except sqlite3.OperationalError as op_err:
+                if 'no such table: {}'.format(db.SQLITE_IMG_INFO_TABLE) in repr(op_err):
+                    return [], {}
+                raise
+            finally:
+                dbcn.close()
+
+        return db.retry_if_locked(_read_db, shard_path, db_timeout=db_timeout,
+                                  db_attempts=db_attempts, action='reading from')
+
+    shard_results = _map_shards(_read_shard, list(zip(shard_paths, shard_samples)),
+                                n_threads=n_threads)
+    filename_list = []
+    out_dict = {}
+    for shard_fnames, shard_dict in shard_results:
+        filename_list.extend(shard_fnames)
+        out_dict.update(shard_dict)
+    if isinstance(tag_strings, list):
+        # add the new strings to the list, as for a single database:
+        known_strings = set(tag_strings)
+        tag_strings.extend([x for x in string_pool if x not in known_strings])
+    return filename_list, out_dict
+
+
+def _split_sample(shard_paths, tags_by_shard, n_samples, sample_seed=None, where=None,
+                  immutable=False, db_timeout=DEFAULT_DB_TIMEOUT,
+                  db_attempts=DEFAULT_DB_ATTEMPTS, n_threads=None):
+    '''
+    Splits a random sample of n_samples images, from all of the shards
+    (shard_paths, with their tag names in tags_by_shard), between the shards.
+    This is done as if the sample was taken from all the images that match
+    where, so each shard's part of the sample is in proportion to the number
+    of matching images in it.
+
+    Returns a list of the number of images to sample from each shard.
+    '''
+    if not isinstance(n_samples, int):
+        raise ValueError('n_samples must be an integer')
+    elif n_samples < 1:
+        raise ValueError('n_samples must be > 1')
+
+    def _count_shard(shard_path):
+        'counts the images in a shard that match where, for _map_shards'
+        shard_where = _shard_where(where, set(tags_by_shard[shard_path]))
+        if shard_where is None:
+            return 0
+
+        def _count_db():
+            'opens the shard and counts the images, for retry_if_locked'
+            dbcn, dbcr = db.open_db_file(shard_path, timeout=db_timeout, read_only=True,
+                                         immutable=immutable)
+            try:
+                _, where_command, where_values = db._select_clauses(dbcr, where=shard_where)
+                count_com = 'SELECT COUNT(*) FROM {}'.format(db.SQLITE_IMG_INFO_TABLE)
+                if where_command:
+                    count_com += ' WHERE {}'.format(where_command)
+                return dbcr.execute(count_com, where_values).fetchone()[0]
+            finally:
+                dbcn.close()
+
+        return db.retry_if_locked(_count_db, shard_path, db_timeout=db_timeout,
+                                  db_attempts=db_attempts, action='reading from')
+
+    shard_counts = _map_shards(_count_shard, shard_paths, n_threads=n_threads)
+    # pick the positions of the sample, in all of the images, then see which
+    # shard each of them is in:
+    n_imgs = sum(shard_counts)
+    rng = random.Random(sample_seed)
+    sample_pos = sorted(rng.sample(range(n_imgs), min(n_samples, n_imgs)))
+    shard_samples = []
+    shard_end = 0
+    i_pos = 0
+    for count in shard_counts:
+        shard_end += count
+        i_end = bisect.bisect_left(sample_pos, shard_end)
+        shard_samples.append(i_end - i_pos)
+        i_pos = i_end
+    return shard_samples
+
+
+def select(shard_dir, select_tags, immutable=False, required_tags=None, n_threads=None):
+    '''
+    Selects the images from a sharded database that match a dict of tag
+    names & acceptable values, for :func:`ImageMetaTag.db.select_dbfile_by_tags`.
+    If the select_tags give the values of the shard tag, only those shards
+    are read.
+
+    Returns None if shard_dir is not a sharded database.
+    '''
+    if read_manifest(shard_dir) is None:
+        return None
+    if len(select_tags) > 0:
+        # keep a record of what is selected, to advise on indexes:
+        db.INDEX_ADVISOR.record(select_tags)
+    return read(shard_dir, required_tags=required_tags, immutable=immutable,
+                where=select_tags, n_threads=n_threads)
+
+
+def del_plots(shard_dir, filenames, shard_values=None, do_vacuum=True,
+              allow_retries=True, db_timeout=DEFAULT_DB_TIMEOUT,
+              db_attempts=DEFAULT_DB_ATTEMPTS, skip_warning=False,
+              max_lock_seconds=0.25, n_threads=None):
+    '''
+    Deletes a list of files from a sharded database, for
+    :func:`ImageMetaTag.db.del_plots_from_dbfile`, which describes the options.
+
+    The shard tag values of the images are not known from their filenames, so
+    they are deleted from every shard, in parallel threads, unless the
+    shard_values (a value, or a list of values, of the shard tag) say which
+    shards they are in. Only the shards that images were deleted from are
+    vacuumed.
+
+    Returns the number of images deleted.
+    '''
+    if read_manifest(shard_dir) is None or len(filenames) == 0:
+        return 0
+    if shard_values is None:
+        shard_paths = shard_files(shard_dir)
+    elif isinstance(shard_values, (list, tuple)):
+        shard_paths = shard_files(shard_dir, shard_values)
+    else:
+        shard_paths = shard_files(shard_dir, [shard_values])
+
+    def _del_shard(shard_path):
+        'deletes the files from one shard, for _map_shards'
+        return db.del_plots_from_dbfile(shard_path, filenames, do_vacuum=do_vacuum,
+                                        allow_retries=allow_retries,
+                                        db_timeout=db_timeout, db_attempts=db_attempts,
+                                        skip_warning=True,
+                                        max_lock_seconds=max_lock_seconds)
+
+    n_deleted = sum(_map_shards(_del_shard, shard_paths, n_threads=n_threads))
+    n_missing = len(set(filenames)) - n_deleted
+    if n_missing > 0 and not skip_warning:
+        msg = 'WARNING: {} of the files to delete were not in sharded database "{}"'
+        print(msg.format(n_missing, shard_dir))
+    return n_deleted
+
+
+def split_db_file(db_file, shard_dir, shard_tag, encode_tags=False, batch_size=10000,
+                  db_timeout=DEFAULT_DB_TIMEOUT):
+    '''
+    Splits an ImageMetaTag database file into a sharded database, in the
+    directory shard_dir, by the value of the shard_tag (see
+    :func:`ImageMetaTag.shards.create`). The database file is left as it is.
+
+    The images are read in order of their shard_tag, batch_size at a time, so
+    each shard is written in a few large transactions. Images that are
+    already in the sharded database are not changed.
+
+    Options:
+     * encode_tags - create the shards with encoded tags (see \
+                     :func:`ImageMetaTag.db.create_table_for_img_info`).
+     * batch_size - the number of images to read, and write, at a time.
+     * db_timeout - change the database timeout (in seconds).
+
+    Returns the number of images read from db_file.
+    '''
+    create(shard_dir, shard_tag)
+    n_imgs = 0
+    for img_rows in db.iter_read(db_file, batch_size=batch_size, order_by=[shard_tag],
+                                 yield_batches=True, db_timeout=db_timeout):
+        for shard_path, shard_rows in group_by_shard(shard_dir, img_rows):
+            dbcn, dbcr = db.open_or_create_db_file(shard_path, shard_rows[0][1],
+                                                   timeout=db_timeout,
+                                                   encode_tags=encode_tags)
+            try:
+                db.write_imgs_to_open_db(dbcr, shard_rows)
+                dbcn.commit()
+            finally:
+                dbcn.close()
+        n_imgs += len(img_rows)
+    return n_imgs
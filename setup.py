@@ -27,7 +27,7 @@ setup_args = dict(
                    'Programming Language :: Python :: 3.10',
                   ],
     package_data = {'ImageMetaTag': ['javascript/*']},
-    scripts = ['bin/rm_imt_images'],
+    scripts = ['bin/rm_imt_images', 'bin/imt-dbd'],
 )
 
 if __name__ == '__main__':
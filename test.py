@@ -20,6 +20,7 @@ import copy
 import random
 import platform
 import math
+import sqlite3
 import pdb
 from multiprocessing import Pool
 from datetime import datetime
@@ -245,6 +246,21 @@ def plot_random_data(random_data, i_rand, plot_col, col_name, trims, borders,
                     check_img_tags(outfile, img_tags)
                     img_count += 1
 
+    # save the last image again, replacing its database entry, with the
+    # database connection kept open after the write:
+    imt.savefig(outfile, do_trim=trim, trim_border=border,
+                do_thumb=True, img_converter=compression,
+                img_tags=img_tags, keep_open=True,
+                verbose=imt_verbose,
+                db_file=imt_db, db_timeout=db_timeout,
+                db_replace=True, db_keep_open=True,
+                dpi=dpi,
+                logo_file=LOGO_FILE, logo_width=LOGO_SIZE,
+                logo_padding=LOGO_PADDING, logo_pos=0)
+    check_img_tags(outfile, img_tags)
+    # and close the connection kept open by savefig:
+    imt.db.close_pooled_connections()
+
     plt.close()
     outfile = '%s/dist_%s_%s.%s' % (img_savedir, n_rolls, plot_col, img_format)
     if PY3:
@@ -311,6 +327,26 @@ def plot_random_data(random_data, i_rand, plot_col, col_name, trims, borders,
                     # and check:
                     check_img_tags(outfile, img_tags)
                     img_count += 1
+
+    # save the last image again, replacing its database entry, with the
+    # database written to in batches rather than one image at a time:
+    db_writer = imt.db.BatchedDbWriter(imt_db, max_rows=5, attempt_replace=True,
+                                       db_timeout=db_timeout)
+    imt.savefig(outfile, do_trim=trim, trim_border=border,
+                do_thumb=True, img_converter=compression,
+                img_tags=img_tags, keep_open=True,
+                verbose=imt_verbose,
+                db_file=db_writer,
+                dpi=dpi,
+                logo_file=[LOGO_FILE, LOGO_FILE],
+                logo_height=LOGO_SIZE//2,
+                logo_padding=LOGO_PADDING, logo_pos=[1, 1])
+    check_img_tags(outfile, img_tags)
+    # write out anything left in the buffer:
+    db_writer.close()
+    if db_writer.n_rows != 1:
+        raise ValueError('BatchedDbWriter reports writing the wrong number of images')
+    print(db_writer)
     plt.close()
 
     # NOTE: in actual usage, it's easier to refer to the database when you
@@ -397,6 +433,30 @@ def define_img_dict_in_tuple(in_tuple):
     return img_dict
 
 
+def write_imgs_to_dbd(in_tuple):
+    '''
+    Writes a list of (filename, img_info) pairs, one at a time, to an imt-dbd
+    daemon (or its database, if it is not running), as savefig would.
+    The input is a tuple so it can be parallelised.
+    '''
+    db_url, imgs = in_tuple
+    for img_file, img_info in imgs:
+        imt.db.write_img_to_dbfile(db_url, img_file, img_info)
+
+
+def make_test_db(db_file, img_rows, encode_tags=False):
+    '''
+    Creates a new database file (replacing any that is there) and writes a
+    list of (filename, img_info) pairs to it, in one transaction.
+    '''
+    img_rows = list(img_rows)
+    dbcn, dbcr = imt.db.open_or_create_db_file(db_file, img_rows[0][1], restart_db=True,
+                                               encode_tags=encode_tags)
+    imt.db.write_imgs_to_open_db(dbcr, img_rows)
+    dbcn.commit()
+    dbcn.close()
+
+
 def make_test_css(webdir):
     'writes out a test.css file in a specified directory'
 
@@ -558,6 +618,37 @@ def test_key_sorting():
     return not failed
 
 
+def benchmark_tag_strings(webdir, n_imgs=20000, n_tags=5,
+                          n_uniques=(10, 100, 1000, 10000)):
+    '''
+    Times reading a database with and without tag_strings, as the number
+    of unique tag values increases. With tag_strings, the time should
+    not increase much with the number of unique values.
+    '''
+    bench_db = '{}/bench_tag_strings.db'.format(webdir)
+    tag_names = ['tag {}'.format(i_tag) for i_tag in range(n_tags)]
+    print('Database read timings for {} images and {} tags:'.format(n_imgs, n_tags))
+    for n_unique in n_uniques:
+        img_rows = []
+        for i_img in range(n_imgs):
+            img_info = {}
+            for i_tag, tag_name in enumerate(tag_names):
+                img_info[tag_name] = 'value {}'.format((i_img * (i_tag + 1)) % n_unique)
+            img_rows.append(('img_{}.png'.format(i_img), img_info))
+        make_test_db(bench_db, img_rows)
+
+        date_start = datetime.now()
+        imt.db.read(bench_db)
+        dt_plain = (datetime.now() - date_start).total_seconds()
+        tag_strings = []
+        date_start = datetime.now()
+        imt.db.read(bench_db, tag_strings=tag_strings)
+        dt_strings = (datetime.now() - date_start).total_seconds()
+        msg = '  {:>6} unique values: {:.3f} s, {:.3f} s with tag_strings'
+        print(msg.format(len(tag_strings), dt_plain, dt_strings))
+    imt.db.rm_db_file(bench_db)
+
+
 def test_compare_img_tags(img_tags1, name1, img_tags2, name2):
     '''
     Tests a set of images and metadata tags.
@@ -800,6 +891,10 @@ def __main__():
         # the database delete test later on will mess this up:
         test_compare_img_tags(images_and_tags, 'plot dict',
                               db_img_tags, 'database dict')
+    # the ImageDict can also be made directly from the database:
+    db_img_dict = imt.ImageDict.from_db(imt_db, tagorder, level_names=sel_names_list)
+    if db_img_dict.dict != img_dict.dict or db_img_dict.keys != img_dict.keys:
+        raise ValueError('ImageDict made from the database differs from the appended ImageDict')
 
     # For memory optimisation of large image databases, we want to make sure
     # the dictionary we get back is as small as possible in memory:
@@ -829,6 +924,304 @@ def __main__():
     imt.db.del_plots_from_dbfile(imt_db, del_img)
     # now put it back in:
     imt.db.write_img_to_dbfile(imt_db, del_img, del_tags)
+
+    # test writing many images at once, to a copy of the database:
+    all_imgs, all_img_tags = imt.db.read(imt_db)
+    bulk_db = '{}/imt_bulk.db'.format(webdir)
+    for img_info in all_img_tags.values():
+        img_info['plot owner'] = 'bulk update'
+    # (without UPSERT, in older versions of sqlite, the tags should be updated the same way)
+    has_upsert = imt.db.SQLITE_HAS_UPSERT
+    for use_upsert in sorted(set([has_upsert, False])):
+        imt.db.SQLITE_HAS_UPSERT = use_upsert
+        make_test_db(bulk_db, imt.db.read(imt_db)[1].items())
+        bulk_cn, bulk_cr = imt.db.open_db_file(bulk_db)
+        # and update a tag, on all of them, leaving the other tags as they are,
+        # in bulk for most, and one at a time for the last:
+        upd_tags = [(x, {'plot owner': 'bulk update'}) for x in all_imgs]
+        imt.db.write_imgs_to_open_db(bulk_cr, upd_tags[:-1], attempt_replace=True)
+        imt.db.write_img_to_open_db(bulk_cr, upd_tags[-1][0], upd_tags[-1][1],
+                                    attempt_replace=True)
+        bulk_cn.commit()
+        bulk_cn.close()
+        bulk_imgs, bulk_img_tags = imt.db.read(bulk_db)
+        if sorted(bulk_imgs) != sorted(all_imgs) or bulk_img_tags != all_img_tags:
+            raise ValueError('Database written in bulk differs from the original')
+    imt.db.SQLITE_HAS_UPSERT = has_upsert
+    imt.db.rm_db_file(bulk_db)
+    # an error in a batched write should not be hidden by the error in flushing it:
+    try:
+        with imt.db.BatchedDbWriter('{}/no_such_dir/imt_bulk.db'.format(webdir)) as db_writer:
+            db_writer.add(all_imgs[0], all_img_tags[all_imgs[0]])
+            raise KeyError('batched write error')
+    except KeyError:
+        pass
+
+    # selecting by tags should give the same results with or without indexes:
+    select_tags = {'plot type': 'Histogram',
+                   'expected dpi': ['72 dpi', '300 dpi']}
+    sel_no_index = imt.db.select_dbfile_by_tags(imt_db, select_tags)[0]
+    imt.db.INDEX_ADVISOR.create(imt_db)
+    sel_index = imt.db.select_dbfile_by_tags(imt_db, select_tags)[0]
+    if sorted(sel_no_index) != sorted(sel_index):
+        raise ValueError('Selecting from an indexed database gives different results')
+
+    # reading the database as a stream should give the same as reading it all:
+    iter_img_tags = dict(imt.db.iter_read(imt_db, batch_size=7))
+    if iter_img_tags != imt.db.read(imt_db)[1]:
+        raise ValueError('Database read as a stream differs from a full read')
+    iter_sel = [x for x, _ in imt.db.iter_read(imt_db, where=select_tags,
+                                               required_tags=['plot type'])]
+    if sorted(iter_sel) != sorted(sel_index):
+        raise ValueError('Database read as a stream differs from a select')
+    # as should reading just some of the tags, with the select done by sqlite:
+    sel_req_imgs, sel_req_tags = imt.db.select_dbfile_by_tags(imt_db, select_tags,
+                                                              required_tags=['plot type'])
+    if sorted(sel_req_imgs) != sorted(sel_index) or \
+            sel_req_tags != imt.db.read(imt_db, where=select_tags, required_tags=['plot type'])[1]:
+        raise ValueError('Database select of only the required_tags differs from a full select')
+    # the unique tag values, and their counts, should match the full read:
+    tag_counts = imt.db.tag_value_counts(imt_db, ['plot type', ('plot type', 'plot color')])
+    for tag_group, group_counts in tag_counts.items():
+        group_tags = tag_group if isinstance(tag_group, tuple) else (tag_group,)
+        read_counts = {}
+        for img_info in iter_img_tags.values():
+            values = tuple([img_info[x] for x in group_tags])
+            values = values if isinstance(tag_group, tuple) else values[0]
+            read_counts[values] = read_counts.get(values, 0) + 1
+        if group_counts != read_counts:
+            raise ValueError('Database tag value counts differ from a full read')
+    if imt.db.distinct_tag_values(imt_db, ['plot type'])['plot type'] != \
+            sorted(tag_counts['plot type']):
+        raise ValueError('Database unique tag values differ from the tag value counts')
+    # as should reading it into memory, copied or memory mapped:
+    for use_mmap in [False, True]:
+        mem_cn, mem_cr = imt.db.read_db_file_to_mem(imt_db, use_mmap=use_mmap)
+        if imt.db.read_img_info_from_dbcursor(mem_cr)[1] != iter_img_tags:
+            raise ValueError('Database read into memory differs from a full read')
+        mem_cn.close()
+    # and reading it immutable, as nothing is writing to it just now:
+    if imt.db.read(imt_db, immutable=True)[1] != iter_img_tags:
+        raise ValueError('Database read as immutable differs from a full read')
+    # or from a published snapshot:
+    snapshot_db = '{}/imt_snapshot.db'.format(webdir)
+    imt.db.publish_snapshot(imt_db, snapshot_db)
+    if imt.db.read(snapshot_db, immutable=True)[1] != iter_img_tags:
+        raise ValueError('Published snapshot of the database differs from a full read')
+    imt.db.rm_db_file(snapshot_db)
+    ro_cn, ro_cr = imt.db.open_db_file(imt_db, read_only=True)
+    try:
+        ro_cr.execute('DELETE FROM {}'.format(imt.db.SQLITE_IMG_INFO_TABLE))
+    except sqlite3.OperationalError:
+        pass
+    else:
+        raise ValueError('Database opened read-only can be written to')
+    finally:
+        ro_cn.close()
+
+    # merging two halves of the database should give the whole of it back:
+    merge_dbs = ['{}/imt_merge{}.db'.format(webdir, x) for x in (1, 2)]
+    merge_imgs = sorted(iter_img_tags)
+    for merge_db, half_imgs in zip(merge_dbs, [merge_imgs[::2], merge_imgs[1::2]]):
+        make_test_db(merge_db, [(x, iter_img_tags[x]) for x in half_imgs])
+    n_merged = imt.db.merge_db_files(merge_dbs[0], merge_dbs[1], delete_added_entries=True)
+    if imt.db.read(merge_dbs[0])[1] != iter_img_tags or imt.db.read(merge_dbs[1])[0]:
+        raise ValueError('Merged database differs from the original')
+    if n_merged != len(merge_imgs[1::2]):
+        raise ValueError('Merging databases reports the wrong number of images')
+    # images that are already there are only written with attempt_replace,
+    # which updates the tags in the added database, with or without UPSERT:
+    upd_info = {'plot owner': 'merge update'}
+    has_upsert = imt.db.SQLITE_HAS_UPSERT
+    for use_upsert in sorted(set([has_upsert, False])):
+        imt.db.SQLITE_HAS_UPSERT = use_upsert
+        make_test_db(merge_dbs[1], [(x, upd_info) for x in merge_imgs[:3]])
+        if imt.db.merge_db_files(merge_dbs[0], merge_dbs[1]) != 0:
+            raise ValueError('Merging images that are already in the database wrote them')
+        if imt.db.merge_db_files(merge_dbs[0], merge_dbs[1], attempt_replace=True) != 3:
+            raise ValueError('Merging with attempt_replace reports the wrong number of images')
+        if imt.db.read(merge_dbs[0])[1][merge_imgs[0]] != dict(iter_img_tags[merge_imgs[0]],
+                                                               **upd_info):
+            raise ValueError('Merging with attempt_replace did not update the tags')
+    imt.db.SQLITE_HAS_UPSERT = has_upsert
+    for merge_db in merge_dbs:
+        imt.db.rm_db_file(merge_db)
+    # and the same for many shards, with some of them encoded:
+    shard_dbs = ['{}/imt_shard{}.db'.format(webdir, x) for x in range(4)]
+    for i_shard, shard_db in enumerate(shard_dbs):
+        make_test_db(shard_db, [(x, iter_img_tags[x]) for x in merge_imgs[i_shard::4]],
+                     encode_tags=i_shard % 2 == 1)
+    shard_stats = imt.db.merge_many_db_files(merge_dbs[0], shard_dbs, delete_shards=True)
+    if imt.db.read(merge_dbs[0])[1] != iter_img_tags:
+        raise ValueError('Database merged from shards differs from the original')
+    if sum([x['n_rows'] for x in shard_stats.values()]) != len(merge_imgs):
+        raise ValueError('Database merged from shards reports the wrong number of images')
+    # images that are already there are not counted again, and encoded tags
+    # named as the columns of the tag values table are decoded properly:
+    make_test_db(shard_dbs[0], [(x, {'value': x}) for x in merge_imgs[:3] + ['new.png']],
+                 encode_tags=True)
+    dup_stats = imt.db.merge_many_db_files(merge_dbs[0], shard_dbs[:1], delete_shards=True)
+    if dup_stats[shard_dbs[0]]['n_rows'] != 1:
+        raise ValueError('Database merged from shards counts images that were already there')
+    if imt.db.read(merge_dbs[0], where={'value': 'new.png'})[0] != ['new.png']:
+        raise ValueError('Database merged from shards decodes a tag named value wrongly')
+    # and a shard that cannot be read should report why:
+    with open(shard_dbs[0], 'w') as bad_file:
+        bad_file.write('not a database\n' * 100)
+    try:
+        imt.db.merge_many_db_files(merge_dbs[0], shard_dbs[:1])
+    except sqlite3.DatabaseError as bad_err:
+        if 'not a database' not in str(bad_err):
+            raise
+    else:
+        raise ValueError('Merging a shard that is not a database did not fail')
+    os.remove(shard_dbs[0])
+    imt.db.rm_db_file(merge_dbs[0])
+
+    # compacting the database (after the delete above) should not change its contents:
+    imt.db.compact(imt_db, step_pages=1)
+    if imt.db.read(imt_db)[1] != iter_img_tags:
+        raise ValueError('Compacted database differs from the original')
+
+    # a seeded random sample should be reproducible, and part of the database:
+    sample_imgs, sample_tags = imt.db.read(imt_db, n_samples=3, sample_seed=5)
+    if sample_imgs != imt.db.read(imt_db, n_samples=3, sample_seed=5)[0]:
+        raise ValueError('Seeded random sample of the database is not reproducible')
+    if len(set(sample_imgs)) != 3 or any([iter_img_tags[x] != y for x, y in sample_tags.items()]):
+        raise ValueError('Random sample of the database is not consistent with a full read')
+
+    # with a change log, only the changes since the last read should be returned:
+    log_db = '{}/imt_log.db'.format(webdir)
+    make_test_db(log_db, iter_img_tags.items())
+    imt.db.enable_change_log(log_db)
+    log_token = imt.db.changes_since(log_db)[3]
+    log_imgs = sorted(iter_img_tags)
+    imt.db.del_plots_from_dbfile(log_db, log_imgs[0])
+    imt.db.write_img_to_dbfile(log_db, log_imgs[1], {'plot owner': 'change log'},
+                               attempt_replace=True)
+    imt.db.write_img_to_dbfile(log_db, 'log_test.png', {'plot owner': 'change log'})
+    log_added, log_updated, log_removed, log_token = imt.db.changes_since(log_db, log_token)
+    if (sorted(log_added) != ['log_test.png'] or sorted(log_updated) != [log_imgs[1]]
+            or log_removed != [log_imgs[0]]):
+        raise ValueError('Database change log does not give the expected changes')
+    if imt.db.changes_since(log_db, log_token)[:3] != ({}, {}, []):
+        raise ValueError('Database change log gives changes when there are none')
+    imt.db.rm_db_file(log_db)
+
+    # writing through the imt-dbd daemon, from several processes at once, should
+    # give the same database, as should writing directly when it is not running:
+    dbd_db = '{}/imt_dbd.db'.format(webdir)
+    imt.db.rm_db_file(dbd_db)
+    dbd_daemon = imt.dbd.DbDaemon(dbd_db)
+    dbd_daemon.start()
+    dbd_url = 'unix://{}{}'.format(dbd_db, imt.dbd.DBD_SOCKET_SUFFIX)
+    dbd_imgs = sorted(iter_img_tags)
+    dbd_pool = Pool(4)
+    dbd_pool.map(write_imgs_to_dbd, [(dbd_url, [(x, iter_img_tags[x]) for x in dbd_imgs[i::4]])
+                                     for i in range(4)])
+    dbd_pool.close()
+    dbd_pool.join()
+    dbd_daemon.shutdown()
+    if dbd_daemon.n_rows != len(dbd_imgs):
+        raise ValueError('imt-dbd daemon reports writing the wrong number of images')
+    # and anything sent after it has shut down gets an error, rather than waiting:
+    dbd_reply = dbd_daemon.handle_message({'op': 'write', 'rows': [[dbd_imgs[0], {}]]})
+    if dbd_reply['ok']:
+        raise ValueError('imt-dbd daemon accepted images after it was shut down')
+    imt.db.del_plots_from_dbfile(dbd_db, dbd_imgs[0])
+    write_imgs_to_dbd((dbd_url, [(dbd_imgs[0], iter_img_tags[dbd_imgs[0]])]))
+    if imt.db.read(dbd_db)[1] != iter_img_tags:
+        raise ValueError('Database written through imt-dbd differs from the original')
+    imt.db.rm_db_file(dbd_db)
+
+    # a sharded database, split by plot type, should read, select and delete
+    # the same as the database it was split from:
+    shard_dir = '{}/imt_shards'.format(webdir)
+    if os.path.isdir(shard_dir):
+        shutil.rmtree(shard_dir)
+    imt.shards.split_db_file(imt_db, shard_dir, 'plot type')
+    if imt.db.read(shard_dir, tag_strings=[])[1] != iter_img_tags:
+        raise ValueError('Sharded database differs from the database it was split from')
+    if imt.db.select_dbfile_by_tags(shard_dir, select_tags)[1] != \
+            imt.db.select_dbfile_by_tags(imt_db, select_tags)[1]:
+        raise ValueError('Selecting from a sharded database gives different results')
+    shard_imgs = sorted(iter_img_tags)[:3]
+    if imt.db.del_plots_from_dbfile(shard_dir, shard_imgs) != len(shard_imgs):
+        raise ValueError('Deleting from a sharded database deleted the wrong number of images')
+    for img_file in shard_imgs:
+        imt.db.write_img_to_dbfile(shard_dir, img_file, iter_img_tags[img_file])
+    if imt.db.read(shard_dir)[1] != iter_img_tags:
+        raise ValueError('Sharded database differs from the original after rewriting images')
+    if imt.db.del_plots_from_dbfile(shard_dir, shard_imgs[:1] * 2) != 1:
+        raise ValueError('Deleting a duplicated file from a sharded database miscounts')
+    imt.db.write_img_to_dbfile(shard_dir, shard_imgs[0], iter_img_tags[shard_imgs[0]])
+    # shards can have different tags, but read as a single database file would,
+    # with 'None' for the tags that an image's shard does not have:
+    extra_tags = {'plot type': 'Extra plots', 'extra tag': 'extra'}
+    imt.db.write_img_to_dbfile(shard_dir, 'extra.png', extra_tags)
+    union_tags = dict([(x, dict(y, **{'extra tag': 'None'})) for x, y in iter_img_tags.items()])
+    union_tags['extra.png'] = dict([(x, 'None') for x in iter_img_tags[shard_imgs[0]]],
+                                   **extra_tags)
+    if imt.db.read(shard_dir)[1] != union_tags:
+        raise ValueError('Sharded database with different tags in each shard reads wrongly')
+    if imt.db.read(shard_dir, required_tags=['extra tag'])[1] != \
+            dict([(x, {'extra tag': y['extra tag']}) for x, y in union_tags.items()]):
+        raise ValueError('Sharded database reads a tag that only one shard has wrongly')
+    if sorted(imt.db.read(shard_dir, where={'extra tag': 'None'})[0]) != sorted(iter_img_tags):
+        raise ValueError('Sharded database selects by a tag that only one shard has wrongly')
+    shutil.rmtree(shard_dir)
+
+    # a database with encoded tags should read and select the same:
+    enc_db = '{}/imt_encoded.db'.format(webdir)
+    make_test_db(enc_db, imt.db.read(imt_db)[1].items(), encode_tags=True)
+    if imt.db.read(enc_db)[1] != imt.db.read(imt_db)[1]:
+        raise ValueError('Database with encoded tags differs from the original')
+    if sorted(imt.db.select_dbfile_by_tags(enc_db, select_tags)[0]) != sorted(sel_index):
+        raise ValueError('Selecting from a database with encoded tags gives different results')
+    enc_codes = imt.db.read(enc_db, tag_codes=True)[1]
+    tag_values = imt.db.read_tag_values(enc_db)
+    for img_file, img_info in enc_codes.items():
+        dec_info = dict([(x, tag_values[y][1]) for x, y in img_info.items()])
+        if dec_info != iter_img_tags[img_file]:
+            raise ValueError('Tag codes do not match the tag values for {}'.format(img_file))
+    # reading by columns should give the same tag values, with or without encoding:
+    for col_db in [imt_db, enc_db]:
+        col_fnames, col_tags = imt.db.read_columnar(col_db)
+        for i_img, img_file in enumerate(col_fnames):
+            col_info = dict([(x, y[1][y[0][i_img]]) for x, y in col_tags.items()])
+            if col_info != iter_img_tags[img_file]:
+                raise ValueError('Columnar read differs from a full read for {}'.format(img_file))
+    # and a new tag, when the table is rebuilt, should be 'None' for all images:
+    enc_cn, enc_cr = imt.db.open_db_file(enc_db)
+    enc_fields = imt.db.get_table_schema(enc_cr)['fields']
+    imt.db.recrete_table_new_cols(enc_cr, enc_fields, ['rebuild tag'])
+    enc_cn.commit()
+    enc_cn.close()
+    enc_img_tags = imt.db.read(enc_db)[1]
+    for img_info in enc_img_tags.values():
+        if img_info.pop('rebuild tag') != 'None':
+            raise ValueError('Rebuilt database table has an unexpected value for a new tag')
+    if enc_img_tags != iter_img_tags:
+        raise ValueError('Rebuilt database table differs from the original')
+    imt.db.rm_db_file(enc_db)
+
+    # images without a tag (NULL, in an older database) should be in the same
+    # branch of an ImageDict as those where the tag is 'None':
+    null_imgs = {'a.png': {'model': 'A', 'plot': '1'},
+                 'b.png': {'model': 'None', 'plot': '2'},
+                 'c.png': {'model': 'None', 'plot': '3'}}
+    null_db = '{}/imt_null.db'.format(webdir)
+    for encode_tags in [False, True]:
+        make_test_db(null_db, sorted(null_imgs.items()), encode_tags=encode_tags)
+        null_cn, null_cr = imt.db.open_db_file(null_db)
+        null_cr.execute('UPDATE {} SET model=NULL WHERE {}=?'.format(
+            imt.db.SQLITE_IMG_INFO_TABLE, imt.db.SQLITE_IMG_INFO_FNAME), ('c.png',))
+        null_cn.commit()
+        null_cn.close()
+        null_dict = imt.ImageDict.from_db(null_db, ['model', 'plot'])
+        if null_dict.dict != {'A': {'1': 'a.png'}, 'None': {'2': 'b.png', '3': 'c.png'}}:
+            raise ValueError('ImageDict from a database with missing tags is incorrect')
+    imt.db.rm_db_file(null_db)
     print('Database integrity checks/memory optimsations completed')
 
     # Now make the next type of web page.
@@ -1285,6 +1678,7 @@ def __main__():
         raise ValueError('Testing failed in test_key_sorting')
 
     if not args.minimal:
+        benchmark_tag_strings(webdir)
 
         # now, finally, produce a large ImageDict:
         if not args.no_biggus_dictus: